@@ -1,11 +1,21 @@
 import Metashape
 import os
+import sys
 import argparse
 
-def process_project(project_path):
-    # Open the existing project
-    doc: object = Metashape.Document()
-    doc.open(project_path, ignore_lock=True)
+import BatchScheduler
+import ExportCache
+import ChunkSelection
+import CogConversion
+import ZonalStats
+from ProjectSession import ProjectSession
+from StageManifest import StageManifest
+import GradualSelection
+
+def process_project(project_path, gradual_selection=None, chunks=None, cog=None, zonal=None, **session_options):
+    # Open the existing project once for all stages; saves are coalesced by the session
+    session = ProjectSession(project_path, **session_options)
+    doc = session.doc
 
     # Define the base directory for output files (relative paths)
     base_dir = os.path.dirname(project_path)
@@ -13,15 +23,12 @@ def process_project(project_path):
     if not os.path.exists(export_dir):
         os.makedirs(export_dir)
 
-    # Set the chunk (assuming single chunk processing, but can be modified for multiple)
-    chunk = doc.chunk
-
     # Set the coordinate system (EPSG::2056 - CH1903+ / LV95)
     # coord_system = Metashape.CoordinateSystem("EPSG::2056")
 
     # Set the coordinate system (EPSG::4326 - WGS 84)
-    coord_system = Metashape.CoordinateSystem("EPSG::4326")
-    chunk.crs = coord_system
+    crs_code = "EPSG::4326"
+    coord_system = Metashape.CoordinateSystem(crs_code)
 
     # Create OrthoProjection object using the same coordinate system
     ortho_proj = Metashape.OrthoProjection()
@@ -29,9 +36,8 @@ def process_project(project_path):
 
     # Settings GPU enabled
 
-    # Apply Raster Transform
-    print("Applying raster transform and exporting...")
-    chunk.raster_transform.formula = [
+    # Raster transform applied to the orthomosaic exports
+    raster_formula = [
         'B1 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
         'B2 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
         'B4 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
@@ -39,100 +45,165 @@ def process_project(project_path):
         'B6 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
         '(B7 / 100) - 273.15'
     ]
+
+    # Process every enabled chunk, or the selected ones, with the settings above. The chunks
+    # of a project run one after the other in the open document.
+    for chunk in ChunkSelection.select_chunks(doc, chunks):
+        print(f"Processing chunk {chunk.label}...")
+        session.process_chunk(process_chunk, chunk, export_dir, crs_code, ortho_proj, raster_formula,
+                              gradual_selection=gradual_selection, cog=cog, zonal=zonal)
+
+    # Exports do not modify the project, so this only saves changes not yet written at a save point
+    session.close()
+    return session.stats
+
+
+def process_chunk(session, chunk, export_dir, crs_code, ortho_proj, raster_formula, gradual_selection=None, cog=None,
+                  zonal=None):
+    project_path = session.project_path
+    doc = session.doc
+    session.chunk = chunk
+    # Exports are named after the chunk
+    label = ChunkSelection.export_label(doc, chunk)
+    chunk.crs = ortho_proj.crs
+
+    # Apply Raster Transform
+    print("Applying raster transform and exporting...")
+    chunk.raster_transform.formula = raster_formula
     chunk.raster_transform.enabled = True
 
+    # Completed stages are tracked per chunk so reruns only redo what changed
+    manifest = StageManifest(project_path, ChunkSelection.manifest_key(doc, chunk))
+    session.on_save(manifest.save)
+    camera_labels = [camera.label for camera in chunk.cameras]
+
     # Step 0: Load script to align cameras, filter tie points for reprojection error and calibrate camera
 
     # Align cameras if not already aligned
-    if not chunk.cameras[0].transform:
-        print("Aligning cameras...")
-        chunk.matchPhotos(downscale=1, keypoint_limit=40000, tiepoint_limit=10000, generic_preselection=True,
-                          reference_preselection=True)
-        chunk.alignCameras()
+    match_params = dict(downscale=1, keypoint_limit=40000, tiepoint_limit=10000, generic_preselection=True,
+                        reference_preselection=True)
+    cameras_aligned = any(camera.transform for camera in chunk.cameras)
+    if manifest.needs_run("align", params=match_params, inputs=camera_labels, present=cameras_aligned):
+        with session.stage("align") as progress:
+            print("Aligning cameras...")
+            chunk.matchPhotos(progress=progress.part(0, 2), **match_params)
+            chunk.alignCameras(progress=progress.part(1, 2))
+            manifest.complete("align")
     else:
         print("Cameras are already aligned. Skipping.")
 
-    doc.save()
+    # Camera optimization settings, also used between the rounds of the adaptive gradual selection
+    optimize_params = dict(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, adaptive_fitting=False)
 
-    # Gradual selection based on reprojection error
-    print("Gradual selection for reprojection error...")
-    f = Metashape.TiePoints.Filter()  # Create filter object
+    # Gradual selection: one pass on the reprojection error, or the adaptive loop over several criteria
     threshold = 0.5  # Create reprojection error threshold
-    f.init(chunk, criterion=Metashape.TiePoints.Filter.ReprojectionError)  # Init with reprojection error criterion
-    f.removePoints(threshold)  # Remove points with reprojection error greater than the threshold
-    doc.save()
+    selection_params = gradual_selection or {"criterion": "ReprojectionError", "threshold": threshold}
+    if manifest.needs_run("gradual_selection", params=selection_params, depends=["align"]):
+        with session.stage("gradual_selection") as progress:
+            if gradual_selection:
+                print("Adaptive gradual selection...")
+                iterations = GradualSelection.adaptive_selection(chunk, optimize_params=optimize_params, progress=progress,
+                                                                 **gradual_selection)
+                GradualSelection.write_log(project_path, iterations, gradual_selection, label)
+            else:
+                print("Gradual selection for reprojection error...")
+                f = Metashape.TiePoints.Filter()  # Create filter object
+                f.init(chunk, criterion=Metashape.TiePoints.Filter.ReprojectionError)  # Init with reprojection error criterion
+                f.removePoints(threshold)  # Remove points with reprojection error greater than the threshold
+            manifest.complete("gradual_selection")
 
     # Optimize camera alignment by adjusting intrinsic parameters
-    print("Optimizing camera alignment...")
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, adaptive_fitting=False)
-    doc.save()
+    if manifest.needs_run("optimize", params=optimize_params, depends=["gradual_selection"]):
+        with session.stage("optimize") as progress:
+            print("Optimizing camera alignment...")
+            chunk.optimizeCameras(progress=progress, **optimize_params)
+            manifest.complete("optimize")
 
     # Step 1: Build Depth Maps and Dense Point Cloud (Redundancy Check)
-    if not chunk.depth_maps:
-        print("Building Depth Maps...")
-        chunk.buildDepthMaps(downscale=1, filter_mode=Metashape.MildFiltering)
+    depth_params = dict(downscale=1, filter_mode=Metashape.MildFiltering)
+    if manifest.needs_run("depth_maps", params=depth_params, depends=["optimize"],
+                          present=chunk.depth_maps is not None):
+        with session.stage("depth_maps") as progress:
+            print("Building Depth Maps...")
+            chunk.buildDepthMaps(progress=progress, **depth_params)
+            manifest.complete("depth_maps")
     else:
         print("Depth Maps already exist. Skipping.")
 
-    if not chunk.point_cloud:
-        print("Building Point Cloud...")
-        chunk.buildPointCloud(
-            source_data=Metashape.DataSource.DepthMapsData,
-            point_colors=True
-        )
+    point_cloud_params = dict(source_data=Metashape.DataSource.DepthMapsData, point_colors=True)
+    if manifest.needs_run("point_cloud", params=point_cloud_params, depends=["depth_maps"],
+                          present=chunk.point_cloud is not None):
+        with session.stage("point_cloud") as progress:
+            print("Building Point Cloud...")
+            chunk.buildPointCloud(progress=progress, **point_cloud_params)
+            manifest.complete("point_cloud")
     else:
         print("Point Cloud already exists. Skipping.")
-    doc.save()
 
     # Step 2: Build DEM (Redundancy Check)
-    if not chunk.elevations:
-        print("Building DEM...")
-        chunk.buildDem(
-            source_data=Metashape.PointCloudData,
-            interpolation=Metashape.EnabledInterpolation,
-            projection=ortho_proj
-        )
+    dem_params = dict(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation)
+    dem = manifest.elevation(chunk, "dem", adopt=True)
+    if manifest.needs_run("dem", params=dict(dem_params, crs=crs_code), depends=["point_cloud"],
+                          present=dem is not None, product=dem.key if dem else None):
+        with session.stage("dem") as progress:
+            print("Building DEM...")
+            chunk.buildDem(progress=progress, projection=ortho_proj, **dem_params)
+            dem = chunk.elevation
+            manifest.complete("dem", product=dem.key)
     else:
         print("DEM already exists. Skipping.")
-    doc.save()
 
     # Step 3: Build Orthomosaic (Redundancy Check)
-    if not chunk.orthomosaic:
-        print("Building Orthomosaic...")
-        chunk.buildOrthomosaic(
-            surface_data=Metashape.ElevationData,
-            blending_mode=Metashape.DisabledBlending,
-            projection=ortho_proj
-        )
+    ortho_params = dict(surface_data=Metashape.ElevationData, blending_mode=Metashape.DisabledBlending)
+    if manifest.needs_run("orthomosaic", params=dict(ortho_params, crs=crs_code), depends=["dem"],
+                          present=chunk.orthomosaic is not None):
+        with session.stage("orthomosaic") as progress:
+            print("Building Orthomosaic...")
+            # The orthomosaic is projected on the active elevation, which may be the DTM
+            chunk.elevation = dem
+            chunk.buildOrthomosaic(progress=progress, projection=ortho_proj, **ortho_params)
+            manifest.complete("orthomosaic")
     else:
         print("Orthomosaic already exists. Skipping.")
-    doc.save()
-
-    # Step 4 & 5: Export DEM and Orthomosaic
-    if chunk.elevation:
-        dem_path = os.path.join(export_dir, chunk.label + "_DEM.tif")
-        print(f"Exporting DEM to {dem_path}...")
-        chunk.exportRaster(
-            path=dem_path,
-            source_data=Metashape.ElevationData,
-            image_format=Metashape.ImageFormatTIFF,
-            projection=ortho_proj
-        )
+
+    # Step 4 & 5: Export DEM and Orthomosaic, unless the exports are up to date with the chunk
+    if dem is not None:
+        dem_path = os.path.join(export_dir, label + "_DEM.tif")
+        dem_export = dict(source_data=Metashape.ElevationData, image_format=Metashape.ImageFormatTIFF)
+        fingerprint = ExportCache.export_fingerprint(manifest, ["dem"], crs=crs_code, **dem_export)
+        if ExportCache.up_to_date(dem_path, fingerprint):
+            print(f"DEM export {dem_path} is up to date. Skipping.")
+        else:
+            print(f"Exporting DEM to {dem_path}...")
+            with session.stage("export_dem", modifies=False) as progress, \
+                    ExportCache.atomic_export(dem_path, fingerprint) as tmp_path:
+                chunk.elevation = dem
+                chunk.exportRaster(
+                    progress=progress,
+                    path=tmp_path,
+                    projection=ortho_proj,
+                    **dem_export
+                )
 
     if chunk.orthomosaic:
-        ortho_path = os.path.join(export_dir, chunk.label + "_Ortho.tif")
-        print(f"Exporting Orthomosaic to {ortho_path}...")
-        chunk.exportRaster(
-            path=ortho_path,
-            source_data=Metashape.OrthomosaicData,
-            image_format=Metashape.ImageFormatTIFF,
-            projection=ortho_proj
-        )
-    doc.save()
+        ortho_path = os.path.join(export_dir, label + "_Ortho.tif")
+        ortho_export = dict(source_data=Metashape.OrthomosaicData, image_format=Metashape.ImageFormatTIFF)
+        fingerprint = ExportCache.export_fingerprint(manifest, ["orthomosaic"], crs=crs_code, **ortho_export)
+        if ExportCache.up_to_date(ortho_path, fingerprint):
+            print(f"Orthomosaic export {ortho_path} is up to date. Skipping.")
+        else:
+            print(f"Exporting Orthomosaic to {ortho_path}...")
+            with session.stage("export_orthomosaic", modifies=False) as progress, \
+                    ExportCache.atomic_export(ortho_path, fingerprint) as tmp_path:
+                chunk.exportRaster(
+                    progress=progress,
+                    path=tmp_path,
+                    projection=ortho_proj,
+                    **ortho_export
+                )
 
     # Step 6: Build DTM from Classified Ground Points
-    print("Classifying Ground Points...")
-    chunk.point_cloud.classifyGroundPoints(
+    ground_params = dict(
         max_angle=40,  # Allow steeper slopes
         max_distance=2.5,  # Adjust for vegetation
         max_terrain_slope=35,  # Handle sloped terrain
@@ -141,54 +212,91 @@ def process_project(project_path):
         return_number=0,  # Use last return (-1) for LiDAR (or 0 for photogrammetry)
         keep_existing=False  # Reclassify all points
     )
-    doc.save()
-
-    print("Building DTM from classified ground points...")
-    ground_points = [Metashape.PointClass.Ground]
-    chunk.buildDem(
-        source_data=Metashape.PointCloudData,
-        interpolation=Metashape.EnabledInterpolation,
-        projection=ortho_proj,
-        classes=ground_points
-    )
-
-    dtm_path = os.path.join(export_dir, chunk.label + "_DTM.tif")
-    print(f"Exporting DTM to {dtm_path}...")
-    chunk.exportRaster(
-        path=dtm_path,
-        source_data=Metashape.ElevationData,
-        image_format=Metashape.ImageFormatTIFF,
-        projection=ortho_proj
-    )
-    doc.save()
-
-    # Export the processing report
-    report_path = os.path.join(export_dir, chunk.label + "_report.pdf")
-    print(f"Exporting processing report to {report_path}...")
-    chunk.exportReport(report_path)
-    doc.save()
+    if manifest.needs_run("ground_classification", params=ground_params, depends=["point_cloud"]):
+        with session.stage("ground_classification") as progress:
+            print("Classifying Ground Points...")
+            chunk.point_cloud.classifyGroundPoints(progress=progress, **ground_params)
+            manifest.complete("ground_classification")
+
+    dtm_params = dict(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation)
+    dtm = manifest.elevation(chunk, "dtm")
+    if manifest.needs_run("dtm", params=dict(dtm_params, crs=crs_code), depends=["ground_classification"],
+                          present=dtm is not None):
+        with session.stage("dtm") as progress:
+            print("Building DTM from classified ground points...")
+            ground_points = [Metashape.PointClass.Ground]
+            chunk.buildDem(progress=progress, projection=ortho_proj, classes=ground_points, **dtm_params)
+            dtm = chunk.elevation
+            manifest.complete("dtm", product=dtm.key)
+
+    dtm_path = os.path.join(export_dir, label + "_DTM.tif")
+    dtm_export = dict(source_data=Metashape.ElevationData, image_format=Metashape.ImageFormatTIFF)
+    fingerprint = ExportCache.export_fingerprint(manifest, ["dtm"], crs=crs_code, **dtm_export)
+    if ExportCache.up_to_date(dtm_path, fingerprint):
+        print(f"DTM export {dtm_path} is up to date. Skipping.")
+    else:
+        print(f"Exporting DTM to {dtm_path}...")
+        with session.stage("export_dtm", modifies=False) as progress, \
+                ExportCache.atomic_export(dtm_path, fingerprint) as tmp_path:
+            chunk.elevation = dtm
+            chunk.exportRaster(
+                progress=progress,
+                path=tmp_path,
+                projection=ortho_proj,
+                **dtm_export
+            )
+
+    # Step 7: Cloud-Optimized GeoTIFF copies of the exports for GIS and web viewers
+    if cog:
+        cog_paths = [os.path.join(export_dir, label + suffix) for suffix in ("_DEM.tif", "_Ortho.tif", "_DTM.tif")]
+        session.post("export_cog", CogConversion.convert_exports, cog_paths, inputs=cog_paths, **cog)
+
+    # Statistics of the orthomosaic bands per plot
+    if zonal:
+        ortho_path = os.path.join(export_dir, label + "_Ortho.tif")
+        session.post("zonal_stats", ZonalStats.update_flight, ortho_path, inputs=[ortho_path], **zonal)
+
+    # Export the processing report; it covers every stage, so any rerun stage renews it
+    report_path = os.path.join(export_dir, label + "_report.pdf")
+    fingerprint = ExportCache.export_fingerprint(manifest, sorted(manifest.stages))
+    if ExportCache.up_to_date(report_path, fingerprint):
+        print(f"Processing report {report_path} is up to date. Skipping.")
+    else:
+        print(f"Exporting processing report to {report_path}...")
+        with session.stage("export_report", modifies=False) as progress, \
+                ExportCache.atomic_export(report_path, fingerprint) as tmp_path:
+            chunk.exportReport(tmp_path, progress=progress)
 
 
-def process_multiple_projects(project_paths):
-    for project_path in project_paths:
-        process_project(project_path)
+def process_multiple_projects(project_paths, workers=1, **options):
+    return BatchScheduler.run_batch(process_project, project_paths, workers=workers, **options)
 
 
-def process_multiple_projects_from_file(filepath):
+def process_multiple_projects_from_file(filepath, workers=1, **options):
     """Read project paths from a text file and process each."""
-    with open(filepath, 'r') as file:
-        project_paths = [line.strip() for line in file.readlines()]
-    process_multiple_projects(project_paths)
+    project_paths = BatchScheduler.read_project_list(filepath)
+    return process_multiple_projects(project_paths, workers=workers, **options)
 
 
 def main():
     # Set up the argument parser
     parser = argparse.ArgumentParser(description="Process Metashape projects from a text file.")
     parser.add_argument('project_paths', type=str, help='Path to the text file containing Metashape project paths.')
+    GradualSelection.add_selection_arguments(parser)
+    ChunkSelection.add_chunk_arguments(parser)
+    CogConversion.add_cog_arguments(parser)
+    ZonalStats.add_zonal_arguments(parser)
+    BatchScheduler.add_batch_arguments(parser)
     args = parser.parse_args()
 
     # Process the projects from the text file
-    process_multiple_projects_from_file(args.project_paths)
+    results = process_multiple_projects_from_file(args.project_paths, workers=args.workers,
+                                                  gradual_selection=GradualSelection.selection_settings(args),
+                                                  chunks=ChunkSelection.parse_chunks(args.chunks),
+                                                  cog=CogConversion.cog_settings(args),
+                                                  zonal=ZonalStats.zonal_settings(args),
+                                                  **BatchScheduler.batch_options(args))
+    sys.exit(BatchScheduler.exit_code(results))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import os
+import json
+from datetime import datetime
+
+from StageManifest import digest
+
+# Options that change how a project is opened and saved, but not what is computed
+SESSION_OPTIONS = ("ignore_lock", "stale_lock_hours", "save_after", "progress_dir", "defer_post", "measure_writes")
+
+
+def journal_path(list_path):
+    """The default journal of a project list, e.g. projects.txt.journal.json."""
+    return list_path + ".journal.json"
+
+
+def project_key(project_path):
+    return os.path.normcase(os.path.abspath(project_path))
+
+
+class BatchJournal:
+    """
+    Outcome of every project of a batch, kept on disk so that a restarted batch can resume.
+
+    Entries are kept per pipeline function and processing options, so running the same
+    list with other settings (or another script) does not pick up the finished projects
+    of the earlier run. Projects recorded as finished are skipped on resume; all others
+    are run again, and their stage manifests let them continue after the last completed
+    stage.
+    """
+
+    def __init__(self, path, process_fn, options):
+        self.path = path
+        self.key = digest({"pipeline": f"{process_fn.__module__}.{process_fn.__name__}",
+                           "options": {k: v for k, v in options.items() if k not in SESSION_OPTIONS}})
+        self.batches = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.batches = json.load(file).get("batches", {})
+        self.projects = self.batches.setdefault(self.key, {"pipeline": process_fn.__name__, "projects": {}})["projects"]
+
+    def finished(self, project_path):
+        """The entry of a project that finished in an earlier run, or None."""
+        entry = self.projects.get(project_key(project_path))
+        return entry if entry is not None and entry["status"] == "ok" else None
+
+    def record(self, project_path, status, **details):
+        self.projects[project_key(project_path)] = dict(details, project=project_path, status=status,
+                                                        updated=datetime.now().isoformat(timespec="seconds"))
+        self.save()
+
+    def reset(self):
+        self.projects.clear()
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"batches": self.batches}, file, indent=2, default=str)
+        os.replace(tmp_path, self.path)
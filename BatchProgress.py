@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".geco_stage_history.json")
+
+# Weight of the newest run in the running average of the stage durations
+HISTORY_WEIGHT = 0.3
+
+
+def status_file(progress_dir, project_path):
+    key = hashlib.sha1(os.path.abspath(project_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(progress_dir, key + ".json")
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    if seconds < 60:
+        return f"{seconds:.0f} s"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+class StageHistory:
+    """
+    Running averages of the seconds per image each stage took in earlier batches, per pipeline.
+
+    The order in which the stages ran is kept as well, so the stages still ahead of a
+    running project can be estimated. The peak memory per image of each stage is
+    averaged the same way, for the memory budget of the batch scheduler.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.pipelines = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.pipelines = json.load(file)
+
+    def expected(self, pipeline, stage, images):
+        entry = self.pipelines.get(pipeline, {}).get("stages", {}).get(stage)
+        if entry is None:
+            return None
+        return entry["seconds_per_image"] * max(images or 1, 1)
+
+    def stages_after(self, pipeline, stage):
+        order = self.pipelines.get(pipeline, {}).get("order", [])
+        return order[order.index(stage) + 1:] if stage in order else order
+
+    def expected_project(self, pipeline, images):
+        estimates = [self.expected(pipeline, stage, images) for stage in self.pipelines.get(pipeline, {}).get("order", [])]
+        return sum(e for e in estimates if e is not None) if estimates else None
+
+    def expected_peak(self, pipeline, images):
+        """Peak memory in bytes of the most demanding stage for a project with this many images."""
+        peaks = [entry["peak_bytes_per_image"] for entry in self.pipelines.get(pipeline, {}).get("stages", {}).values()
+                 if entry.get("peak_bytes_per_image")]
+        return max(peaks) * max(images or 1, 1) if peaks else None
+
+    def update(self, pipeline, results):
+        """Fold the stage metrics of finished projects into the averages."""
+        entry = self.pipelines.setdefault(pipeline, {"stages": {}, "order": []})
+        for result in results:
+            if result["status"] != "ok":
+                continue
+            previous = None
+            for record in result["stats"].get("stages", []):
+                stage = record["stage"]
+                seconds_per_image = record["wall_seconds"] / max(record["image_count"] or 1, 1)
+                peak_per_image = (record.get("peak_rss_bytes") or 0) / max(record["image_count"] or 1, 1)
+                stats = entry["stages"].get(stage)
+                if stats is None:
+                    entry["stages"][stage] = {"seconds_per_image": seconds_per_image, "samples": 1}
+                    if peak_per_image:
+                        entry["stages"][stage]["peak_bytes_per_image"] = peak_per_image
+                else:
+                    stats["seconds_per_image"] += HISTORY_WEIGHT * (seconds_per_image - stats["seconds_per_image"])
+                    if peak_per_image:
+                        previous_peak = stats.get("peak_bytes_per_image", peak_per_image)
+                        stats["peak_bytes_per_image"] = previous_peak + HISTORY_WEIGHT * (peak_per_image - previous_peak)
+                    stats["samples"] += 1
+                if stage not in entry["order"]:
+                    position = entry["order"].index(previous) + 1 if previous in entry["order"] else len(entry["order"])
+                    entry["order"].insert(position, stage)
+                previous = stage
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.pipelines, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class ProgressReporter:
+    """
+    Worker side: writes the progress of one project to its status file.
+
+    Metashape calls the progress callbacks very often from inside its processing calls,
+    so a callback only compares a timestamp and returns; the file is rewritten at most
+    once per `interval` seconds.
+    """
+
+    def __init__(self, progress_dir, project_path, interval=5.0):
+        self.path = status_file(progress_dir, project_path)
+        self.interval = interval
+        self.status = {"project": project_path, "stage": None, "fraction": 0.0, "stage_started": None,
+                       "images": None, "done": [], "updated": time.time()}
+        self.last_write = 0.0
+
+    def start_stage(self, stage, images):
+        self.status.update(stage=stage, fraction=0.0, stage_started=time.time(), images=images)
+        self.write()
+
+    def update(self, fraction):
+        now = time.monotonic()
+        if now - self.last_write < self.interval:
+            return
+        self.status["fraction"] = min(max(fraction, 0.0), 1.0)
+        self.write()
+
+    def finish_stage(self, stage):
+        self.status["done"].append(stage)
+        self.status.update(stage=None, fraction=0.0, stage_started=None)
+        self.write()
+
+    def write(self):
+        self.last_write = time.monotonic()
+        self.status["updated"] = time.time()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.status, file)
+        os.replace(tmp_path, self.path)
+
+
+class StageProgress:
+    """
+    Progress callback handed to Metashape calls, e.g. chunk.buildDepthMaps(progress=progress).
+
+    Stages made of several calls give each call a part of the range with part(); without
+    a reporter the callback does nothing.
+    """
+
+    def __init__(self, reporter=None, start=0.0, span=1.0):
+        self.reporter = reporter
+        self.start = start
+        self.span = span
+
+    def __call__(self, percent):
+        if self.reporter is not None:
+            self.reporter.update(self.start + self.span * percent / 100.0)
+
+    def part(self, index, count):
+        return StageProgress(self.reporter, self.start + self.span * index / count, self.span / count)
+
+
+class ProgressMonitor:
+    """
+    Batch side: reads the status files of the running projects and prints the progress
+    and the estimated time left, per stage and for the whole batch.
+
+    Estimates combine the progress reported by Metashape with the stage history: a stage
+    that reported enough progress is extrapolated from its own rate, otherwise the history
+    average for its image count is used. Projects whose status did not change for
+    `stall_minutes` are flagged as possibly stalled.
+    """
+
+    def __init__(self, progress_dir, project_paths, pipeline, workers, history, interval=60.0, stall_minutes=30.0):
+        self.progress_dir = progress_dir
+        self.project_paths = project_paths
+        self.pipeline = pipeline
+        self.workers = max(workers, 1)
+        self.history = history
+        self.interval = interval
+        self.stall_seconds = stall_minutes * 60
+        self.finished = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop_event.set()
+        self.thread.join()
+        return False
+
+    def project_finished(self, result):
+        self.finished[result["project"]] = result["duration"]
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def read_status(self, project_path):
+        try:
+            with open(status_file(self.progress_dir, project_path), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def stage_remaining(self, status, now):
+        elapsed = now - status["stage_started"]
+        fraction = status["fraction"]
+        if fraction >= 0.05:
+            return elapsed * (1 - fraction) / fraction
+        expected = self.history.expected(self.pipeline, status["stage"], status["images"])
+        return max(expected - elapsed, 0.0) if expected is not None else None
+
+    def project_remaining(self, status, stage_remaining):
+        if stage_remaining is None:
+            return None
+        remaining = stage_remaining
+        for stage in self.history.stages_after(self.pipeline, status["stage"]):
+            if stage not in status["done"]:
+                remaining += self.history.expected(self.pipeline, stage, status["images"]) or 0.0
+        return remaining
+
+    def report(self):
+        now = time.time()
+        lines = []
+        running_remaining = 0.0
+        image_counts = []
+        pending = 0
+        for project_path in self.project_paths:
+            if project_path in self.finished:
+                continue
+            status = self.read_status(project_path)
+            if status is None:
+                pending += 1
+                continue
+            image_counts.append(status["images"] or 0)
+            name = os.path.splitext(os.path.basename(project_path))[0]
+            if status["stage"] is None:
+                lines.append(f"  {name}: between stages, saving or preparing")
+                continue
+            stage_remaining = self.stage_remaining(status, now)
+            project_remaining = self.project_remaining(status, stage_remaining)
+            running_remaining += project_remaining or 0.0
+            line = (f"  {name}: {status['stage']} {status['fraction'] * 100:.0f}%, "
+                    f"stage ETA {format_duration(stage_remaining)}, project ETA {format_duration(project_remaining)}")
+            if now - status["updated"] > self.stall_seconds:
+                line += f"  -- no progress for {format_duration(now - status['updated'])}, stalled?"
+            lines.append(line)
+
+        # Projects not started yet are estimated from the history, or from the finished projects
+        per_project = None
+        if image_counts:
+            per_project = self.history.expected_project(self.pipeline, sum(image_counts) / len(image_counts))
+        if per_project is None and self.finished:
+            per_project = sum(self.finished.values()) / len(self.finished)
+        batch_remaining = None
+        if per_project is not None or pending == 0:
+            batch_remaining = (running_remaining + pending * (per_project or 0.0)) / self.workers
+
+        print(f"[progress {time.strftime('%H:%M')}] {len(self.finished)}/{len(self.project_paths)} done, "
+              f"{len(self.project_paths) - len(self.finished) - pending} running, {pending} pending, "
+              f"batch ETA {format_duration(batch_remaining)}", flush=True)
+        for line in lines:
+            print(line, flush=True)
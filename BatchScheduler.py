@@ -0,0 +1,506 @@
+import os
+import json
+import time
+import shutil
+import inspect
+import tempfile
+import traceback
+import contextlib
+import collections
+import multiprocessing
+import multiprocessing.connection
+
+from ProjectLock import ProjectLockedError, lock_file_path, lock_age_hours
+from StageMetrics import write_batch_metrics
+from BatchProgress import ProgressMonitor, StageHistory, status_file, format_duration
+from BatchJournal import BatchJournal, journal_path
+from ProjectInspector import InspectorCache, inspect_projects
+from PostProcessing import PostProcessingQueue, deferred_jobs
+from ImageValidation import validate_projects
+
+# Failures that come from the project or the script: running the project again gives the same error
+PERMANENT_ERRORS = (ValueError, TypeError, AttributeError, KeyError, IndexError, NotImplementedError,
+                    FileNotFoundError, PermissionError)
+# Failures of the machine rather than the project, which may well pass on a second attempt
+RETRYABLE_ERRORS = (OSError, MemoryError, TimeoutError, ConnectionError)
+# Metashape raises plain exceptions; these messages point at memory, GPU, disk or network trouble
+RETRYABLE_MESSAGES = ("out of memory", "not enough memory", "bad allocation", "cuda", "opencl", "gpu",
+                      "i/o error", "input/output error", "no space left", "network", "timed out")
+
+
+def read_project_list(filepath):
+    """Read project paths from a text file, skipping blank lines, comments and duplicates."""
+    with open(filepath, 'r') as file:
+        project_paths = [line.strip() for line in file.readlines()]
+    return unique_project_paths(p for p in project_paths if p and not p.startswith("#"))
+
+
+def unique_project_paths(project_paths):
+    """Drop repeated entries so the same .psx is never processed by two workers at once."""
+    seen = set()
+    unique_paths = []
+    for project_path in project_paths:
+        key = os.path.normcase(os.path.abspath(project_path))
+        if key not in seen:
+            seen.add(key)
+            unique_paths.append(project_path)
+    return unique_paths
+
+
+def is_retryable(error):
+    """Tell whether a failed project is worth another attempt."""
+    if isinstance(error, PERMANENT_ERRORS):
+        return False
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    message = str(error).lower()
+    return any(text in message for text in RETRYABLE_MESSAGES)
+
+
+def project_images(project_paths):
+    """
+    Images of the largest chunk of every project; None if unknown.
+
+    Taken from the inspector cache where the project is unchanged, otherwise read from the
+    project files without measuring folder sizes, which counting cameras does not need.
+    """
+    images = {}
+    for info in inspect_projects(project_paths, InspectorCache(), sizes=False):
+        cameras = [chunk["cameras"] for chunk in info["chunks"]]
+        images[info["project"]] = max(cameras) if cameras else None
+    return images
+
+
+def run_project(process_fn, project_path, options):
+    """Run one project and turn its outcome into a summary record instead of an exception."""
+    result = {"project": project_path, "status": "ok", "error": None, "retryable": False, "duration": 0.0, "stats": {}}
+    start_time = time.time()
+    try:
+        result["stats"] = process_fn(project_path, **options) or {}
+    except ProjectLockedError as e:
+        print(f"Skipping locked project: {e}")
+        result["status"] = "locked"
+        result["error"] = str(e)
+    except Exception as e:
+        print(f"Error while processing {project_path}: {e}")
+        traceback.print_exc()
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["retryable"] = is_retryable(e)
+    result["duration"] = time.time() - start_time
+    return result
+
+
+def _worker_main(process_fn, project_path, options, connection):
+    connection.send(run_project(process_fn, project_path, options))
+    connection.close()
+
+
+class WorkerProcess:
+    """One project running in its own freshly spawned process, which can be stopped when a stage hangs."""
+
+    def __init__(self, context, process_fn, project_path, options, attempt):
+        self.project_path = project_path
+        self.attempt = attempt
+        self.progress_dir = options.get("progress_dir")
+        self.start_time = time.time()
+        self.owns_lock = self.takes_lock(project_path, options)
+        if self.progress_dir:
+            # A status file left by an earlier attempt would make the new one look hung
+            with contextlib.suppress(OSError):
+                os.remove(status_file(self.progress_dir, project_path))
+        self.connection, child_connection = context.Pipe(duplex=False)
+        # Not a daemon, so that the project may run processes of its own, e.g. tiles of a large flight
+        self.process = context.Process(target=_worker_main, args=(process_fn, project_path, options, child_connection))
+        self.process.start()
+        child_connection.close()
+
+    @staticmethod
+    def takes_lock(project_path, options):
+        """
+        Whether the lock of the project will be the worker's: it is if the project is not
+        locked yet, or if the worker breaks a stale lock. A lock ignored with ignore_lock
+        belongs to another Metashape instance.
+        """
+        age = lock_age_hours(project_path)
+        if age is None:
+            return True
+        stale_lock_hours = options.get("stale_lock_hours")
+        return not options.get("ignore_lock") and stale_lock_hours is not None and age >= stale_lock_hours
+
+    def wait_objects(self):
+        """Handles that become ready when the worker sends its result or exits."""
+        return [self.connection, self.process.sentinel]
+
+    def stage_deadline(self, stage_timeout):
+        """Time at which the current stage times out; a stage not yet reported cannot time out before now + timeout."""
+        stage, stage_started = self.current_stage()
+        return (stage_started if stage is not None else time.time()) + stage_timeout
+
+    def current_stage(self):
+        """The stage the worker is in and since when, from its progress status file."""
+        if not self.progress_dir:
+            return None, None
+        try:
+            with open(status_file(self.progress_dir, self.project_path), 'r') as file:
+                status = json.load(file)
+        except (OSError, ValueError):
+            return None, None
+        return status["stage"], status["stage_started"]
+
+    def poll(self, stage_timeout=None):
+        """The result once the worker is done, a failure record if it died or hung, otherwise None."""
+        # The result is read before the process is joined, so a large result cannot block the worker
+        if self.connection.poll():
+            try:
+                result = self.connection.recv()
+            except EOFError:
+                result = None
+            if result is not None:
+                self.process.join()
+                return result
+        if not self.process.is_alive():
+            self.process.join()
+            return self.failure(f"Worker crashed (exit code {self.process.exitcode})")
+        stage, stage_started = self.current_stage()
+        if stage_timeout and stage is not None and time.time() - stage_started > stage_timeout:
+            self.stop()
+            return self.failure(f"Stage '{stage}' timed out after {format_duration(stage_timeout)}")
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join(30)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def failure(self, error):
+        print(f"{error}: {self.project_path}")
+        # A lock the worker created is left behind by the stopped worker and ours to remove;
+        # a lock it ignored belongs to another Metashape instance and is kept
+        if self.owns_lock:
+            with contextlib.suppress(OSError):
+                os.remove(lock_file_path(self.project_path))
+        return {"project": self.project_path, "status": "failed", "error": error, "retryable": True,
+                "duration": time.time() - self.start_time, "stats": {}}
+
+
+def run_batch(process_fn, project_paths, workers=1, metrics_dir=None, progress_interval=None, stage_timeout=None,
+              retries=0, retry_backoff=60.0, journal=None, restart=False, memory_budget=None, post_workers=0,
+              post_budget=None, preflight=False, **options):
+    """
+    Process a list of projects with at most `workers` projects running at once.
+
+    With more than one worker, or with a `stage_timeout` in seconds, every project runs in
+    its own freshly spawned process, so Metashape state and memory never leak from one
+    project into the next and a crash only fails that project. A worker whose current
+    stage runs longer than `stage_timeout` is stopped. Failed projects are retried up to
+    `retries` times if the failure looks temporary (worker crashes, timeouts, memory, disk
+    or GPU errors), waiting `retry_backoff` seconds before the first retry and twice as
+    long before every further one; script and data errors are not retried.
+
+    With a `journal` file the outcome of every project is recorded as the batch goes. A
+    restarted batch skips the projects the journal lists as finished, unless `restart`
+    is set, and runs the others again; their stage manifests let them continue after the
+    last completed stage.
+
+    With a `memory_budget` in bytes, a project is only started while the expected peak
+    memory of the running projects and the new one stays within the budget; a project
+    that does not fit waits, and others that fit are started first. The peak memory of
+    a project is its largest chunk's image count times the peak memory per image its
+    pipeline needed in earlier batches (the stage history), or an even share of the
+    budget per worker while the pipeline has no history. A project is always started
+    when nothing else runs, so one above the budget still gets processed.
+
+    With `preflight`, the images of every queued project are checked first (ImageValidation):
+    projects with missing or corrupt images, or without any GPS reference, are rejected
+    before they take a worker, and projects with warnings are flagged in the output.
+
+    With `post_workers`, the post-processing stages of the projects (COG conversion,
+    plot statistics) are deferred to that many background workers, so the next project
+    computes while the exports of the last one are converted. No new project is started
+    while two projects per post worker wait for their post-processing, or while the
+    exports they read take `post_budget` bytes or more. The budget is a soft cap: the
+    exports of a project are only known once it finishes, so the projects running when
+    the budget is reached still hand over theirs, and the pending exports can exceed it
+    by up to `workers` projects. A project counts as finished, in the journal and the
+    summary, once its post-processing is done.
+
+    With `metrics_dir` the stage metrics of all projects are written there as a CSV
+    file and a Prometheus textfile. With `progress_interval` the progress of the running
+    projects and the estimated time left are printed every so many seconds, and the
+    stage durations of the batch are added to the stage history used for the estimates.
+    """
+    project_paths = unique_project_paths(project_paths)
+    print(f"Processing {len(project_paths)} projects with {workers} worker(s).")
+    batch_start = time.time()
+    results = []
+
+    batch_journal = BatchJournal(journal, process_fn, options) if journal else None
+    queue = collections.deque()
+    for project_path in project_paths:
+        entry = batch_journal.finished(project_path) if batch_journal is not None and not restart else None
+        if entry is not None:
+            results.append({"project": project_path, "status": "ok", "error": None, "retryable": False,
+                            "duration": entry["duration"], "stats": {}, "resumed": True})
+        else:
+            queue.append((project_path, 1))
+    if batch_journal is not None and restart:
+        batch_journal.reset()
+    if results:
+        print(f"Resuming: {len(results)} project(s) finished in an earlier run are skipped ({journal}).")
+
+    if preflight and queue:
+        for project_path, report in validate_projects([project_path for project_path, _ in queue]).items():
+            if report["status"] != "rejected":
+                continue
+            queue.remove((project_path, 1))
+            result = {"project": project_path, "status": "rejected", "error": "; ".join(report["errors"]),
+                      "retryable": False, "duration": 0.0, "stats": {}, "attempts": 0}
+            results.append(result)
+            if batch_journal is not None:
+                batch_journal.record(project_path, "rejected", attempts=0, error=result["error"], duration=0.0)
+
+    isolated = workers > 1 or bool(stage_timeout)
+    if post_workers:
+        options = dict(options, defer_post=True)
+    if progress_interval or (isolated and stage_timeout):
+        # Workers report their progress through small status files in a shared folder
+        options = dict(options, progress_dir=tempfile.mkdtemp(prefix="geco_progress_"))
+    pipeline = os.path.splitext(os.path.basename(inspect.getfile(process_fn)))[0]
+    history = StageHistory()
+
+    def finish(result, attempt):
+        """Schedule a retry if the failure allows one, otherwise record the final result."""
+        result["attempts"] = attempt
+        if result["status"] == "failed" and result["retryable"] and attempt <= retries:
+            delay = retry_backoff * 2 ** (attempt - 1)
+            print(f"Attempt {attempt} failed, retrying in {delay:.0f} s: {result['project']}")
+            waiting.append((time.time() + delay, result["project"], attempt + 1))
+            status = "retrying"
+        else:
+            if isolated:
+                print(f"Finished {result['project']} ({result['status']}, {result['duration'] / 60:.1f} min)")
+            if monitor is not None:
+                monitor.project_finished(result)
+            jobs = deferred_jobs(result)
+            if jobs and result["status"] == "ok":
+                # Finished only once its post-processing is; a batch stopped before that runs it again
+                post_queue.submit(result, jobs)
+                status = "post_processing"
+            else:
+                results.append(result)
+                status = result["status"]
+        if batch_journal is not None:
+            batch_journal.record(result["project"], status, attempts=attempt, error=result["error"],
+                                 duration=result["duration"])
+
+    def post_finished(result):
+        results.append(result)
+        if batch_journal is not None:
+            batch_journal.record(result["project"], result["status"], attempts=result["attempts"],
+                                 error=result["error"], duration=result["duration"])
+
+    def post_queue_full():
+        return post_queue is not None and post_queue.full()
+
+    expected_peaks = {}
+    if memory_budget and isolated:
+        for project_path, images in project_images([project_path for project_path, _ in queue]).items():
+            expected_peaks[project_path] = history.expected_peak(pipeline, images) if images else None
+        print(f"Memory budget: {memory_budget / 1024 ** 3:.1f} GB.")
+
+    def expected_peak(project_path):
+        peak = expected_peaks.get(project_path)
+        return peak if peak is not None else memory_budget / workers
+
+    def next_project():
+        """The first queued project that fits in the memory budget next to the running ones."""
+        if not memory_budget or not running:
+            return queue.popleft()
+        in_use = sum(expected_peak(worker.project_path) for worker in running)
+        for item in queue:
+            if in_use + expected_peak(item[0]) <= memory_budget:
+                queue.remove(item)
+                return item
+        return None
+
+    waiting = []
+    running = []
+    context = multiprocessing.get_context("spawn")
+    post_queue = None
+    if post_workers:
+        post_queue = PostProcessingQueue(post_workers, max_bytes=post_budget)
+        print(f"Post-processing in {post_workers} background worker(s)"
+              + (f", holding at most {post_budget / 1024 ** 3:.1f} GB of pending exports." if post_budget else "."))
+    monitor = None
+    try:
+        if progress_interval:
+            monitor = ProgressMonitor(options["progress_dir"], project_paths, pipeline, workers, history,
+                                      interval=progress_interval).__enter__()
+            for result in results:
+                monitor.project_finished(result)
+        while queue or waiting or running or (post_queue is not None and post_queue.pending):
+            if post_queue is not None:
+                for result in post_queue.collect():
+                    post_finished(result)
+            now = time.time()
+            for item in sorted(w for w in waiting if w[0] <= now):
+                waiting.remove(item)
+                queue.append(item[1:])
+
+            if not isolated:
+                if queue and not post_queue_full():
+                    project_path, attempt = queue.popleft()
+                    if batch_journal is not None:
+                        batch_journal.record(project_path, "running", attempts=attempt, error=None, duration=0.0)
+                    finish(run_project(process_fn, project_path, options), attempt)
+                else:
+                    # Wait for the next retry, or for a post-processing to finish and make room
+                    delay = max(min(w[0] for w in waiting) - now, 0.0) if waiting else None
+                    if post_queue is not None and post_queue.pending:
+                        post_queue.wait(delay)
+                    elif waiting:
+                        time.sleep(delay)
+                continue
+
+            while queue and len(running) < workers and not post_queue_full():
+                item = next_project()
+                if item is None:
+                    break
+                project_path, attempt = item
+                if batch_journal is not None:
+                    batch_journal.record(project_path, "running", attempts=attempt, error=None, duration=0.0)
+                running.append(WorkerProcess(context, process_fn, project_path, options, attempt))
+            finished = False
+            for worker in list(running):
+                result = worker.poll(stage_timeout)
+                if result is not None:
+                    running.remove(worker)
+                    finish(result, worker.attempt)
+                    finished = True
+            if finished:
+                # Start the next projects in the places that became free
+                continue
+
+            # Block until a worker sends its result or exits, a post-processing finishes, a retry
+            # is due or the current stage of a worker reaches the stage timeout
+            now = time.time()
+            deadlines = [w[0] for w in waiting]
+            if stage_timeout:
+                deadlines += [worker.stage_deadline(stage_timeout) for worker in running]
+            timeout = max(min(deadlines) - now, 0.0) if deadlines else None
+            handles = [handle for worker in running for handle in worker.wait_objects()]
+            if post_queue is not None and post_queue.pending:
+                handles.append(post_queue.sentinel)
+            if handles:
+                multiprocessing.connection.wait(handles, timeout)
+            elif timeout is not None:
+                time.sleep(timeout)
+    finally:
+        if post_queue is not None:
+            post_queue.close()
+        if monitor is not None:
+            monitor.__exit__(None, None, None)
+        if "progress_dir" in options:
+            shutil.rmtree(options["progress_dir"], ignore_errors=True)
+    if monitor is not None:
+        history.update(pipeline, results)
+        history.save()
+
+    # Keep the summary in list-file order
+    order = {project_path: i for i, project_path in enumerate(project_paths)}
+    results.sort(key=lambda r: order[r["project"]])
+    print_summary(results, time.time() - batch_start)
+    if metrics_dir:
+        write_batch_metrics(results, metrics_dir)
+    return results
+
+
+def print_summary(results, wall_time):
+    """Print one line per project plus the totals of the batch."""
+    print("\n=== Batch summary ===")
+    for result in results:
+        line = (f"[{result['status'].upper():6}] {result['duration'] / 60:7.1f} min"
+                f"  saves: {result['stats'].get('saves', 0):2d} ({result['stats'].get('save_time', 0.0):6.1f} s)"
+                f"  {result['project']}")
+        if result.get("post_duration"):
+            line += f"  post-processing: {result['post_duration'] / 60:.1f} min"
+        if result.get("attempts", 1) > 1:
+            line += f"  attempts: {result['attempts']}"
+        if result.get("resumed"):
+            line += "  (finished in an earlier run)"
+        if result["error"]:
+            line += f"  -> {result['error']}"
+        print(line)
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    busy_time = sum(r["duration"] for r in results)
+    save_time = sum(r["stats"].get("save_time", 0.0) for r in results)
+    print(", ".join(f"{status}: {count}" for status, count in sorted(counts.items())))
+    print(f"Wall time: {wall_time / 60:.1f} min, summed project time: {busy_time / 60:.1f} min, "
+          f"time spent in saves: {save_time / 60:.1f} min")
+
+
+def exit_code(results):
+    """Non-zero exit status if any project did not finish successfully."""
+    return 0 if all(r["status"] == "ok" for r in results) else 1
+
+
+def add_batch_arguments(parser):
+    """Command line options shared by all project-list entry points."""
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of projects processed at the same time (default: 1).')
+    parser.add_argument('--ignore-lock', action='store_true',
+                        help='Open projects even if another Metashape instance holds their lock.')
+    parser.add_argument('--stale-lock-hours', type=float, default=None,
+                        help='Treat project locks older than this many hours as stale and break them.')
+    parser.add_argument('--save-after', type=str, default=None,
+                        help="Comma separated stages after which the project is saved, or 'all'/'none' "
+                             "(default: the expensive stages; the project is always saved at the end).")
+    parser.add_argument('--progress-interval', type=float, default=60.0,
+                        help='Print the progress and estimated time left every this many seconds, 0 to disable (default: 60).')
+    parser.add_argument('--metrics-dir', type=str, default=None,
+                        help='Write the stage metrics of the batch to this folder as CSV and Prometheus textfile.')
+    parser.add_argument('--measure-writes', action='store_true',
+                        help='Also record the bytes each stage writes to the project and exports folders; this walks '
+                             'both folders before and after every stage, which is slow on network storage.')
+    parser.add_argument('--stage-timeout', type=float, default=None,
+                        help='Stop a project whose current stage runs longer than this many minutes (default: no limit).')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Retry projects that failed for a temporary reason up to this many times (default: 2).')
+    parser.add_argument('--retry-backoff', type=float, default=60.0,
+                        help='Seconds to wait before the first retry; doubled for every further one (default: 60).')
+    parser.add_argument('--journal', type=str, default=None,
+                        help='Batch journal used to resume an interrupted batch (default: <project list>.journal.json).')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the journal and process all projects again.')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='With several workers, only start a project while the expected peak memory of the '
+                             'running projects stays within this many GB (default: no limit).')
+    parser.add_argument('--preflight', action='store_true',
+                        help='Check the images of every project before processing it; projects with missing or corrupt '
+                             'images or without GPS reference are rejected, others with warnings are flagged.')
+    parser.add_argument('--post-workers', type=int, default=0,
+                        help='Run the post-processing of the exports (COGs, plot statistics) in this many background '
+                             'workers while the next project computes (default: 0, within the project).')
+    parser.add_argument('--post-budget', type=float, default=None,
+                        help='Start no new project while the exports waiting for post-processing take this many GB '
+                             'or more. A soft cap: projects already running still hand over their exports '
+                             '(default: no limit beyond two waiting projects per post worker).')
+
+
+def batch_options(args):
+    """Extract the options for run_batch from parsed command line arguments."""
+    list_path = getattr(args, "project_paths", None)
+    return {"ignore_lock": args.ignore_lock, "stale_lock_hours": args.stale_lock_hours,
+            "save_after": args.save_after, "metrics_dir": args.metrics_dir, "measure_writes": args.measure_writes,
+            "progress_interval": args.progress_interval,
+            "stage_timeout": args.stage_timeout * 60 if args.stage_timeout else None,
+            "retries": args.retries, "retry_backoff": args.retry_backoff,
+            "journal": args.journal or (journal_path(list_path) if list_path else None), "restart": args.restart,
+            "memory_budget": args.memory_budget * 1024 ** 3 if args.memory_budget else None,
+            "preflight": args.preflight, "post_workers": args.post_workers,
+            "post_budget": args.post_budget * 1024 ** 3 if args.post_budget else None}
@@ -0,0 +1,60 @@
+from StageManifest import migrate_manifest
+
+
+def parse_chunks(value):
+    """Parse the --chunks option: a comma separated list of chunk labels or keys, or 'active'."""
+    if not value:
+        return None
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def is_active(doc, chunk):
+    return doc.chunk is not None and chunk.key == doc.chunk.key
+
+
+def select_chunks(doc, selection=None):
+    """
+    The chunks of a document to process: every enabled chunk, or the chunks named in
+    `selection` by label or key ('active' for the active chunk), in document order.
+    """
+    if not selection:
+        return [chunk for chunk in doc.chunks if chunk.enabled]
+    chosen = []
+    for item in selection:
+        if item == "active":
+            matches = [chunk for chunk in doc.chunks if is_active(doc, chunk)]
+        else:
+            matches = [chunk for chunk in doc.chunks if chunk.label == item or str(chunk.key) == item]
+        if not matches:
+            raise ValueError(f"No chunk '{item}' in {doc.path}")
+        chosen.extend(chunk for chunk in matches if chunk.key not in {c.key for c in chosen})
+    return [chunk for chunk in doc.chunks if chunk.key in {c.key for c in chosen}]
+
+
+def manifest_key(doc, chunk):
+    """
+    Key of the chunk's stage manifest: the chunk key, which stays with the chunk when another
+    chunk is made the active one. The manifest written when only the active chunk was processed
+    is first moved to the active chunk, so existing projects are not reprocessed.
+    """
+    if doc.chunk is not None:
+        migrate_manifest(doc.path, doc.chunk.key)
+    return chunk.key
+
+
+def unique_label(label, key, labels):
+    """A chunk label made unique with the chunk key if `labels`, those of all chunks of the document, repeat it."""
+    if sum(1 for other in labels if other == label) > 1:
+        return f"{label}_{key}"
+    return label
+
+
+def export_label(doc, chunk):
+    """Prefix of the chunk's exports: its label, made unique with the chunk key if another chunk has the same label."""
+    return unique_label(chunk.label, chunk.key, [other.label for other in doc.chunks])
+
+
+def add_chunk_arguments(parser):
+    parser.add_argument('--chunks', type=str, default=None,
+                        help="Comma separated labels or keys of the chunks to process, or 'active' "
+                             "(default: every enabled chunk of each project).")
@@ -1,40 +1,218 @@
-import Metashape
 import os
+import re
+import sys
+import time
 import argparse
-import tqdm
+
+import BatchScheduler
+import ChunkSelection
+from ProjectSession import ProjectSession
+from StageManifest import StageManifest, migrate_manifest
+from ProjectInspector import InspectorCache, DEFAULT_CACHE_PATH, inspect_projects, directory_size, files_dir, format_size
+from ProjectIndex import lacks_export
+
+# Artifacts that can be removed from a project once its products are built
+ARTIFACTS = ("orthophotos", "depth_maps", "key_points", "intermediate_dems")
+# Stages whose product is a DEM of the chunk
+DEM_STAGES = ("dem", "dtm")
 
 def process_multiple_projects_from_file(filepath):
    print(f"Reading project paths from file: {filepath}")
-   with open(filepath, 'r') as file:
-      project_paths = [line.strip() for line in file.readlines()]
+   project_paths = BatchScheduler.read_project_list(filepath)
    print(f"Found {len(project_paths)} project paths.")
    return project_paths
 
-def clear_storage_space(project_path):
+def size_of_files_matching(directory, patterns):
+   """Size of the files below `directory` whose name contains one of the patterns."""
+   total = 0
+   for root, dirs, files in os.walk(directory):
+      for name in files:
+         if any(pattern in name.lower() for pattern in patterns):
+            try:
+               total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+               pass
+   return total
+
+def chunk_manifest(project_path, chunk_info):
+   """Stage manifest of a chunk as reported by the inspector."""
+   if chunk_info.get("active", True):
+      migrate_manifest(project_path, chunk_info.get("key"))
+   return StageManifest(project_path, chunk_info.get("key"))
+
+def referenced_elevations(manifest):
+   """
+   Keys of the DEMs built by a stage of the manifest, which the exports are made from.
+   None if a DEM stage did not record which DEM it built, then no DEM can be told apart.
+   """
+   keys = set()
+   for name in DEM_STAGES:
+      entry = manifest.stages.get(name)
+      if entry is not None:
+         if "product" not in entry:
+            return None
+         keys.add(entry["product"])
+   return keys
+
+def depth_maps_clearable(manifest):
+   """Depth maps are only needed to rebuild the point cloud, so they can go once both are recorded as complete."""
+   return "depth_maps" in manifest.stages and "point_cloud" in manifest.stages
+
+def measure_reclaimable(info):
+   """
+   Estimate the bytes each artifact type occupies in a project, from the project files alone.
+
+   Depth maps and DEMs are measured exactly from their folders; orthophotos and key points
+   share a folder with data that is kept, so they are estimated from the file names. Depth
+   maps and DEMs that remove_artifacts keeps are not counted.
+   """
+   sizes = dict.fromkeys(ARTIFACTS, 0)
+   for chunk in info["chunks"]:
+      manifest = chunk_manifest(info["project"], chunk)
+      product_dirs = chunk.get("product_dirs", {})
+      if depth_maps_clearable(manifest):
+         sizes["depth_maps"] += chunk["product_sizes"].get("depth_maps", 0)
+      sizes["orthophotos"] += sum(size_of_files_matching(d, ("orthophoto",)) for d in product_dirs.get("orthomosaic", []))
+      sizes["key_points"] += sum(size_of_files_matching(d, ("keypoint", ".kp")) for d in product_dirs.get("tie_points", []))
+      referenced = referenced_elevations(manifest)
+      if referenced is not None:
+         sizes["intermediate_dems"] += sum(directory_size(dem["dir"]) for dem in chunk.get("dems", [])
+                                           if not dem["active"] and dem.get("key") not in referenced)
+   return sizes
+
+def flight_age_days(project_path):
+   """Age of the flight from the YYYYMMDD prefix of the project name, or from the file date."""
+   match = re.match(r"(\d{8})", os.path.basename(project_path))
+   if match:
+      try:
+         flight_time = time.mktime(time.strptime(match.group(1), "%Y%m%d"))
+         return (time.time() - flight_time) / 86400
+      except ValueError:
+         pass
+   return (time.time() - os.path.getmtime(project_path)) / 86400
+
+def retention_reason(info, older_than_days=None, require_exports=False):
+   """Apply the retention policy; returns the reason a project is kept as is, or None if it may be cleared."""
+   project_path = info["project"]
+   if older_than_days is not None and flight_age_days(project_path) < older_than_days:
+      return f"flight younger than {older_than_days} days"
+   if require_exports:
+      export_dir = os.path.join(os.path.dirname(project_path), "exports")
+      exports = os.listdir(export_dir) if os.path.isdir(export_dir) else []
+      missing = [product for product in ("dem", "ortho") if lacks_export(info, exports, product)]
+      if missing:
+         return f"missing exports: {', '.join(missing)}"
+   return None
+
+def remove_artifacts(chunk, artifacts, manifest):
+   """
+   Remove the selected artifacts from one chunk, returns True if anything was removed.
+
+   Removed depth maps are recorded in the chunk's stage manifest, so the point cloud and the
+   products built from it are not rebuilt for want of them. DEMs are only removed if they
+   are neither the active one nor built by a stage of the manifest, whose exports they are.
+   """
+   removed = False
+   if "orthophotos" in artifacts and chunk.orthomosaic is not None:
+      print(f'Removing orthoPhotos for chunk: {chunk.label}')
+      chunk.orthomosaic.removeOrthophotos()
+      removed = True
+   if "depth_maps" in artifacts and chunk.depth_maps is not None:
+      if depth_maps_clearable(manifest) and chunk.point_cloud is not None:
+         print(f'Removing depth maps for chunk: {chunk.label}')
+         chunk.remove(chunk.depth_maps)
+         manifest.clear("depth_maps")
+         removed = True
+      else:
+         print(f'Keeping depth maps for chunk: {chunk.label} (point cloud not recorded as complete in the stage manifest)')
+   if "key_points" in artifacts:
+      # Metashape 2.x keeps key points with the tie points, 1.x with the sparse point cloud
+      tie_points = chunk.tie_points if hasattr(chunk, "tie_points") else chunk.point_cloud
+      if tie_points is not None:
+         print(f'Removing key points for chunk: {chunk.label}')
+         tie_points.removeKeypoints()
+         removed = True
+   if "intermediate_dems" in artifacts and chunk.elevation is not None:
+      referenced = referenced_elevations(manifest)
+      if referenced is None:
+         print(f'Keeping all DEMs for chunk: {chunk.label} (the stage manifest does not record which DEMs were exported)')
+      else:
+         for elevation in list(chunk.elevations):
+            if elevation.key != chunk.elevation.key and elevation.key not in referenced:
+               print(f'Removing DEM {elevation.label or elevation.key} for chunk: {chunk.label}')
+               chunk.remove(elevation)
+               removed = True
+   return removed
+
+def reclaim_project(project_path, artifacts=("orthophotos",), **session_options):
+   """Remove artifacts from a project and measure the bytes actually freed on disk."""
+   size_before = directory_size(files_dir(project_path))
+   session = ProjectSession(project_path, **session_options)
+   for chunk in session.doc.chunks:
+      manifest = StageManifest(project_path, ChunkSelection.manifest_key(session.doc, chunk))
+      if remove_artifacts(chunk, artifacts, manifest):
+         # The manifest is written after the document, like in the processing scripts
+         session.on_save(manifest.save)
+         session.changed("clear_storage")
+   session.close()
+   stats = dict(session.stats)
+   stats["freed"] = size_before - directory_size(files_dir(project_path))
+   print(f"Freed {format_size(stats['freed'])} in project: {project_path}")
+   return stats
+
+def clear_storage_space(project_path, **session_options):
    print(f"Opening project: {project_path}")
-   doc = Metashape.Document()
-   doc.open(project_path, ignore_lock=True)
-   for chunk in doc.chunks:
-      if chunk.orthomosaic is not None:
-         print(f'Removing orthoPhotos for chunk: {chunk.label}')
-         chunk.orthomosaic.removeOrthophotos()
-   doc.save()
+   reclaim_project(project_path, artifacts=("orthophotos",), **session_options)
    print(f"Storage space cleared for project: {project_path}")
 
+def print_plan(plan, artifacts):
+   print("\n=== Reclaimable space ===")
+   print(f"{'project':60} " + " ".join(f"{artifact:>18}" for artifact in artifacts))
+   for info, sizes, skip_reason in plan:
+      line = f"{os.path.basename(info['project'])[:60]:60} " + " ".join(f"{format_size(sizes[a]):>18}" for a in artifacts)
+      if skip_reason:
+         line += f"  (kept: {skip_reason})"
+      print(line)
+   selected = [sizes for info, sizes, skip_reason in plan if skip_reason is None]
+   total = sum(sizes[a] for sizes in selected for a in artifacts)
+   print(f"{len(selected)} of {len(plan)} projects selected, estimated reclaimable: {format_size(total)}")
+
 def main():
    parser = argparse.ArgumentParser(description="Clear storage space of Metashape projects.")
    parser.add_argument('project_paths', type=str, help='Path to the text file containing Metashape project paths.')
+   parser.add_argument('--artifacts', type=str, default="orthophotos",
+                       help=f"Comma separated artifacts to remove: {', '.join(ARTIFACTS)} or 'all' (default: orthophotos).")
+   parser.add_argument('--older-than-days', type=float, default=None,
+                       help='Only clear flights older than this many days.')
+   parser.add_argument('--require-exports', action='store_true',
+                       help='Only clear projects whose DEM and orthomosaic have been exported.')
+   parser.add_argument('--dry-run', action='store_true',
+                       help='Only report the reclaimable space, without opening or changing any project.')
+   parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_PATH, help='Path of the project inspection cache.')
+   BatchScheduler.add_batch_arguments(parser)
    args = parser.parse_args()
 
+   artifacts = ARTIFACTS if args.artifacts == "all" else tuple(a.strip() for a in args.artifacts.split(","))
+   unknown = [a for a in artifacts if a not in ARTIFACTS]
+   if unknown:
+      parser.error(f"Unknown artifacts: {', '.join(unknown)}")
+
    print("Starting the storage clearing process.")
    project_paths = process_multiple_projects_from_file(args.project_paths)
-   for project_path in project_paths:
-      clear_storage_space(project_path)
-   print("Storage clearing process completed.")
-   for project_path in tqdm.tqdm(project_paths, desc="Clearing storage space"):
-      clear_storage_space(project_path)
+   plan = []
+   for info in inspect_projects(project_paths, InspectorCache(args.cache)):
+      skip_reason = info["error"] or retention_reason(info, args.older_than_days, args.require_exports)
+      plan.append((info, measure_reclaimable(info), skip_reason))
+   print_plan(plan, artifacts)
+   if args.dry_run:
+      return
+
+   selected = [info["project"] for info, sizes, skip_reason in plan if skip_reason is None]
+   results = BatchScheduler.run_batch(reclaim_project, selected, workers=args.workers, artifacts=artifacts,
+                                      **BatchScheduler.batch_options(args))
+   freed = sum(result["stats"].get("freed", 0) for result in results)
+   print(f"Storage clearing process completed, freed {format_size(freed)}.")
+   sys.exit(BatchScheduler.exit_code(results))
 
 if __name__ == "__main__":
    main()
-
-
@@ -0,0 +1,314 @@
+"""
+Cloud-Optimized GeoTIFF copies of the exports, without Metashape.
+
+The overviews are computed here rather than by GDAL: every level is downsampled from
+the level above it in 2 x 2 blocks by a pool of worker processes, averaging only the
+valid pixels of each band. Elevation keeps its no-data holes instead of smearing the
+no-data value into the terrain, and reflectance bands are averaged band by band. The
+levels are declared as the overviews of a VRT that the GDAL COG driver copies as they
+are, so neither the levels nor the COG are ever held in memory as a whole.
+"""
+import os
+import json
+import math
+import shutil
+import argparse
+import tempfile
+from xml.etree import ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    import numpy as np
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import ColorInterp
+    from rasterio.windows import Window
+except ImportError:
+    np = rasterio = None
+
+import ExportCache
+from StageManifest import digest
+
+# Block size of the COG, also the size below which no further overview level is built
+COG_BLOCKSIZE = 512
+DEFAULT_COMPRESSION = "LZW"
+COMPRESSIONS = ("LZW", "DEFLATE", "ZSTD")
+# TIFF predictor numbers as named by the COG driver; without one the driver picks it from the data type
+PREDICTORS = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}
+
+# Datasets opened once per worker process, by path
+_datasets = {}
+
+
+def overview_sizes(width, height, blocksize=COG_BLOCKSIZE):
+    """Sizes of the overview levels, each half the one above, until the level fits in one block."""
+    sizes = []
+    while width > blocksize or height > blocksize:
+        width, height = math.ceil(width / 2), math.ceil(height / 2)
+        sizes.append((width, height))
+    return sizes
+
+
+def downsample_block(block, valid, alpha_bands=()):
+    """
+    Halve a (bands, rows, cols) block by averaging 2 x 2 pixels over the valid ones.
+
+    `valid` is a (bands, rows, cols) boolean array; a pixel of a band is only averaged
+    where it is valid, and the output is invalid where none of the four pixels is.
+    Alpha bands take the largest of the four values instead. Returns the halved block as
+    float64 and its validity per band.
+    """
+    bands, rows, cols = block.shape
+    if rows % 2 or cols % 2:
+        padding = ((0, 0), (0, rows % 2), (0, cols % 2))
+        block = np.pad(block, padding, mode="edge")
+        valid = np.pad(valid, padding, constant_values=False)
+        rows, cols = rows + rows % 2, cols + cols % 2
+    shape = (bands, rows // 2, 2, cols // 2, 2)
+    values = np.where(valid, block, 0).astype(np.float64).reshape(shape)
+    weights = valid.reshape(shape)
+    count = weights.sum(axis=(2, 4))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = values.sum(axis=(2, 4)) / count
+    for band in alpha_bands:
+        out[band] = values[band].max(axis=(1, 3))
+    return out, count > 0
+
+
+def alpha_bands(dataset):
+    return [i for i, interp in enumerate(dataset.colorinterp) if interp == ColorInterp.alpha]
+
+
+def band_validity(dataset, block, window):
+    """Valid pixels of a block per band: inside the dataset mask and the alpha band, not no-data and finite."""
+    valid = np.broadcast_to(dataset.dataset_mask(window=window) > 0, block.shape).copy()
+    # GDAL only takes the alpha band as mask for gray or RGB images, not for the multispectral bands
+    for band in alpha_bands(dataset):
+        valid &= block[band] > 0
+    for i, nodata in enumerate(dataset.nodatavals):
+        if nodata is not None:
+            valid[i] &= block[i] != nodata
+    if np.issubdtype(block.dtype, np.floating):
+        valid &= np.isfinite(block)
+    return valid
+
+
+def _dataset(path):
+    if path not in _datasets:
+        _datasets[path] = rasterio.open(path)
+    return _datasets[path]
+
+
+def _downsample_window(source_path, window):
+    """Compute one window of the next overview level from the level in `source_path`."""
+    src = _dataset(source_path)
+    source_window = Window(window.col_off * 2, window.row_off * 2,
+                           min(window.width * 2, src.width - window.col_off * 2),
+                           min(window.height * 2, src.height - window.row_off * 2))
+    block = src.read(window=source_window)
+    valid = band_validity(src, block, source_window)
+    out, out_valid = downsample_block(block, valid, alpha_bands(src))
+    out = out[:, :window.height, :window.width]
+    out_valid = out_valid[:, :window.height, :window.width]
+
+    dtype = np.dtype(src.dtypes[0])
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        out = np.clip(np.rint(np.nan_to_num(out)), info.min, info.max)
+    for i, nodata in enumerate(src.nodatavals):
+        if nodata is not None:
+            out[i][~out_valid[i]] = nodata
+    return window, out.astype(dtype)
+
+
+def iter_windows(width, height, tile_size):
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+
+def build_level(executor, workers, source_path, level_path, size, tile_size):
+    """Write one overview level, downsampled from `source_path` in windows by the worker pool."""
+    width, height = size
+    with rasterio.open(source_path) as src:
+        profile = src.profile.copy()
+        transform = src.transform * src.transform.scale(src.width / width, src.height / height)
+        colorinterp = src.colorinterp
+    profile.update(driver="GTiff", width=width, height=height, transform=transform, tiled=True,
+                   blockxsize=COG_BLOCKSIZE, blockysize=COG_BLOCKSIZE, compress="lzw", BIGTIFF="IF_SAFER")
+    windows = iter_windows(width, height, tile_size)
+    with rasterio.open(level_path, "w", **profile) as dst:
+        dst.colorinterp = colorinterp
+        # At most two windows per worker are in flight, so memory does not grow with the raster
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers:
+                window = next(windows, None)
+                if window is None:
+                    break
+                pending.add(executor.submit(_downsample_window, source_path, window))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window, block = future.result()
+                dst.write(block, window=window)
+
+
+def write_vrt(source_path, level_paths, vrt_path):
+    """A VRT of the source whose overviews are the computed levels."""
+    with rasterio.open(source_path) as src:
+        root = ET.Element("VRTDataset", rasterXSize=str(src.width), rasterYSize=str(src.height))
+        if src.crs is not None:
+            ET.SubElement(root, "SRS").text = src.crs.to_wkt()
+        ET.SubElement(root, "GeoTransform").text = ", ".join(repr(value) for value in src.transform.to_gdal())
+        gdal_types = {"uint8": "Byte", "uint16": "UInt16", "int16": "Int16", "uint32": "UInt32", "int32": "Int32",
+                      "float32": "Float32", "float64": "Float64"}
+        for band in range(1, src.count + 1):
+            element = ET.SubElement(root, "VRTRasterBand", dataType=gdal_types[src.dtypes[band - 1]], band=str(band))
+            if src.nodatavals[band - 1] is not None:
+                ET.SubElement(element, "NoDataValue").text = repr(src.nodatavals[band - 1])
+            ET.SubElement(element, "ColorInterp").text = src.colorinterp[band - 1].name.capitalize()
+            source = ET.SubElement(element, "SimpleSource")
+            ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = os.path.abspath(source_path)
+            ET.SubElement(source, "SourceBand").text = str(band)
+            for level_path in level_paths:
+                overview = ET.SubElement(element, "Overview")
+                ET.SubElement(overview, "SourceFilename", relativeToVRT="0").text = os.path.abspath(level_path)
+                ET.SubElement(overview, "SourceBand").text = str(band)
+    ET.ElementTree(root).write(vrt_path)
+
+
+def build_cog(source_path, output_path, workers=None, compression=DEFAULT_COMPRESSION, predictor=None,
+              blocksize=COG_BLOCKSIZE, tile_size=1024):
+    """
+    Write a Cloud-Optimized GeoTIFF of a raster export with overviews computed by a pool of workers.
+
+    The overview levels are kept in a temporary folder next to the output, which is
+    removed afterwards; they take about a third of the size of the source.
+    """
+    if rasterio is None:
+        raise ImportError("The COG conversion needs numpy and rasterio.")
+    workers = workers or os.cpu_count()
+    with rasterio.open(source_path) as src:
+        sizes = overview_sizes(src.width, src.height, blocksize)
+
+    work_dir = tempfile.mkdtemp(prefix="cog_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        level_paths = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            previous = source_path
+            for i, size in enumerate(sizes):
+                level_path = os.path.join(work_dir, f"level{i + 1}.tif")
+                build_level(executor, workers, previous, level_path, size, tile_size)
+                level_paths.append(level_path)
+                previous = level_path
+        vrt_path = os.path.join(work_dir, "source.vrt")
+        write_vrt(source_path, level_paths, vrt_path)
+        rasterio.shutil.copy(vrt_path, output_path, driver="COG", BLOCKSIZE=blocksize, COMPRESS=compression,
+                             PREDICTOR=PREDICTORS.get(predictor, "YES"), OVERVIEWS="FORCE_USE_EXISTING",
+                             BIGTIFF="IF_SAFER", NUM_THREADS="ALL_CPUS")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def cog_path(path):
+    """COGs are written to a cog folder next to the export, under the same name."""
+    return os.path.join(os.path.dirname(path), "cog", os.path.basename(path))
+
+
+def product_type(band_count):
+    """Exports are told apart by their bands: elevation (DEM, DTM) has one, orthomosaics have several."""
+    return "elevation" if band_count == 1 else "orthomosaic"
+
+
+def load_profile(path):
+    """The settings per product chosen by CompressionTuner."""
+    with open(path, 'r') as file:
+        return json.load(file)["products"]
+
+
+def cog_options(path, compression=DEFAULT_COMPRESSION, profile=None):
+    """Compression, predictor and block size of the COG of an export, from the profile if it covers the product."""
+    options = {"compression": compression, "predictor": None, "blocksize": COG_BLOCKSIZE}
+    if profile:
+        with rasterio.open(path) as src:
+            product = product_type(src.count)
+        if product in profile:
+            chosen = profile[product]
+            options = {"compression": chosen["compress"], "predictor": chosen["predictor"], "blocksize": chosen["blocksize"]}
+    return options
+
+
+def cog_fingerprint(path, options):
+    """The fingerprint of the export the COG is made from, or its size and time if it has none."""
+    source = ExportCache.recorded_fingerprint(path)
+    if source is None:
+        stat = os.stat(path)
+        source = [stat.st_size, stat.st_mtime]
+    return digest({"source": source, **options})
+
+
+def convert_exports(paths, workers=None, compression=DEFAULT_COMPRESSION, profile=None):
+    """
+    Convert the given exports that exist to COGs in exports/cog, unless their COG is up to date.
+
+    With a `profile` from CompressionTuner, each product gets the settings chosen for it;
+    products the profile does not cover get `compression`.
+    """
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        output_path = cog_path(path)
+        options = cog_options(path, compression, profile)
+        fingerprint = cog_fingerprint(path, options)
+        if ExportCache.up_to_date(output_path, fingerprint):
+            print(f"COG {output_path} is up to date. Skipping.")
+            continue
+        print(f"Converting {path} to a Cloud-Optimized GeoTIFF...")
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with ExportCache.atomic_export(output_path, fingerprint) as tmp_path:
+            build_cog(path, tmp_path, workers=workers, **options)
+
+
+def add_cog_arguments(parser):
+    """Command line options of the processing scripts for the COG post-export stage."""
+    parser.add_argument('--cog', action='store_true',
+                        help='Also write Cloud-Optimized GeoTIFF copies of the DEM, DTM and orthomosaic exports '
+                             'to exports/cog (needs numpy and rasterio).')
+    parser.add_argument('--cog-workers', type=int, default=None,
+                        help='Worker processes computing the COG overviews (default: all cores).')
+    parser.add_argument('--cog-compression', choices=COMPRESSIONS, default=DEFAULT_COMPRESSION,
+                        help=f'Compression of the COGs (default: {DEFAULT_COMPRESSION}).')
+    parser.add_argument('--cog-profile', type=str, default=None,
+                        help='Compression profile written by CompressionTuner.py, with the compression, predictor '
+                             'and block size per product; overrides --cog-compression for the products it covers.')
+
+
+def cog_settings(args):
+    """Settings of the COG post-export stage from the command line, or None to skip it."""
+    if not args.cog:
+        return None
+    if rasterio is None:
+        # Fail before the projects are processed rather than after
+        raise ImportError("The COG conversion needs numpy and rasterio.")
+    return {"workers": args.cog_workers, "compression": args.cog_compression,
+            "profile": load_profile(args.cog_profile) if args.cog_profile else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert raster exports to Cloud-Optimized GeoTIFFs in exports/cog.")
+    parser.add_argument('exports', type=str, nargs='+', help='DEM, DTM or orthomosaic GeoTIFFs exported by Metashape.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: all cores).')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=DEFAULT_COMPRESSION,
+                        help=f'Compression of the COGs (default: {DEFAULT_COMPRESSION}).')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Compression profile written by CompressionTuner.py, used for the products it covers.')
+    args = parser.parse_args()
+
+    convert_exports(args.exports, workers=args.workers, compression=args.compression,
+                    profile=load_profile(args.profile) if args.profile else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Benchmark the GeoTIFF compression, predictor and tile size per export product and pick the best.
+
+A window from the centre of each product type (elevation, orthomosaic) is written with every
+candidate setting, read back and measured. Each setting is scored by the time a megabyte of
+raw data costs from export to use: the write, the transfer of the compressed file at the given
+network bandwidth and the read. The report lists every candidate; the profile keeps the best
+setting per product and is read by CogConversion (--cog-profile).
+"""
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from CogConversion import product_type
+
+CODECS = ("LZW", "DEFLATE", "ZSTD")
+TILE_SIZES = (256, 512, 1024)
+DEFAULT_SAMPLE_SIZE = 2048
+DEFAULT_BANDWIDTH_MB = 100  # MB/s of the link the exports are copied over
+REPEATS = 3
+# Codecs Metashape can write itself (ImageCompression.TiffCompressionLZW / TiffCompressionDeflate)
+METASHAPE_CODECS = ("LZW", "DEFLATE")
+
+
+def candidates(dtype):
+    """Each codec without and with the predictor of the data type, at each tile size."""
+    predictor = 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+    return [dict(compress=codec, predictor=pred, blocksize=size)
+            for codec in CODECS for pred in (1, predictor) for size in TILE_SIZES]
+
+
+def sample_window(width, height, size=DEFAULT_SAMPLE_SIZE):
+    """A window of at most size x size pixels from the centre of the raster."""
+    cols, rows = min(size, width), min(size, height)
+    return Window((width - cols) // 2, (height - rows) // 2, cols, rows)
+
+
+def read_sample(path, size=DEFAULT_SAMPLE_SIZE):
+    """The centre window of an export and the profile to write it with."""
+    with rasterio.open(path) as src:
+        window = sample_window(src.width, src.height, size)
+        data = src.read(window=window)
+        profile = dict(driver="GTiff", width=int(window.width), height=int(window.height), count=src.count,
+                       dtype=src.dtypes[0], nodata=src.nodata, crs=src.crs, transform=src.window_transform(window))
+    return data, profile
+
+
+def benchmark(data, profile, setting, work_dir):
+    """Write the sample with one setting and read it back; the fastest of REPEATS runs is kept."""
+    path = os.path.join(work_dir, "sample.tif")
+    options = dict(profile, compress=setting["compress"], predictor=setting["predictor"], tiled=True,
+                   blockxsize=setting["blocksize"], blockysize=setting["blocksize"], bigtiff="IF_SAFER")
+    write_time = read_time = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        with rasterio.open(path, "w", **options) as dst:
+            dst.write(data)
+        write_time = min(write_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        with rasterio.open(path) as src:
+            src.read()
+        read_time = min(read_time, time.perf_counter() - start)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return write_time, read_time, size
+
+
+def score(raw_mb, write_time, read_time, size, bandwidth_mb):
+    """Seconds per raw MB to write, copy at bandwidth_mb MB/s and read a product; lower is better."""
+    return (write_time + read_time + size / 1e6 / bandwidth_mb) / raw_mb
+
+
+def tune(paths, output_dir, sample_size=DEFAULT_SAMPLE_SIZE, bandwidth_mb=DEFAULT_BANDWIDTH_MB):
+    """
+    Benchmark the candidates on the first export of each product type and write
+    compression_report.csv and compression_profile.json to output_dir.
+    """
+    samples = {}
+    for path in paths:
+        with rasterio.open(path) as src:
+            product = product_type(src.count)
+        samples.setdefault(product, path)
+    if not samples:
+        raise ValueError("No exports to benchmark.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="tuner_", dir=output_dir)
+    rows = []
+    products = {}
+    try:
+        for product, path in samples.items():
+            data, profile = read_sample(path, sample_size)
+            raw_mb = data.nbytes / 1e6
+            print(f"Benchmarking {product} on a {profile['width']} x {profile['height']} window of {path}...")
+            results = []
+            for setting in candidates(data.dtype):
+                if setting["blocksize"] > max(profile["width"], profile["height"]) and setting["blocksize"] != TILE_SIZES[0]:
+                    continue  # Larger tiles than the sample measure nothing new
+                write_time, read_time, size = benchmark(data, profile, setting, work_dir)
+                results.append(dict(product=product, source=path, **setting,
+                                    write_mb_s=round(raw_mb / write_time, 1), read_mb_s=round(raw_mb / read_time, 1),
+                                    ratio=round(data.nbytes / size, 3),
+                                    score=round(score(raw_mb, write_time, read_time, size, bandwidth_mb), 5)))
+            results.sort(key=lambda result: result["score"])
+            rows.extend(results)
+            best = results[0]
+            metashape = next(result for result in results if result["compress"] in METASHAPE_CODECS)
+            products[product] = dict({key: best[key] for key in ("compress", "predictor", "blocksize")},
+                                     source=path, score=best["score"], ratio=best["ratio"],
+                                     metashape={key: metashape[key] for key in ("compress", "predictor", "blocksize")})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report_path = os.path.join(output_dir, "compression_report.csv")
+    with open(report_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    profile_path = os.path.join(output_dir, "compression_profile.json")
+    with open(profile_path, 'w') as file:
+        json.dump({"bandwidth_mb_s": bandwidth_mb, "sample_size": sample_size, "products": products}, file, indent=2)
+
+    print(f"{'product':<12} {'codec':<8} {'pred':>4} {'tile':>5} {'write MB/s':>10} {'read MB/s':>10} {'ratio':>6} {'score':>8}")
+    for row in rows:
+        print(f"{row['product']:<12} {row['compress']:<8} {row['predictor']:>4} {row['blocksize']:>5} "
+              f"{row['write_mb_s']:>10} {row['read_mb_s']:>10} {row['ratio']:>6} {row['score']:>8}")
+    for product, chosen in products.items():
+        print(f"Best for {product}: {chosen['compress']}, predictor {chosen['predictor']}, "
+              f"{chosen['blocksize']} px tiles (ratio {chosen['ratio']}).")
+    print(f"Report written to {report_path}, profile to {profile_path}.")
+    return products
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compression, predictor and tile size per export product and write a compression profile.")
+    parser.add_argument('exports', nargs='+', help='GeoTIFF exports to sample, e.g. a DEM and an orthomosaic of a recent flight.')
+    parser.add_argument('--output-dir', type=str, default='.', help='Folder of compression_report.csv and compression_profile.json.')
+    parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE,
+                        help=f'Edge length in pixels of the window sampled from each product (default: {DEFAULT_SAMPLE_SIZE}).')
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH_MB,
+                        help=f'Network bandwidth in MB/s the exports are copied over (default: {DEFAULT_BANDWIDTH_MB}).')
+    args = parser.parse_args()
+
+    tune(args.exports, args.output_dir, sample_size=args.sample_size, bandwidth_mb=args.bandwidth)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,60 @@
 import os
-import Metashape
 import argparse
 
+from ProjectInspector import has_product
+from ProjectIndex import DEFAULT_DB_PATH, connect, scan, query, project_info
 
-def find_metashape_projects(directory, extension=".psx"):
+
+def find_metashape_projects(directory, db_path=DEFAULT_DB_PATH, workers=16):
+    """Find all projects below `directory`, re-listing only directories that changed since the last search."""
     print(f"Searching for Metashape projects in directory: {directory}")
-    metashape_projects = []
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith(extension):
-                project_path = os.path.join(root, file)
-                print(f"Found Metashape project: {project_path}")
-                metashape_projects.append(project_path)
-    return metashape_projects
+    connection = connect(db_path)
+    projects = scan(directory, connection, workers=workers)
+    connection.close()
+    return projects
 
-if __name__ == "__main__":
+
+def has_orthomosaic(project_path, db_path=DEFAULT_DB_PATH):
+    """Check the project index for an orthomosaic; the project files are only read if it was saved since."""
+    connection = connect(db_path)
+    info = project_info(connection, project_path)
+    connection.close()
+    return has_product(info, "orthomosaic")
+
+
+def write_projects_to_file(projects, filename):
+    print(f"Writing projects to file: {filename}")
+    with open(filename, 'w') as file:
+        for project in projects:
+            file.write(f"{project}\n")
+    print(f"Finished writing projects to file: {filename}")
+
+
+def main():
     parser = argparse.ArgumentParser(description="Search for Metashape projects in a directory.")
     parser.add_argument("directory", type=str, help="Directory to search for Metashape projects")
+    parser.add_argument("--db", type=str, default=DEFAULT_DB_PATH, help="Path of the SQLite project index")
+    parser.add_argument("--workers", type=int, default=16, help="Number of directories listed at the same time")
     args = parser.parse_args()
 
     directory = args.directory
     print(f"Starting search in directory: {directory}")
-    projects = find_metashape_projects(directory)
+    connection = connect(args.db)
+    projects = scan(directory, connection, workers=args.workers)
     print(f"Total projects found: {len(projects)}")
-    for project in projects:
-        print(project)
-        
-    def has_orthomosaic(project_path):
-        print(f"Checking for orthomosaic in project: {project_path}")
-        doc = Metashape.Document()
-        doc.open(project_path, ignore_lock=True)
-        for chunk in doc.chunks:
-            if chunk.orthomosaic is not None:
-                print(f"Orthomosaic found in project: {project_path}")
-                return True
-        print(f"No orthomosaic found in project: {project_path}")
-        return False
-    
-    def write_projects_to_file(projects, filename):
-        print(f"Writing projects to file: {filename}")
-        with open(filename, 'w') as file:
-            for project in projects:
-                file.write(f"{project}\n")
-        print(f"Finished writing projects to file: {filename}")
-
-    projects_with_orthomosaic = []
-    projects_without_orthomosaic = []
-
-    for project in projects:
-        if has_orthomosaic(project):
-            projects_with_orthomosaic.append(project)
-        else:
-            projects_without_orthomosaic.append(project)
+
+    projects_with_orthomosaic = query(connection, directory, has=["orthomosaic"])
+    with_orthomosaic = set(projects_with_orthomosaic)
+    projects_without_orthomosaic = [p for p in query(connection, directory) if p not in with_orthomosaic]
+    connection.close()
 
     print(f"Projects with orthomosaic: {len(projects_with_orthomosaic)}")
     print(f"Projects without orthomosaic: {len(projects_without_orthomosaic)}")
 
     output_dir = directory
     write_projects_to_file(projects_with_orthomosaic, os.path.join(output_dir, "projects_with_orthomosaic.txt"))
-    write_projects_to_file(projects_without_orthomosaic, os.path.join(output_dir, "projects_without_orthomosaic.txt"))
\ No newline at end of file
+    write_projects_to_file(projects_without_orthomosaic, os.path.join(output_dir, "projects_without_orthomosaic.txt"))
+
+
+if __name__ == "__main__":
+    main()
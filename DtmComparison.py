@@ -0,0 +1,91 @@
+import os
+import csv
+import math
+import argparse
+
+import numpy as np
+import rasterio
+
+STAT_FIELDS = ["valid_fraction", "mean", "std", "min", "max", "mean_diff", "rmse_diff", "max_abs_diff"]
+
+
+def _valid(block, nodata):
+    valid = np.isfinite(block)
+    if nodata is not None:
+        valid &= block != nodata
+    return valid
+
+
+def dtm_statistics(path, reference_path=None):
+    """
+    Summary statistics of a DTM, and of its difference to a reference DTM on the same grid.
+
+    The rasters are read block by block, so memory use does not depend on their size.
+    The difference statistics are None if the reference is missing or on another grid.
+    """
+    count = total = total_sq = 0.0
+    low, high = math.inf, -math.inf
+    diff_count = diff_total = diff_sq = 0.0
+    diff_max = 0.0
+    with rasterio.open(path) as src:
+        reference = rasterio.open(reference_path) if reference_path else None
+        try:
+            same_grid = (reference is not None and reference.shape == src.shape
+                         and reference.transform == src.transform)
+            for _, window in src.block_windows(1):
+                block = src.read(1, window=window).astype(np.float64)
+                valid = _valid(block, src.nodata)
+                values = block[valid]
+                if values.size:
+                    count += values.size
+                    total += values.sum()
+                    total_sq += np.square(values).sum()
+                    low, high = min(low, values.min()), max(high, values.max())
+                if same_grid:
+                    ref_block = reference.read(1, window=window).astype(np.float64)
+                    both = valid & _valid(ref_block, reference.nodata)
+                    diff = block[both] - ref_block[both]
+                    if diff.size:
+                        diff_count += diff.size
+                        diff_total += diff.sum()
+                        diff_sq += np.square(diff).sum()
+                        diff_max = max(diff_max, np.abs(diff).max())
+            cells = src.width * src.height
+        finally:
+            if reference is not None:
+                reference.close()
+
+    stats = dict.fromkeys(STAT_FIELDS)
+    stats["valid_fraction"] = count / cells if cells else 0.0
+    if count:
+        mean = total / count
+        stats.update(mean=mean, std=math.sqrt(max(total_sq / count - mean * mean, 0.0)), min=low, max=high)
+    if diff_count:
+        stats.update(mean_diff=diff_total / diff_count, rmse_diff=math.sqrt(diff_sq / diff_count), max_abs_diff=diff_max)
+    return stats
+
+
+def write_comparison(rows, path, param_names):
+    """Write one row per DTM: its parameters followed by its statistics."""
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=["setting"] + list(param_names) + STAT_FIELDS + ["cached", "dtm"],
+                                extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare DTMs against a reference DTM.")
+    parser.add_argument('reference', help='Reference DTM.')
+    parser.add_argument('dtms', nargs='+', help='DTMs to compare, on the same grid as the reference.')
+    args = parser.parse_args()
+
+    print("dtm," + ",".join(STAT_FIELDS))
+    for path in args.dtms:
+        stats = dtm_statistics(path, args.reference)
+        print(os.path.basename(path) + "," + ",".join("" if stats[f] is None else f"{stats[f]:.4f}" for f in STAT_FIELDS))
+
+
+if __name__ == "__main__":
+    main()
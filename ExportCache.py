@@ -0,0 +1,93 @@
+import os
+import json
+import contextlib
+
+from StageManifest import digest
+
+COMPRESSION_ATTRIBUTES = ("tiff_compression", "jpeg_quality", "tiff_big", "tiff_overviews", "tiff_tiled")
+
+
+def sidecar_path(path):
+    """The fingerprint of an export is kept next to it, e.g. site_DEM.tif.export.json."""
+    return path + ".export.json"
+
+
+def partial_path(path):
+    """Exports are written under a temporary name that keeps the extension Metashape expects."""
+    root, ext = os.path.splitext(path)
+    return root + ".partial" + ext
+
+
+def compression_settings(compression):
+    if compression is None:
+        return None
+    return {name: str(getattr(compression, name, None)) for name in COMPRESSION_ATTRIBUTES}
+
+
+def raster_transform_settings(chunk, raster_transform=None):
+    """The raster transform only matters for exports that apply it."""
+    if raster_transform is None:
+        return None
+    return {"type": str(raster_transform), "formula": list(chunk.raster_transform.formula),
+            "enabled": bool(chunk.raster_transform.enabled)}
+
+
+def export_fingerprint(manifest, sources, **settings):
+    """
+    Fingerprint of an export: the run ids of the stages whose products it contains and the export settings.
+
+    Returns None if one of the stages has no run id in the manifest; such exports are
+    always written, since nothing tells whether the product changed.
+    """
+    run_ids = {}
+    for source in sources:
+        run_id = manifest.stages.get(source, {}).get("run_id")
+        if run_id is None:
+            return None
+        run_ids[source] = run_id
+    return digest({"sources": run_ids, "settings": settings})
+
+
+def recorded_fingerprint(path):
+    """The fingerprint an existing export was written with, or None if it is missing or incomplete."""
+    try:
+        with open(sidecar_path(path), 'r') as file:
+            recorded = json.load(file)
+        size = os.path.getsize(path)
+    except (OSError, ValueError):
+        return None
+    return recorded.get("fingerprint") if recorded.get("size") == size else None
+
+
+def up_to_date(path, fingerprint):
+    """True if the export exists, is complete and was written with the same fingerprint."""
+    return fingerprint is not None and recorded_fingerprint(path) == fingerprint
+
+
+@contextlib.contextmanager
+def atomic_export(path, fingerprint=None):
+    """
+    Yield the temporary path an export is written to, and move it into place once it succeeds.
+
+    An interrupted export only leaves the .partial file, which the next export overwrites;
+    the previous export and its fingerprint stay valid until they are replaced. The
+    fingerprint is recorded after the export is in place, so an export is never taken as
+    up to date before it is complete.
+    """
+    tmp_path = partial_path(path)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(sidecar_path(path))
+    os.replace(tmp_path, path)
+    if fingerprint is not None:
+        tmp_sidecar = sidecar_path(path) + ".tmp"
+        with open(tmp_sidecar, 'w') as file:
+            json.dump({"fingerprint": fingerprint, "size": os.path.getsize(path)}, file)
+        os.replace(tmp_sidecar, sidecar_path(path))
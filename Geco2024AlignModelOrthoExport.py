@@ -7,6 +7,14 @@ import sys
 from datetime import datetime
 from pathlib import Path
 
+import BatchScheduler
+import ExportCache
+import ChunkSelection
+import CogConversion
+from ProjectSession import ProjectSession
+from StageManifest import StageManifest
+import GradualSelection
+
 def setup_logging(project_path, log_dir):
     """Configure logging to file and console"""
     
@@ -35,10 +43,10 @@ def setup_logging(project_path, log_dir):
     return log_file
 
 
-def process_project_preprocessing(project_path):
-    # Open the existing project
-    doc = Metashape.Document()
-    doc.open(project_path, ignore_lock=True)
+def process_project_preprocessing(project_path, gradual_selection=None, chunks=None, cog=None, **session_options):
+    # Open the existing project once for all stages; saves are coalesced by the session
+    session = ProjectSession(project_path, **session_options)
+    doc = session.doc
 
     # Define the base directory for output files (relative paths)
     base_dir = os.path.dirname(project_path)
@@ -57,12 +65,9 @@ def process_project_preprocessing(project_path):
     log_file_path = os.path.join(log_dir, f"processing_log_{current_time}.log")
     setup_logging(log_file_path, log_dir)
 
-    # Set the chunk (assuming single chunk processing, but can be modified for multiple)
-    chunk = doc.chunk
-
     # Set the coordinate system (EPSG::4326 - WGS 84) or another desired coordinate system
-    coord_system = Metashape.CoordinateSystem("EPSG::4326")
-    chunk.crs = coord_system
+    crs_code = "EPSG::4326"
+    coord_system = Metashape.CoordinateSystem(crs_code)
 
     # Create OrthoProjection object using the same coordinate system
     ortho_proj = Metashape.OrthoProjection()
@@ -76,9 +81,8 @@ def process_project_preprocessing(project_path):
     compression.tiff_overviews = True
     compression.tiff_tiled = True
 
-    # Apply Raster Transform
-    print("Applying raster transform and exporting...")
-    chunk.raster_transform.formula = [
+    # Raster transform applied to the orthomosaic exports
+    raster_formula = [
         'B1 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
         'B2 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
         'B4 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
@@ -86,8 +90,36 @@ def process_project_preprocessing(project_path):
         'B6 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
         '(B7 / 100) - 273.15'
     ]
-    chunk.raster_transform.enabled = True
+
+    # Process every enabled chunk, or the selected ones, with the settings above. The chunks
+    # of a project run one after the other in the open document.
+    for chunk in ChunkSelection.select_chunks(doc, chunks):
+        print(f"Processing chunk {chunk.label}...")
+        logging.info(f"Processing chunk {chunk.label}...")
+        session.process_chunk(process_chunk_preprocessing, chunk, export_dir, crs_code, ortho_proj, compression, raster_formula,
+                              gradual_selection=gradual_selection, cog=cog)
+    session.close()
+    # Clean up the project flder and get rid of the temporary files (see the ClearinStorageSpace.py script)
     
+    #clear_storage_space(project_path)
+
+    return session.stats
+
+def process_chunk_preprocessing(session, chunk, export_dir, crs_code, ortho_proj, compression, raster_formula,
+                                gradual_selection=None, cog=None):
+    project_path = session.project_path
+    doc = session.doc
+    reference_dir = os.path.join(os.path.dirname(project_path), "references")
+    session.chunk = chunk
+    # Exports are named after the chunk
+    label = ChunkSelection.export_label(doc, chunk)
+    chunk.crs = ortho_proj.crs
+
+    # Apply Raster Transform
+    print("Applying raster transform and exporting...")
+    chunk.raster_transform.formula = raster_formula
+    chunk.raster_transform.enabled = True
+
     # Set the primary channel to Panchro band
     panchro_band_found = False
     for s in chunk.sensors:
@@ -105,135 +137,214 @@ def process_project_preprocessing(project_path):
 
 
 
+    # Completed stages are tracked per chunk so reruns only redo what changed
+    manifest = StageManifest(project_path, ChunkSelection.manifest_key(doc, chunk))
+    session.on_save(manifest.save)
+    camera_labels = [camera.label for camera in chunk.cameras]
+
+    # Projects aligned before the manifest existed carry the old CamerasAligned.txt marker, which
+    # was written for the active chunk
     alignment_done = Path(reference_dir) / "CamerasAligned.txt"
-    if not alignment_done.exists():
-        print("Aligning cameras...")
-        logging.info("Aligning cameras...")
-        chunk.matchPhotos(
-            downscale=1,
-            generic_preselection=True,
-            reference_preselection=True,
-            reference_preselection_mode=Metashape.ReferencePreselectionSource,
-            tiepoint_limit=10000,
-            reset_matches=True
-        )
-        chunk.alignCameras(reset_alignment=True)
-        doc.save()
-        
-        # Mark alignment as done
-        alignment_done.parent.mkdir(parents=True, exist_ok=True)  # Ensure the directory exists
-        with open(alignment_done, 'w') as done_file:
-            done_file.write("Alignment of Multispectral Images step completed.\n")
+    cameras_aligned = (alignment_done.exists() and ChunkSelection.is_active(doc, chunk)) or \
+        any(camera.transform for camera in chunk.cameras)
+    match_params = dict(
+        downscale=1,
+        generic_preselection=True,
+        reference_preselection=True,
+        reference_preselection_mode=Metashape.ReferencePreselectionSource,
+        tiepoint_limit=10000,
+        reset_matches=True
+    )
+    if manifest.needs_run("align", params=match_params, inputs={"cameras": camera_labels, "primary_channel": chunk.primary_channel},
+                          present=cameras_aligned):
+        with session.stage("align") as progress:
+            print("Aligning cameras...")
+            logging.info("Aligning cameras...")
+            chunk.matchPhotos(progress=progress.part(0, 2), **match_params)
+            chunk.alignCameras(progress=progress.part(1, 2), reset_alignment=True)
+            manifest.complete("align")
     else:
         print("Alignment already completed. Skipping...")
         logging.info("Alignment already completed. Skipping...")
 
-    doc.save()
+    # Camera optimization settings, also used between the rounds of the adaptive gradual selection
+    optimize_params = dict(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, adaptive_fitting=False)
 
-    # Gradual selection based on reprojection error
-    print("Gradual selection for reprojection error...")
-    f = Metashape.TiePoints.Filter()
+    # Gradual selection: one pass on the reprojection error, or the adaptive loop over several criteria
     threshold = 0.5
-    f.init(chunk, criterion=Metashape.TiePoints.Filter.ReprojectionError)
-    f.removePoints(threshold)
-    doc.save()
+    selection_params = gradual_selection or {"criterion": "ReprojectionError", "threshold": threshold}
+    if manifest.needs_run("gradual_selection", params=selection_params, depends=["align"]):
+        with session.stage("gradual_selection") as progress:
+            if gradual_selection:
+                print("Adaptive gradual selection...")
+                iterations = GradualSelection.adaptive_selection(chunk, optimize_params=optimize_params, progress=progress,
+                                                                 **gradual_selection)
+                GradualSelection.write_log(project_path, iterations, gradual_selection, label)
+            else:
+                print("Gradual selection for reprojection error...")
+                f = Metashape.TiePoints.Filter()
+                f.init(chunk, criterion=Metashape.TiePoints.Filter.ReprojectionError)
+                f.removePoints(threshold)
+            manifest.complete("gradual_selection")
 
     # Optimize camera alignment by adjusting intrinsic parameters
-    print("Optimizing camera alignment...")
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, adaptive_fitting=False)
-    doc.save()
+    if manifest.needs_run("optimize", params=optimize_params, depends=["gradual_selection"]):
+        with session.stage("optimize") as progress:
+            print("Optimizing camera alignment...")
+            chunk.optimizeCameras(progress=progress, **optimize_params)
+            manifest.complete("optimize")
 
     # Build Depth Maps and Dense Point Cloud
-    if not chunk.depth_maps:
-        print("Building Depth Maps...")
-        chunk.buildDepthMaps(downscale=1, filter_mode=Metashape.MildFiltering)
+    depth_params = dict(downscale=1, filter_mode=Metashape.MildFiltering)
+    if manifest.needs_run("depth_maps", params=depth_params, depends=["optimize"], present=chunk.depth_maps is not None):
+        with session.stage("depth_maps") as progress:
+            print("Building Depth Maps...")
+            chunk.buildDepthMaps(progress=progress, **depth_params)
+            manifest.complete("depth_maps")
     else:
         print("Depth Maps already exist. Skipping.")
 
-    if not chunk.point_cloud:
-        print("Building Point Cloud...")
-        chunk.buildPointCloud(source_data=Metashape.DataSource.DepthMapsData, point_colors=True)
+    point_cloud_params = dict(source_data=Metashape.DataSource.DepthMapsData, point_colors=True)
+    if manifest.needs_run("point_cloud", params=point_cloud_params, depends=["depth_maps"], present=chunk.point_cloud is not None):
+        with session.stage("point_cloud") as progress:
+            print("Building Point Cloud...")
+            chunk.buildPointCloud(progress=progress, **point_cloud_params)
+            manifest.complete("point_cloud")
     else:
         print("Point Cloud already exists. Skipping.")
-    doc.save()
 
     # Build Model (Redundancy Check)
-
-    print("Building Model...")
-    chunk.buildModel(surface_type=Metashape.HeightField, source_data=Metashape.PointCloudData,
-                         face_count=Metashape.MediumFaceCount)
-
-    # Decimate and smooth the model to use as an orthorectification surface
-    print("Decimating and smoothing the model...")
-    chunk.decimateModel(face_count=len(chunk.model.faces) // 2)
+    model_params = dict(surface_type=Metashape.HeightField, source_data=Metashape.PointCloudData,
+                        face_count=Metashape.MediumFaceCount)
     smooth_val = 100   #Example smoothing strength, adjust as needed
-    chunk.smoothModel(smooth_val)
+    if manifest.needs_run("model", params=dict(model_params, decimate_ratio=0.5, smooth=smooth_val), depends=["point_cloud"],
+                          present=chunk.model is not None):
+        with session.stage("model") as progress:
+            print("Building Model...")
+            chunk.buildModel(progress=progress.part(0, 3), **model_params)
 
-    # Build Orthomosaic from the model data
-    print("Building Orthomosaic from the model data...")
-    chunk.buildOrthomosaic(surface_data=Metashape.ModelData, blending_mode=Metashape.DisabledBlending, projection=ortho_proj)
-    ortho_file_model = os.path.join(export_dir, chunk.label + "model_ortho.tif")
-    chunk.exportRaster(path=ortho_file_model, source_data=Metashape.OrthomosaicData, image_format=Metashape.ImageFormatTIFF, image_compression=compression, raster_transform=Metashape.RasterTransformValue, projection=ortho_proj)
-    doc.save()
+            # Decimate and smooth the model to use as an orthorectification surface
+            print("Decimating and smoothing the model...")
+            chunk.decimateModel(progress=progress.part(1, 3), face_count=len(chunk.model.faces) // 2)
+            chunk.smoothModel(smooth_val, progress=progress.part(2, 3))
+            manifest.complete("model")
+    else:
+        print("Model already exists. Skipping.")
+
+    # Build Orthomosaic from the model data. It is exported right away because the
+    # orthomosaic built from the DEM below replaces it in the chunk.
+    model_ortho_params = dict(surface_data=Metashape.ModelData, blending_mode=Metashape.DisabledBlending)
+    if manifest.needs_run("model_orthomosaic", params=dict(model_ortho_params, crs=crs_code), depends=["model"]):
+        with session.stage("model_orthomosaic") as progress:
+            print("Building Orthomosaic from the model data...")
+            chunk.buildOrthomosaic(progress=progress.part(0, 2), projection=ortho_proj, **model_ortho_params)
+            ortho_file_model = os.path.join(export_dir, label + "model_ortho.tif")
+            # Exported with the stage, so it is renewed exactly when the stage reruns
+            with ExportCache.atomic_export(ortho_file_model) as tmp_path:
+                chunk.exportRaster(progress=progress.part(1, 2), path=tmp_path, source_data=Metashape.OrthomosaicData, image_format=Metashape.ImageFormatTIFF, image_compression=compression, raster_transform=Metashape.RasterTransformValue, projection=ortho_proj)
+            manifest.complete("model_orthomosaic")
+    else:
+        print("Orthomosaic from the model data is up to date. Skipping.")
 
     # Build DEM
-    print("Building DEM...")
-    chunk.buildDem(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation, projection=ortho_proj)
-    doc.save()
+    dem_params = dict(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation)
+    dem = manifest.elevation(chunk, "dem", adopt=True)
+    if manifest.needs_run("dem", params=dict(dem_params, crs=crs_code), depends=["point_cloud"], present=dem is not None,
+                          product=dem.key if dem else None):
+        with session.stage("dem") as progress:
+            print("Building DEM...")
+            chunk.buildDem(progress=progress, projection=ortho_proj, **dem_params)
+            dem = chunk.elevation
+            manifest.complete("dem", product=dem.key)
+    else:
+        print("DEM already exists. Skipping.")
 
     # Build Orthomosaic from DEM
-    print("Building Orthomosaic from DEM...")
-    chunk.buildOrthomosaic(surface_data=Metashape.ElevationData, blending_mode=Metashape.DisabledBlending, projection=ortho_proj)
-    doc.save()
-
-    # Export DEM and Orthomosaic
-    dem_path = os.path.join(export_dir, chunk.label + "_DEM.tif")
-    print(f"Exporting DEM to {dem_path}...")
-    chunk.exportRaster(path=dem_path, source_data=Metashape.ElevationData, image_format=Metashape.ImageFormatTIFF, image_compression=compression, projection=ortho_proj)
-
-    ortho_path_DEM = os.path.join(export_dir, chunk.label + "DEM_ortho.tif")
-    print(f"Exporting Orthomosaic to {ortho_path_DEM}...")
-    chunk.exportRaster(path=ortho_path_DEM, source_data=Metashape.OrthomosaicData, image_format=Metashape.ImageFormatTIFF, image_compression=compression, raster_transform=Metashape.RasterTransformValue, projection=ortho_proj)
-    
-    # Export the processing report
-    report_path = os.path.join(export_dir, chunk.label + "_report.pdf")
-    print(f"Exporting processing report to {report_path}...")
-    chunk.exportReport(report_path)
-    doc.save()
-    # Clean up the project flder and get rid of the temporary files (see the ClearinStorageSpace.py script)
-    
-    #clear_storage_space(project_path)
-    
-    #doc.save()
-    
-def clear_storage_space(project_path):
+    ortho_params = dict(surface_data=Metashape.ElevationData, blending_mode=Metashape.DisabledBlending)
+    if manifest.needs_run("orthomosaic", params=dict(ortho_params, crs=crs_code), depends=["dem", "model_orthomosaic"],
+                          present=chunk.orthomosaic is not None):
+        with session.stage("orthomosaic") as progress:
+            print("Building Orthomosaic from DEM...")
+            chunk.elevation = dem
+            chunk.buildOrthomosaic(progress=progress, projection=ortho_proj, **ortho_params)
+            manifest.complete("orthomosaic")
+    else:
+        print("Orthomosaic from DEM is up to date. Skipping.")
+
+    # Export DEM and Orthomosaic, unless the exports are up to date with the chunk
+    export_settings = dict(crs=crs_code, compression=ExportCache.compression_settings(compression))
+    dem_path = os.path.join(export_dir, label + "_DEM.tif")
+    dem_export = dict(source_data=Metashape.ElevationData, image_format=Metashape.ImageFormatTIFF)
+    fingerprint = ExportCache.export_fingerprint(manifest, ["dem"], **dem_export, **export_settings)
+    if ExportCache.up_to_date(dem_path, fingerprint):
+        print(f"DEM export {dem_path} is up to date. Skipping.")
+    else:
+        print(f"Exporting DEM to {dem_path}...")
+        with session.stage("export_dem", modifies=False) as progress, ExportCache.atomic_export(dem_path, fingerprint) as tmp_path:
+            chunk.elevation = dem
+            chunk.exportRaster(progress=progress, path=tmp_path, image_compression=compression, projection=ortho_proj, **dem_export)
+
+    ortho_path_DEM = os.path.join(export_dir, label + "DEM_ortho.tif")
+    ortho_export = dict(source_data=Metashape.OrthomosaicData, image_format=Metashape.ImageFormatTIFF, raster_transform=Metashape.RasterTransformValue)
+    fingerprint = ExportCache.export_fingerprint(manifest, ["orthomosaic"], **ortho_export, **export_settings,
+                                                 transform=ExportCache.raster_transform_settings(chunk, Metashape.RasterTransformValue))
+    if ExportCache.up_to_date(ortho_path_DEM, fingerprint):
+        print(f"Orthomosaic export {ortho_path_DEM} is up to date. Skipping.")
+    else:
+        print(f"Exporting Orthomosaic to {ortho_path_DEM}...")
+        with session.stage("export_orthomosaic", modifies=False) as progress, ExportCache.atomic_export(ortho_path_DEM, fingerprint) as tmp_path:
+            chunk.exportRaster(progress=progress, path=tmp_path, image_compression=compression, projection=ortho_proj, **ortho_export)
+
+    # Cloud-Optimized GeoTIFF copies of the exports for GIS and web viewers
+    if cog:
+        cog_paths = [os.path.join(export_dir, label + suffix) for suffix in ("_DEM.tif", "DEM_ortho.tif", "model_ortho.tif")]
+        session.post("export_cog", CogConversion.convert_exports, cog_paths, inputs=cog_paths, **cog)
+
+    # Export the processing report; it covers every stage, so any rerun stage renews it
+    report_path = os.path.join(export_dir, label + "_report.pdf")
+    fingerprint = ExportCache.export_fingerprint(manifest, sorted(manifest.stages))
+    if ExportCache.up_to_date(report_path, fingerprint):
+        print(f"Processing report {report_path} is up to date. Skipping.")
+    else:
+        print(f"Exporting processing report to {report_path}...")
+        with session.stage("export_report", modifies=False) as progress, ExportCache.atomic_export(report_path, fingerprint) as tmp_path:
+            chunk.exportReport(tmp_path, progress=progress)
+
+def clear_storage_space(project_path, **session_options):
    print(f"Opening project: {project_path}")
-   doc = Metashape.Document()
-   doc.open(project_path, ignore_lock=True)
-   for chunk in doc.chunks:
+   session = ProjectSession(project_path, **session_options)
+   for chunk in session.doc.chunks:
       if chunk.orthomosaic is not None:
          print(f'Removing orthoPhotos for chunk: {chunk.label}')
          chunk.orthomosaic.removeOrthophotos()
-   doc.save()
+         session.changed("clear_storage")
+   session.close()
    print(f"Storage space cleared for project: {project_path}")
-def process_multiple_projects(project_paths):
-            processed_projects = set()
-            for project_path in project_paths:
-                if project_path not in processed_projects:
-                    process_project_preprocessing(project_path)
-                    processed_projects.add(project_path)
-def process_multiple_projects_from_file(filepath):
-            with open(filepath, 'r') as file:
-                project_paths = [line.strip() for line in file.readlines()]
-            process_multiple_projects(project_paths)
+
+def process_multiple_projects(project_paths, workers=1, **options):
+    # Duplicate entries are dropped by the scheduler
+    return BatchScheduler.run_batch(process_project_preprocessing, project_paths, workers=workers, **options)
+
+def process_multiple_projects_from_file(filepath, workers=1, **options):
+    project_paths = BatchScheduler.read_project_list(filepath)
+    return process_multiple_projects(project_paths, workers=workers, **options)
 
 def main():
-            parser = argparse.ArgumentParser(description="Process Metashape projects (Pre-Processing).")
-            parser.add_argument('project_paths', type=str, help='Path to the text file containing Metashape project paths.')
-            args = parser.parse_args()
+    parser = argparse.ArgumentParser(description="Process Metashape projects (Pre-Processing).")
+    parser.add_argument('project_paths', type=str, help='Path to the text file containing Metashape project paths.')
+    GradualSelection.add_selection_arguments(parser)
+    ChunkSelection.add_chunk_arguments(parser)
+    CogConversion.add_cog_arguments(parser)
+    BatchScheduler.add_batch_arguments(parser)
+    args = parser.parse_args()
 
-            process_multiple_projects_from_file(args.project_paths)
+    results = process_multiple_projects_from_file(args.project_paths, workers=args.workers,
+                                                  gradual_selection=GradualSelection.selection_settings(args),
+                                                  chunks=ChunkSelection.parse_chunks(args.chunks),
+                                                  cog=CogConversion.cog_settings(args),
+                                                  **BatchScheduler.batch_options(args))
+    sys.exit(BatchScheduler.exit_code(results))
 
 if __name__ == "__main__":
-            main()
+    main()
 
@@ -1,11 +1,33 @@
 import Metashape
 import os
+import sys
+import json
+import time
 import argparse
+import itertools
 
-def process_ground_classification_and_dtm(project_path):
-    # Open the existing project
-    doc = Metashape.Document()
-    doc.open(project_path, ignore_lock=True)
+import BatchScheduler
+import ExportCache
+import ChunkSelection
+import CogConversion
+from ProjectSession import ProjectSession
+from StageManifest import StageManifest, digest
+
+# Ground classification settings; sweeps vary some of them and keep the others
+GROUND_PARAMS = dict(
+    max_angle=40,
+    max_distance=2.5,
+    max_terrain_slope=35,
+    cell_size=20.0,
+    erosion_radius=0.5,
+    return_number=0,
+    keep_existing=False
+)
+
+def process_ground_classification_and_dtm(project_path, chunks=None, cog=None, **session_options):
+    # Open the existing project once for all stages; saves are coalesced by the session
+    session = ProjectSession(project_path, **session_options)
+    doc = session.doc
 
     # Define the base directory for output files (relative paths)
     base_dir = os.path.dirname(project_path)
@@ -13,67 +35,234 @@ def process_ground_classification_and_dtm(project_path):
     if not os.path.exists(export_dir):
         os.makedirs(export_dir)
 
-    # Set the chunk (assuming single chunk processing)
-    chunk = doc.chunk
-
     # Set the coordinate system (EPSG::4326 - WGS 84) or another desired coordinate system
-    coord_system = Metashape.CoordinateSystem("EPSG::4326")
-    chunk.crs = coord_system
+    crs_code = "EPSG::4326"
+    coord_system = Metashape.CoordinateSystem(crs_code)
 
     # Create OrthoProjection object using the same coordinate system
     ortho_proj = Metashape.OrthoProjection()
     ortho_proj.crs = coord_system
 
+    # Process every enabled chunk, or the selected ones, with the settings above. The chunks
+    # of a project run one after the other in the open document.
+    for chunk in ChunkSelection.select_chunks(doc, chunks):
+        print(f"Processing chunk {chunk.label}...")
+        session.process_chunk(process_chunk_ground_classification_and_dtm, chunk, export_dir, crs_code, ortho_proj, cog=cog)
+    session.close()
+    return session.stats
+
+def process_chunk_ground_classification_and_dtm(session, chunk, export_dir, crs_code, ortho_proj, cog=None):
+    project_path = session.project_path
+    doc = session.doc
+    session.chunk = chunk
+    # Exports are named after the chunk
+    label = ChunkSelection.export_label(doc, chunk)
+    chunk.crs = ortho_proj.crs
+
+    # Completed stages are tracked per chunk so reruns only redo what changed
+    manifest = StageManifest(project_path, ChunkSelection.manifest_key(doc, chunk))
+    session.on_save(manifest.save)
+
     # Classify Ground Points
-    print("Classifying Ground Points...")
-    chunk.point_cloud.classifyGroundPoints(
-        max_angle=40,
-        max_distance=2.5,
-        max_terrain_slope=35,
-        cell_size=20.0,
-        erosion_radius=0.5,
-        return_number=0,
-        keep_existing=False
-    )
-    doc.save()
+    ground_params = dict(GROUND_PARAMS)
+    if manifest.needs_run("ground_classification", params=ground_params, depends=["point_cloud"]):
+        with session.stage("ground_classification") as progress:
+            print("Classifying Ground Points...")
+            chunk.point_cloud.classifyGroundPoints(progress=progress, **ground_params)
+            manifest.complete("ground_classification")
 
     # Build DTM from Classified Ground Points
-    print("Building DTM from classified ground points...")
-    ground_points = [Metashape.PointClass.Ground]
-    chunk.buildDem(
-        source_data=Metashape.PointCloudData,
-        interpolation=Metashape.EnabledInterpolation,
-        projection=ortho_proj,
-        classes=ground_points
-    )
-
-    dtm_path = os.path.join(export_dir, chunk.label + "_DTM.tif")
-    print(f"Exporting DTM to {dtm_path}...")
-    chunk.exportRaster(path=dtm_path, source_data=Metashape.ElevationData, image_format=Metashape.ImageFormatTIFF, projection=ortho_proj)
-
-    doc.save()
-
-    # Export the processing report
-    report_path = os.path.join(export_dir, chunk.label + "_report.pdf")
-    print(f"Exporting processing report to {report_path}...")
-    chunk.exportReport(report_path)
-    doc.save()
-
-def process_multiple_projects(project_paths):
-    for project_path in project_paths:
-        process_ground_classification_and_dtm(project_path)
-
-def process_multiple_projects_from_file(filepath):
-    with open(filepath, 'r') as file:
-        project_paths = [line.strip() for line in file.readlines()]
-    process_multiple_projects(project_paths)
+    dtm_params = dict(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation)
+    dtm = manifest.elevation(chunk, "dtm")
+    if manifest.needs_run("dtm", params=dict(dtm_params, crs=crs_code), depends=["ground_classification"],
+                          present=dtm is not None):
+        with session.stage("dtm") as progress:
+            print("Building DTM from classified ground points...")
+            ground_points = [Metashape.PointClass.Ground]
+            chunk.buildDem(progress=progress, projection=ortho_proj, classes=ground_points, **dtm_params)
+            dtm = chunk.elevation
+            manifest.complete("dtm", product=dtm.key)
+
+    # Export the DTM and the report, unless the exports are up to date with the chunk
+    dtm_path = os.path.join(export_dir, label + "_DTM.tif")
+    dtm_export = dict(source_data=Metashape.ElevationData, image_format=Metashape.ImageFormatTIFF)
+    fingerprint = ExportCache.export_fingerprint(manifest, ["dtm"], crs=crs_code, **dtm_export)
+    if ExportCache.up_to_date(dtm_path, fingerprint):
+        print(f"DTM export {dtm_path} is up to date. Skipping.")
+    else:
+        print(f"Exporting DTM to {dtm_path}...")
+        with session.stage("export_dtm", modifies=False) as progress, ExportCache.atomic_export(dtm_path, fingerprint) as tmp_path:
+            chunk.elevation = dtm
+            chunk.exportRaster(progress=progress, path=tmp_path, projection=ortho_proj, **dtm_export)
+
+    # Cloud-Optimized GeoTIFF copy of the DTM for GIS and web viewers
+    if cog:
+        cog_paths = [os.path.join(export_dir, label + suffix) for suffix in ("_DTM.tif",)]
+        session.post("export_cog", CogConversion.convert_exports, cog_paths, inputs=cog_paths, **cog)
+
+    # The report covers every stage, so any rerun stage renews it
+    report_path = os.path.join(export_dir, label + "_report.pdf")
+    fingerprint = ExportCache.export_fingerprint(manifest, sorted(manifest.stages))
+    if ExportCache.up_to_date(report_path, fingerprint):
+        print(f"Processing report {report_path} is up to date. Skipping.")
+    else:
+        print(f"Exporting processing report to {report_path}...")
+        with session.stage("export_report", modifies=False) as progress, ExportCache.atomic_export(report_path, fingerprint) as tmp_path:
+            chunk.exportReport(tmp_path, progress=progress)
+
+def sweep_settings(grid):
+    """Expand a grid such as {"max_angle": [15, 25], "cell_size": [5, 20]} into full parameter sets."""
+    unknown = [name for name in grid if name not in GROUND_PARAMS]
+    if unknown:
+        raise ValueError(f"Unknown ground classification parameters: {', '.join(unknown)}")
+    names = sorted(grid)
+    return [dict(GROUND_PARAMS, **dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+def process_ground_sweep(project_path, grid, keep_ground_points=True, chunks=None, **session_options):
+    """
+    Classify the ground points and build a DTM for every setting of a parameter grid,
+    with the project loaded only once.
+
+    Each setting writes its DTM, and optionally the ground points it classified, to
+    exports/ground_sweep/<setting>/. Settings whose results exist for the current point
+    cloud are taken from there instead of being recomputed. The project itself is not
+    saved: its point classes and DTM stay as they were before the sweep.
+    """
+    session = ProjectSession(project_path, **session_options)
+    doc = session.doc
+
+    crs_code = "EPSG::4326"
+    coord_system = Metashape.CoordinateSystem(crs_code)
+    ortho_proj = Metashape.OrthoProjection()
+    ortho_proj.crs = coord_system
+
+    sweep_dir = os.path.join(os.path.dirname(project_path), "exports", "ground_sweep")
+    os.makedirs(sweep_dir, exist_ok=True)
+    for chunk in ChunkSelection.select_chunks(doc, chunks):
+        print(f"Sweeping chunk {chunk.label}...")
+        sweep_chunk(session, chunk, grid, sweep_dir, crs_code, ortho_proj, keep_ground_points)
+
+    session.close()
+    return session.stats
+
+def sweep_chunk(session, chunk, grid, sweep_dir, crs_code, ortho_proj, keep_ground_points=True):
+    from DtmComparison import dtm_statistics, write_comparison
+
+    doc = session.doc
+    session.chunk = chunk
+    label = ChunkSelection.export_label(doc, chunk)
+    chunk.crs = ortho_proj.crs
+    dtm_params = dict(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation)
+
+    # Cached results are only valid for the point cloud they were classified from
+    manifest = StageManifest(session.project_path, ChunkSelection.manifest_key(doc, chunk))
+    point_cloud_run = manifest.stages.get("point_cloud", {}).get("run_id")
+    if chunk.point_cloud is None or point_cloud_run is None:
+        raise ValueError(f"Chunk {chunk.label} has no point cloud recorded in its stage manifest; "
+                         f"build it with one of the processing scripts before sweeping.")
+    # The points are already classified with the setting of a complete ground classification
+    # stage; that setting goes first and reuses the classification instead of redoing it
+    classified = manifest.stages.get("ground_classification")
+    if classified is not None and classified["fingerprint"] != manifest.fingerprint(
+            "ground_classification", classified["params"], None, ["point_cloud"]):
+        classified = None
+    settings = sweep_settings(grid)
+    settings.sort(key=lambda params: classified is None or params != classified["params"])
+    original_elevation = chunk.elevation
+
+    rows = []
+    for ground_params in settings:
+        setting = digest({"ground": ground_params, "dtm": dtm_params, "crs": crs_code, "point_cloud": point_cloud_run})
+        setting_dir = os.path.join(sweep_dir, setting)
+        dtm_path = os.path.join(setting_dir, label + "_DTM.tif")
+        setting_file = os.path.join(setting_dir, "setting.json")
+        cached = os.path.exists(setting_file) and os.path.exists(dtm_path)
+        if cached:
+            print(f"Setting {setting} {ground_params} is cached. Skipping.")
+        else:
+            os.makedirs(setting_dir, exist_ok=True)
+            start_time = time.time()
+            if classified is not None and ground_params == classified["params"]:
+                print(f"Setting {setting}: points are classified with {ground_params} already, reusing them...")
+            else:
+                print(f"Setting {setting}: classifying ground points with {ground_params}...")
+                with session.stage("sweep_classification", modifies=False) as progress:
+                    chunk.point_cloud.classifyGroundPoints(progress=progress, **ground_params)
+            # The points no longer hold the recorded classification
+            classified = None
+            if keep_ground_points:
+                with session.stage("sweep_ground_points", modifies=False) as progress, \
+                        ExportCache.atomic_export(os.path.join(setting_dir, label + "_ground.laz")) as tmp_path:
+                    chunk.exportPointCloud(progress=progress, path=tmp_path,
+                                           source_data=Metashape.PointCloudData, format=Metashape.PointCloudFormatLAZ,
+                                           classes=[Metashape.PointClass.Ground], crs=ortho_proj.crs)
+            with session.stage("sweep_dtm", modifies=False) as progress:
+                chunk.buildDem(progress=progress.part(0, 2), projection=ortho_proj, classes=[Metashape.PointClass.Ground], **dtm_params)
+                with ExportCache.atomic_export(dtm_path) as tmp_path:
+                    chunk.exportRaster(progress=progress.part(1, 2), path=tmp_path, source_data=Metashape.ElevationData,
+                                       image_format=Metashape.ImageFormatTIFF, projection=ortho_proj)
+                # The sweep DTM is only wanted as a file, not as another DEM in the chunk
+                chunk.remove(chunk.elevation)
+            # Written last, so an interrupted setting is recomputed on the next run
+            with open(setting_file, 'w') as file:
+                json.dump({"params": ground_params, "crs": crs_code, "point_cloud": point_cloud_run,
+                           "seconds": time.time() - start_time}, file, indent=2)
+        rows.append({"setting": setting, "dtm": dtm_path, "cached": cached, **ground_params})
+
+    if original_elevation is not None:
+        chunk.elevation = original_elevation
+
+    # Compare every DTM with the one of the first setting of the grid
+    order = [digest({"ground": params, "dtm": dtm_params, "crs": crs_code, "point_cloud": point_cloud_run})
+             for params in sweep_settings(grid)]
+    rows.sort(key=lambda row: order.index(row["setting"]))
+    for row in rows:
+        row.update(dtm_statistics(row["dtm"], rows[0]["dtm"]))
+    comparison_path = os.path.join(sweep_dir, label + "_sweep.csv")
+    write_comparison(rows, comparison_path, sorted(GROUND_PARAMS))
+    print(f"Sweep comparison written to {comparison_path}")
+
+def process_multiple_projects(project_paths, workers=1, **options):
+    return BatchScheduler.run_batch(process_ground_classification_and_dtm, project_paths, workers=workers, **options)
+
+def sweep_multiple_projects(project_paths, grid, workers=1, **options):
+    return BatchScheduler.run_batch(process_ground_sweep, project_paths, workers=workers, grid=grid, **options)
+
+def process_multiple_projects_from_file(filepath, workers=1, **options):
+    project_paths = BatchScheduler.read_project_list(filepath)
+    return process_multiple_projects(project_paths, workers=workers, **options)
 
 def main():
     parser = argparse.ArgumentParser(description="Process Ground Classification and DTM for Metashape projects.")
     parser.add_argument('project_paths', type=str, help='Path to the text file containing Metashape project paths.')
+    parser.add_argument('--sweep', type=str, default=None,
+                        help='JSON file with a grid of ground classification parameters, e.g. {"max_angle": [15, 25, 40]}. '
+                             'Builds one DTM per setting in exports/ground_sweep instead of processing the projects.')
+    parser.add_argument('--no-ground-points', action='store_true',
+                        help='In sweep mode, do not export the ground points of each setting.')
+    ChunkSelection.add_chunk_arguments(parser)
+    CogConversion.add_cog_arguments(parser)
+    BatchScheduler.add_batch_arguments(parser)
     args = parser.parse_args()
 
-    process_multiple_projects_from_file(args.project_paths)
+    if args.sweep:
+        with open(args.sweep, 'r') as file:
+            grid = json.load(file)
+        try:
+            sweep_settings(grid)
+        except ValueError as e:
+            parser.error(str(e))
+        project_paths = BatchScheduler.read_project_list(args.project_paths)
+        results = sweep_multiple_projects(project_paths, grid, workers=args.workers,
+                                          keep_ground_points=not args.no_ground_points,
+                                          chunks=ChunkSelection.parse_chunks(args.chunks),
+                                          **BatchScheduler.batch_options(args))
+    else:
+        results = process_multiple_projects_from_file(args.project_paths, workers=args.workers,
+                                                      chunks=ChunkSelection.parse_chunks(args.chunks),
+                                                      cog=CogConversion.cog_settings(args),
+                                                      **BatchScheduler.batch_options(args))
+    sys.exit(BatchScheduler.exit_code(results))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,122 @@
+import Metashape
+import os
+import json
+import math
+import time
+from datetime import datetime
+
+# Criteria in the order they are applied, with the threshold each one works towards.
+# Values follow the usual USGS style workflow for UAV imagery.
+DEFAULT_CRITERIA = (
+    ("ReconstructionUncertainty", 10.0),
+    ("ProjectionAccuracy", 3.0),
+    ("ReprojectionError", 0.5),
+)
+
+
+def filter_values(chunk, criterion):
+    """Initialise a tie point filter for a criterion and return it with the values of the valid points."""
+    f = Metashape.TiePoints.Filter()
+    f.init(chunk, criterion=getattr(Metashape.TiePoints.Filter, criterion))
+    values = sorted(v for v in f.values if v is not None and math.isfinite(v))
+    return f, values
+
+
+def rms(values):
+    return math.sqrt(sum(v * v for v in values) / len(values)) if values else 0.0
+
+
+def round_threshold(values, target, max_removal):
+    """The target threshold, raised where needed so that at most `max_removal` of the points go."""
+    if not values:
+        return target
+    keep = int(math.ceil(len(values) * (1.0 - max_removal)))
+    return max(target, values[min(max(keep - 1, 0), len(values) - 1)])
+
+
+def adaptive_selection(chunk, criteria=DEFAULT_CRITERIA, max_removal=0.1, max_rounds=5, rms_tolerance=0.01,
+                       optimize_params=None, progress=None):
+    """
+    Gradual selection in rounds of filtering and camera optimization, criterion by criterion.
+
+    Each round removes the points above the criterion's target, but never more than
+    `max_removal` of the remaining points, and then reoptimizes the cameras. A criterion
+    is done when no point exceeds its target, when the RMS reprojection error improves by
+    less than `rms_tolerance` (relative) or after `max_rounds` rounds. Returns the
+    statistics of every round.
+    """
+    optimize_params = optimize_params or {}
+    iterations = []
+    rounds_done = 0
+    total_rounds = len(criteria) * max_rounds
+    previous_rms = rms(filter_values(chunk, "ReprojectionError")[1])
+    print(f"Initial RMS reprojection error: {previous_rms:.4f}")
+
+    for criterion, target in criteria:
+        for round_number in range(1, max_rounds + 1):
+            start_time = time.time()
+            f, values = filter_values(chunk, criterion)
+            threshold = round_threshold(values, target, max_removal)
+            removed = sum(1 for v in values if v > threshold)
+            if removed == 0:
+                print(f"{criterion}: no points above {threshold:.4f}, done.")
+                break
+            f.removePoints(threshold)
+            chunk.optimizeCameras(**optimize_params)
+            current_rms = rms(filter_values(chunk, "ReprojectionError")[1])
+            iterations.append({
+                "criterion": criterion,
+                "round": round_number,
+                "target": target,
+                "threshold": threshold,
+                "points_before": len(values),
+                "removed": removed,
+                "removed_fraction": removed / len(values),
+                "rms_reprojection_error": current_rms,
+                "seconds": time.time() - start_time,
+            })
+            print(f"{criterion} round {round_number}: threshold {threshold:.4f}, removed {removed} of {len(values)} points, "
+                  f"RMS reprojection error {previous_rms:.4f} -> {current_rms:.4f}")
+            rounds_done += 1
+            if progress is not None:
+                progress(100.0 * rounds_done / total_rounds)
+            converged = previous_rms > 0 and (previous_rms - current_rms) / previous_rms < rms_tolerance
+            previous_rms = current_rms
+            if converged:
+                print(f"{criterion}: RMS reprojection error converged.")
+                break
+    return iterations
+
+
+def write_log(project_path, iterations, settings, chunk_label=None):
+    """Write the per-round statistics to logs/<project>[_<chunk>]_gradual_selection_<time>.json."""
+    log_dir = os.path.join(os.path.dirname(project_path), "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    project_name = os.path.splitext(os.path.basename(project_path))[0]
+    if chunk_label:
+        project_name += "_" + chunk_label
+    path = os.path.join(log_dir, f"{project_name}_gradual_selection_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, 'w') as file:
+        json.dump({"project": project_path, "chunk": chunk_label, "settings": settings, "iterations": iterations},
+                  file, indent=2)
+    print(f"Gradual selection statistics written to {path}")
+    return path
+
+
+def add_selection_arguments(parser):
+    """Command line options of the alignment scripts for the adaptive gradual selection."""
+    parser.add_argument('--adaptive-selection', action='store_true',
+                        help='Replace the single reprojection error pass by the adaptive gradual selection over '
+                             'reconstruction uncertainty, projection accuracy and reprojection error.')
+    parser.add_argument('--selection-max-removal', type=float, default=10.0,
+                        help='Adaptive selection: largest share of the tie points removed per round, in percent (default: 10).')
+    parser.add_argument('--selection-max-rounds', type=int, default=5,
+                        help='Adaptive selection: maximum rounds per criterion (default: 5).')
+
+
+def selection_settings(args):
+    """Settings of the adaptive gradual selection from the command line, or None for the single pass."""
+    if not args.adaptive_selection:
+        return None
+    return {"criteria": [list(criterion) for criterion in DEFAULT_CRITERIA], "max_removal": args.selection_max_removal / 100.0,
+            "max_rounds": args.selection_max_rounds, "rms_tolerance": 0.01}
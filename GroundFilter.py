@@ -0,0 +1,394 @@
+"""
+Ground filter and DTM for exported point clouds, without Metashape.
+
+The cloud is streamed in chunks and reduced to the lowest point of every grid cell,
+which is all the filter needs. The reduced cells are spilled to one file per spatial
+tile, including a buffer around the tile, and the tiles are filtered in parallel by a
+progressive morphological filter (Zhang et al. 2003). Memory use depends on the chunk
+and tile size, not on the size of the cloud.
+
+The cloud has to be in a projected coordinate system with metres as unit; export it
+from Metashape with e.g. EPSG::2056 instead of EPSG::4326.
+"""
+import os
+import math
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# Same knobs and defaults as the ground classification in Geco2024GroundPointDTM.py
+DEFAULT_PARAMS = dict(
+    max_angle=40,
+    max_distance=2.5,
+    max_terrain_slope=35,
+    cell_size=20.0,
+    erosion_radius=0.5,
+)
+
+OUTPUT_NODATA = -32767.0
+
+# Reduced cells as spilled to the tile files: global cell column and row, lowest elevation
+CELL_DTYPE = np.dtype([("col", "<i4"), ("row", "<i4"), ("z", "<f4")])
+
+
+def read_ply_header(path):
+    """Parse the header of a binary little endian PLY file, returns the vertex dtype, count and data offset."""
+    types = {"char": "i1", "uchar": "u1", "short": "<i2", "ushort": "<u2", "int": "<i4", "uint": "<u4",
+             "float": "<f4", "double": "<f8", "int8": "i1", "uint8": "u1", "int16": "<i2", "uint16": "<u2",
+             "int32": "<i4", "uint32": "<u4", "float32": "<f4", "float64": "<f8"}
+    fields, count, element = [], 0, None
+    with open(path, 'rb') as file:
+        if file.readline().strip() != b"ply":
+            raise ValueError(f"Not a PLY file: {path}")
+        while True:
+            line = file.readline()
+            if not line:
+                raise ValueError(f"Truncated PLY header: {path}")
+            words = line.decode("ascii").split()
+            if not words:
+                continue
+            if words[0] == "format" and words[1] != "binary_little_endian":
+                raise ValueError(f"Only binary little endian PLY files are supported: {path}")
+            if words[0] == "element":
+                element = words[1]
+                if element == "vertex":
+                    count = int(words[2])
+                elif count == 0:
+                    raise ValueError(f"The vertices have to be the first element of the PLY file: {path}")
+            elif words[0] == "property" and element == "vertex":
+                if words[1] == "list":
+                    raise ValueError(f"List properties on vertices are not supported: {path}")
+                fields.append((words[2], types[words[1]]))
+            elif words[0] == "end_header":
+                return np.dtype(fields), count, file.tell()
+
+
+def cloud_bounds(path, chunk_points):
+    """(xmin, ymin, xmax, ymax) of the cloud, from the LAS header or from one pass over a PLY file."""
+    if path.lower().endswith(".ply"):
+        xmin = ymin = math.inf
+        xmax = ymax = -math.inf
+        for x, y, z in iter_points(path, chunk_points):
+            if x.size:
+                xmin, xmax = min(xmin, x.min()), max(xmax, x.max())
+                ymin, ymax = min(ymin, y.min()), max(ymax, y.max())
+        return xmin, ymin, xmax, ymax
+    import laspy
+    with laspy.open(path) as reader:
+        mins, maxs = reader.header.mins, reader.header.maxs
+    return mins[0], mins[1], maxs[0], maxs[1]
+
+
+def cloud_crs(path):
+    """Coordinate system stored in a LAS header, or None."""
+    if path.lower().endswith(".ply"):
+        return None
+    import laspy
+    try:
+        with laspy.open(path) as reader:
+            crs = reader.header.parse_crs()
+    except Exception:
+        # Parsing needs pyproj and a header with a valid coordinate system record
+        return None
+    return crs.to_wkt() if crs is not None else None
+
+
+def iter_points(path, chunk_points):
+    """Yield the x, y and z coordinates of the cloud in chunks of at most `chunk_points` points."""
+    if path.lower().endswith(".ply"):
+        dtype, count, offset = read_ply_header(path)
+        vertices = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+        for start in range(0, count, chunk_points):
+            block = vertices[start:start + chunk_points]
+            yield (np.asarray(block["x"], dtype=np.float64), np.asarray(block["y"], dtype=np.float64),
+                   np.asarray(block["z"], dtype=np.float64))
+        return
+    import laspy
+    with laspy.open(path) as reader:
+        for points in reader.chunk_iterator(chunk_points):
+            yield np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+
+
+def lowest_per_cell(cols, rows, z):
+    """Reduce points to the lowest one of every cell."""
+    key = cols.astype(np.int64) << 32 | rows.astype(np.int64) & 0xFFFFFFFF
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    return cols[order][starts], rows[order][starts], np.minimum.reduceat(z[order], starts)
+
+
+class TileGrid:
+    """
+    Global grid of `resolution` sized cells, divided into square tiles of `tile_cells` cells.
+
+    Cell rows count upwards from the southern edge of the cloud; the output raster is
+    aligned so that every tile is one window of it.
+    """
+
+    def __init__(self, bounds, resolution, tile_cells, buffer_cells):
+        self.xmin, self.ymin = bounds[0], bounds[1]
+        self.resolution = resolution
+        self.tile_cells = tile_cells
+        self.buffer_cells = buffer_cells
+        self.tiles_x = max(int(math.ceil((bounds[2] - bounds[0]) / resolution / tile_cells)), 1)
+        self.tiles_y = max(int(math.ceil((bounds[3] - bounds[1]) / resolution / tile_cells)), 1)
+
+    @property
+    def width(self):
+        return self.tiles_x * self.tile_cells
+
+    @property
+    def height(self):
+        return self.tiles_y * self.tile_cells
+
+    def transform(self):
+        return from_origin(self.xmin, self.ymin + self.height * self.resolution, self.resolution, self.resolution)
+
+    def cells(self, x, y):
+        cols = np.floor((x - self.xmin) / self.resolution).astype(np.int32)
+        rows = np.floor((y - self.ymin) / self.resolution).astype(np.int32)
+        np.clip(cols, 0, self.width - 1, out=cols)
+        np.clip(rows, 0, self.height - 1, out=rows)
+        return cols, rows
+
+    def window(self, tile_x, tile_y):
+        return Window(tile_x * self.tile_cells, (self.tiles_y - 1 - tile_y) * self.tile_cells,
+                      self.tile_cells, self.tile_cells)
+
+    def tile_path(self, spill_dir, tile_x, tile_y):
+        return os.path.join(spill_dir, f"tile_{tile_x}_{tile_y}.bin")
+
+
+def spill_cells(grid, cols, rows, z, spill_dir):
+    """Append reduced cells to the file of every tile whose buffered area contains them."""
+    tc, bc = grid.tile_cells, grid.buffer_cells
+    records = np.empty(cols.size, dtype=CELL_DTYPE)
+    records["col"], records["row"], records["z"] = cols, rows, z
+
+    # A cell belongs to every tile from (c - bc) // tc to (c + bc) // tc on each axis; that is
+    # two tiles per axis at most while the buffer is under half a tile, more for small tiles
+    index = np.arange(cols.size, dtype=np.int64)
+    first_x, last_x = (cols - bc) // tc, (cols + bc) // tc
+    first_y, last_y = (rows - bc) // tc, (rows + bc) // tc
+    span = 2 * bc // tc + 2
+    pairs = []
+    for dx in range(span):
+        for dy in range(span):
+            tiles_x, tiles_y = first_x + dx, first_y + dy
+            valid = ((tiles_x <= last_x) & (tiles_y <= last_y) & (tiles_x >= 0) & (tiles_x < grid.tiles_x)
+                     & (tiles_y >= 0) & (tiles_y < grid.tiles_y))
+            tile_keys = tiles_x[valid].astype(np.int64) * grid.tiles_y + tiles_y[valid]
+            pairs.append(tile_keys * cols.size + index[valid])
+    pairs = np.unique(np.concatenate(pairs))
+    tile_keys, record_index = np.divmod(pairs, cols.size)
+
+    starts = np.flatnonzero(np.r_[True, tile_keys[1:] != tile_keys[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], tile_keys.size]):
+        tile_x, tile_y = divmod(int(tile_keys[start]), grid.tiles_y)
+        with open(grid.tile_path(spill_dir, tile_x, tile_y), 'ab') as file:
+            records[record_index[start:end]].tofile(file)
+
+
+def _window_filter(surface, size, reduce):
+    """Square min or max filter of odd `size` cells, done separably on a padded copy."""
+    if size <= 1:
+        return surface.copy()
+    half = size // 2
+    fill = np.inf if reduce is np.min else -np.inf
+    padded = np.pad(surface, half, constant_values=fill)
+    rows = reduce(np.lib.stride_tricks.sliding_window_view(padded, size, axis=0), axis=-1)
+    return reduce(np.lib.stride_tricks.sliding_window_view(rows, size, axis=1), axis=-1)
+
+
+def morphological_opening(surface, size):
+    """Erosion then dilation; empty cells (inf) never raise the dilated surface."""
+    eroded = _window_filter(surface, size, np.min)
+    eroded[np.isinf(eroded)] = -np.inf
+    opened = _window_filter(eroded, size, np.max)
+    opened[np.isinf(opened)] = np.inf
+    return opened
+
+
+def window_sizes(resolution, cell_size):
+    """Window sizes in cells, doubling from 3 cells up to the size of the largest non-ground object."""
+    largest = max(int(round(cell_size / resolution)) | 1, 3)
+    sizes = [3]
+    while sizes[-1] < largest:
+        sizes.append(min(2 * sizes[-1] - 1, largest))
+    return sizes
+
+
+def ground_mask(lowest, resolution, max_angle, max_distance, max_terrain_slope, cell_size, erosion_radius):
+    """
+    Progressive morphological filter on a grid of the lowest elevation per cell (inf where empty).
+
+    The surface is opened with growing windows; a cell is non-ground as soon as it rises above
+    the opened surface by more than the threshold of the window. The threshold starts at the
+    height a `max_angle` slope rises over one cell and grows with the window at the
+    `max_terrain_slope`, capped at `max_distance`. Cells within `erosion_radius` of non-ground
+    cells are dropped from the ground as well.
+    """
+    slope = math.tan(math.radians(max_terrain_slope))
+    initial = min(math.tan(math.radians(max_angle)) * resolution, max_distance)
+    ground = np.isfinite(lowest)
+    surface = lowest
+    previous_size = 1
+    for size in window_sizes(resolution, cell_size):
+        opened = morphological_opening(surface, size)
+        threshold = min(initial + slope * (size - previous_size) * resolution, max_distance)
+        with np.errstate(invalid="ignore"):
+            # Empty cells are inf in both surfaces and compare as non-ground
+            ground &= (surface - opened) <= threshold
+        surface = opened
+        previous_size = size
+
+    radius = int(round(erosion_radius / resolution))
+    if radius > 0:
+        non_ground = (np.isfinite(lowest) & ~ground).astype(np.float32)
+        ground &= _window_filter(non_ground, 2 * radius + 1, np.max) == 0
+    return ground
+
+
+def fill_gaps(dtm, max_passes):
+    """Fill empty cells from the mean of their filled neighbours, one ring of cells per pass."""
+    for _ in range(max_passes):
+        empty = np.isnan(dtm)
+        if not empty.any():
+            break
+        values = np.pad(np.where(empty, 0.0, dtm), 1)
+        counts = np.pad((~empty).astype(np.float32), 1)
+        total = sum(values[1 + dy:values.shape[0] - 1 + dy, 1 + dx:values.shape[1] - 1 + dx]
+                    for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+        count = sum(counts[1 + dy:counts.shape[0] - 1 + dy, 1 + dx:counts.shape[1] - 1 + dx]
+                    for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+        fillable = empty & (count > 0)
+        if not fillable.any():
+            break
+        dtm[fillable] = total[fillable] / count[fillable]
+    return dtm
+
+
+def filter_tile(tile_path, tile_x, tile_y, tile_cells, buffer_cells, resolution, params, fill_passes):
+    """
+    Ground filter one tile with its buffer, returns the DTM of the tile without the buffer, top row
+    first, and the number of ground cells inside the tile; buffer cells belong to the neighbours.
+    """
+    size = tile_cells + 2 * buffer_cells
+    lowest = np.full((size, size), np.inf, dtype=np.float32)
+    records = np.fromfile(tile_path, dtype=CELL_DTYPE)
+    cols = records["col"] - (tile_x * tile_cells - buffer_cells)
+    rows = records["row"] - (tile_y * tile_cells - buffer_cells)
+    inside = (cols >= 0) & (cols < size) & (rows >= 0) & (rows < size)
+    # Cells may appear more than once, from different chunks of the cloud
+    np.minimum.at(lowest, (rows[inside], cols[inside]), records["z"][inside])
+
+    ground = ground_mask(lowest, resolution, **params)
+    dtm = np.where(ground, lowest, np.nan).astype(np.float32)
+    fill_gaps(dtm, fill_passes)
+    core = np.s_[buffer_cells:buffer_cells + tile_cells, buffer_cells:buffer_cells + tile_cells]
+    tile_dtm = dtm[core][::-1]
+    return (tile_x, tile_y, np.where(np.isnan(tile_dtm), OUTPUT_NODATA, tile_dtm).astype(np.float32),
+            int(ground[core].sum()))
+
+
+def build_dtm(cloud_path, output_path, resolution=0.5, tile_size=250.0, buffer=None, fill_distance=10.0,
+              workers=None, chunk_points=2_000_000, crs=None, **params):
+    """
+    Classify the ground of a point cloud and write the DTM as a GeoTIFF.
+
+    `buffer` (default: `cell_size`) is the overlap in metres read around every tile, so the
+    filter windows see the same surroundings at tile edges as in the middle of a tile.
+    Empty ground cells up to `fill_distance` metres from ground cells are interpolated.
+    """
+    params = dict(DEFAULT_PARAMS, **params)
+    workers = workers or os.cpu_count() or 1
+    tile_cells = max(int(round(tile_size / resolution)), 1)
+    buffer = params["cell_size"] if buffer is None else buffer
+    buffer_cells = int(math.ceil(buffer / resolution))
+    fill_passes = int(math.ceil(fill_distance / resolution))
+    crs = crs or cloud_crs(cloud_path)
+
+    grid = TileGrid(cloud_bounds(cloud_path, chunk_points), resolution, tile_cells, buffer_cells)
+    print(f"Grid of {grid.width} x {grid.height} cells in {grid.tiles_x * grid.tiles_y} tiles.")
+
+    spill_dir = tempfile.mkdtemp(prefix="ground_filter_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        points = 0
+        for x, y, z in iter_points(cloud_path, chunk_points):
+            if x.size == 0:
+                continue
+            cols, rows = grid.cells(x, y)
+            spill_cells(grid, *lowest_per_cell(cols, rows, z.astype(np.float32)), spill_dir)
+            points += x.size
+        print(f"Read {points} points.")
+
+        profile = dict(driver="GTiff", width=grid.width, height=grid.height, count=1, dtype="float32",
+                       nodata=OUTPUT_NODATA, transform=grid.transform(), crs=crs, tiled=True,
+                       blockxsize=256, blockysize=256, compress="deflate", predictor=3, BIGTIFF="IF_SAFER")
+        partial_path = output_path + ".partial"
+        ground_cells = 0
+        with rasterio.open(partial_path, "w", **profile) as dst, \
+                ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for tile_y in range(grid.tiles_y):
+                for tile_x in range(grid.tiles_x):
+                    tile_path = grid.tile_path(spill_dir, tile_x, tile_y)
+                    if not os.path.exists(tile_path):
+                        dst.write(np.full((grid.tile_cells, grid.tile_cells), OUTPUT_NODATA, dtype=np.float32), 1,
+                                  window=grid.window(tile_x, tile_y))
+                        continue
+                    # Bound the tiles held in memory by waiting for results before submitting more
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        ground_cells += _write_tiles(dst, grid, done)
+                    pending.add(executor.submit(filter_tile, tile_path, tile_x, tile_y, tile_cells, buffer_cells,
+                                                resolution, params, fill_passes))
+            ground_cells += _write_tiles(dst, grid, pending)
+        os.replace(partial_path, output_path)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    print(f"DTM written to {output_path} ({ground_cells} ground cells).")
+    return output_path
+
+
+def _write_tiles(dst, grid, futures):
+    ground_cells = 0
+    for future in futures:
+        tile_x, tile_y, block, tile_ground = future.result()
+        dst.write(block, 1, window=grid.window(tile_x, tile_y))
+        ground_cells += tile_ground
+    return ground_cells
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify the ground of a LAS/LAZ/PLY point cloud and build a DTM, without Metashape.")
+    parser.add_argument('cloud', help='Point cloud in a metric projected coordinate system (.las, .laz or binary .ply).')
+    parser.add_argument('output', help='DTM GeoTIFF to write.')
+    parser.add_argument('--resolution', type=float, default=0.5, help='DTM cell size in metres (default: 0.5).')
+    parser.add_argument('--max-angle', type=float, default=DEFAULT_PARAMS["max_angle"], help='Maximum angle in degrees.')
+    parser.add_argument('--max-distance', type=float, default=DEFAULT_PARAMS["max_distance"], help='Maximum distance to the terrain in metres.')
+    parser.add_argument('--max-terrain-slope', type=float, default=DEFAULT_PARAMS["max_terrain_slope"], help='Maximum terrain slope in degrees.')
+    parser.add_argument('--cell-size', type=float, default=DEFAULT_PARAMS["cell_size"], help='Size of the largest non-ground object in metres.')
+    parser.add_argument('--erosion-radius', type=float, default=DEFAULT_PARAMS["erosion_radius"], help='Erosion radius in metres.')
+    parser.add_argument('--tile-size', type=float, default=250.0, help='Tile size in metres (default: 250).')
+    parser.add_argument('--buffer', type=float, default=None, help='Overlap read around every tile in metres (default: the cell size).')
+    parser.add_argument('--fill-distance', type=float, default=10.0, help='Interpolate gaps up to this distance in metres (default: 10).')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: all cores).')
+    parser.add_argument('--crs', type=str, default=None, help='Coordinate system of the cloud for the GeoTIFF, e.g. EPSG:2056.')
+    args = parser.parse_args()
+
+    build_dtm(args.cloud, args.output, resolution=args.resolution, tile_size=args.tile_size, buffer=args.buffer,
+              fill_distance=args.fill_distance, workers=args.workers, crs=args.crs,
+              max_angle=args.max_angle, max_distance=args.max_distance, max_terrain_slope=args.max_terrain_slope,
+              cell_size=args.cell_size, erosion_radius=args.erosion_radius)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,98 @@
 import os
+import csv
+import string
+import argparse
 from pathlib import Path
 import datetime
 
+import RawIngest
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# This list defines all the subdirectories that will be created
+# within each specific flight folder.
+FLIGHT_SUB_STRUCTURE = [
+    "01_Raw/HS_Sensor_Data",
+    "01_Raw/Applanix_Raw_Data",
+    "01_Raw/SWIPOS_Base_Data",
+    "02_Processed/Processed_GPS_IMU",
+    "02_Processed/DEM",
+    "02_Processed/Processed_Images", # This is where ortho.ini and lidar.ini will go
+    "03_Results/Analysis_Products",
+    "03_Results/Reports_and_Logs",
+]
+INI_DIR = "02_Processed/Processed_Images"
+
+# Manifest columns naming the field drive folders, and where their data goes in the flight
+RAW_SOURCES = {
+    "hs_data": "01_Raw/HS_Sensor_Data",
+    "applanix_data": "01_Raw/Applanix_Raw_Data",
+    "swipos_data": "01_Raw/SWIPOS_Base_Data",
+}
+
+# Default content for ortho.ini and lidar.ini, used for sites without a template of their own
+ORTHO_INI = """Lens EFL (mm) = 8.02
+Ortho Lens EFL (mm) = 8.295
+Array Pixel Pitch (um) = 5.86
+Alpha (deg) = 0
+Beta (deg) = 0
+Gamma (deg) = 0
+Roll offset (deg) = -0.38
+Pitch offset (deg) = 0.2
+Yaw offset (deg) = 0
+Roll (right positive) = 1
+Pitch (front up positive) = 0
+Yaw (north-east positive) = 1
+Time Offset = 0
+Altitude Offset = 0
+Col binning = 1
+Correct Timestamps = 1
+Zero DEM = 0
+Invert Columns = 0
+Correct Position = 1
+saveOnlyLL = 1
+usePostProcess = 1
+usePPS = 0
+OrthoFieldsSensor = 0
+OrthoFieldsGpsUnit = 0
+geoidCorrection = 0"""
+
+LIDAR_INI = """[LidarTools]
+demInterpolate=true
+matchHsData=true
+demNoDataValue=-9999
+fromSeconds=146.09
+toSeconds=151.6
+rollOffset=90.17
+rollRightPositive=true
+pitchOffset=0.084
+pitchFrontUpPositive=false
+yawOffset=0.244
+yawNorthEastPositive=true
+gpsOffsetX=0.114
+gpsOffsetY=-0.022
+gpsOffsetZ=0.037
+timeOffset=0
+usePostProcessFile=true
+usePpsTxtFile=false
+saveTimestamps=true
+invertLaserAngle=false
+laserAngleRotation=0
+rotationalOffset=-90
+minRotationalAngle=0
+maxRotationalAngle=360
+minDistance=1
+minLaserAngle=-20
+maxLaserAngle=20
+maxIntensity=128
+doubleSpinBoxSpacing=0.25
+demOutputValues=mean"""
+DEFAULT_INI = {"ortho.ini": ORTHO_INI, "lidar.ini": LIDAR_INI}
+
+
 def create_project_structure():
     """
     Prompts the user for site, date, and flight ID, then creates
@@ -59,19 +150,24 @@ def create_project_structure():
     # Construct the flight folder name
     flight_folder_name = f"{flight_date_str}_{flight_id}"
 
-    # --- Define the core structure relative to the flight folder ---
-    # This list defines all the subdirectories that will be created
-    # within each specific flight folder.
-    flight_sub_structure = [
-        "01_Raw/HS_Sensor_Data",
-        "01_Raw/Applanix_Raw_Data",
-        "01_Raw/SWIPOS_Base_Data",
-        "02_Processed/Processed_GPS_IMU",
-        "02_Processed/DEM",
-        "02_Processed/Processed_Images", # This is where ortho.ini and lidar.ini will go
-        "03_Results/Analysis_Products",
-        "03_Results/Reports_and_Logs",
-    ]
+    create_flight_structure(main_project_path, site_name, flight_folder_name)
+
+
+def render_ini(name, site_name, templates_dir=None, values=None):
+    """
+    Content of ortho.ini or lidar.ini: the site's template (<templates>/<site>/<name>), else the
+    shared one (<templates>/<name>), else the default. $placeholders in a template, e.g.
+    fromSeconds=$from_seconds, are filled in from the flight's manifest columns.
+    """
+    for path in ([Path(templates_dir) / site_name / name, Path(templates_dir) / name] if templates_dir else []):
+        if path.exists():
+            return string.Template(path.read_text()).safe_substitute(values or {})
+    return DEFAULT_INI[name]
+
+
+def create_flight_structure(main_project_path, site_name, flight_folder_name, templates_dir=None, values=None):
+    """Create the folders of one flight with its ortho.ini and lidar.ini; returns the flight path, None if it already exists."""
+    main_project_path = Path(main_project_path)
 
     # --- Construct full paths ---
     site_path = main_project_path / site_name
@@ -99,92 +195,28 @@ def create_project_structure():
     if flight_path.exists():
         print(f"Warning: Flight folder '{flight_folder_name}' already exists for site '{site_name}'. Skipping creation.")
         print("You might want to choose a different Flight ID if this is a new mission.")
-        return
+        return None
 
     try:
         # Create the main flight folder
         flight_path.mkdir(parents=True, exist_ok=True) # exist_ok=True handles if site_path already exists
 
         # Create all subdirectories within the flight folder
-        for sub_dir in flight_sub_structure:
+        for sub_dir in FLIGHT_SUB_STRUCTURE:
             current_dir_path = flight_path / sub_dir
             current_dir_path.mkdir(parents=True, exist_ok=True)
             print(f"  Created: {current_dir_path}")
 
             # Special handling for 'Processed_Images' to create .ini files
-            if sub_dir == "02_Processed/Processed_Images":
-                # Content for ortho.ini
-                ortho_ini_content = """Lens EFL (mm) = 8.02
-Ortho Lens EFL (mm) = 8.295
-Array Pixel Pitch (um) = 5.86
-Alpha (deg) = 0
-Beta (deg) = 0
-Gamma (deg) = 0
-Roll offset (deg) = -0.38
-Pitch offset (deg) = 0.2
-Yaw offset (deg) = 0
-Roll (right positive) = 1
-Pitch (front up positive) = 0
-Yaw (north-east positive) = 1
-Time Offset = 0
-Altitude Offset = 0
-Col binning = 1
-Correct Timestamps = 1
-Zero DEM = 0
-Invert Columns = 0
-Correct Position = 1
-saveOnlyLL = 1
-usePostProcess = 1
-usePPS = 0
-OrthoFieldsSensor = 0
-OrthoFieldsGpsUnit = 0
-geoidCorrection = 0"""
-                ortho_ini_file_path = current_dir_path / "ortho.ini"
-                try:
-                    with open(ortho_ini_file_path, 'w') as f:
-                        f.write(ortho_ini_content)
-                    print(f"    Created file: {ortho_ini_file_path}")
-                except Exception as file_e:
-                    print(f"    Warning: Could not create ortho.ini file: {file_e}")
-
-                # Content for lidar.ini
-                lidar_ini_content = """[LidarTools]
-demInterpolate=true
-matchHsData=true
-demNoDataValue=-9999
-fromSeconds=146.09
-toSeconds=151.6
-rollOffset=90.17
-rollRightPositive=true
-pitchOffset=0.084
-pitchFrontUpPositive=false
-yawOffset=0.244
-yawNorthEastPositive=true
-gpsOffsetX=0.114
-gpsOffsetY=-0.022
-gpsOffsetZ=0.037
-timeOffset=0
-usePostProcessFile=true
-usePpsTxtFile=false
-saveTimestamps=true
-invertLaserAngle=false
-laserAngleRotation=0
-rotationalOffset=-90
-minRotationalAngle=0
-maxRotationalAngle=360
-minDistance=1
-minLaserAngle=-20
-maxLaserAngle=20
-maxIntensity=128
-doubleSpinBoxSpacing=0.25
-demOutputValues=mean"""
-                lidar_ini_file_path = current_dir_path / "lidar.ini"
-                try:
-                    with open(lidar_ini_file_path, 'w') as f:
-                        f.write(lidar_ini_content)
-                    print(f"    Created file: {lidar_ini_file_path}")
-                except Exception as file_e:
-                    print(f"    Warning: Could not create lidar.ini file: {file_e}")
+            if sub_dir == INI_DIR:
+                for name in ("ortho.ini", "lidar.ini"):
+                    ini_file_path = current_dir_path / name
+                    try:
+                        with open(ini_file_path, 'w') as f:
+                            f.write(render_ini(name, site_name, templates_dir, values))
+                        print(f"    Created file: {ini_file_path}")
+                    except Exception as file_e:
+                        print(f"    Warning: Could not create {name} file: {file_e}")
 
 
         print(f"\nSuccessfully created the folder structure for '{site_name}' flight '{flight_folder_name}'!")
@@ -193,7 +225,85 @@ demOutputValues=mean"""
     except Exception as e:
         print(f"\nAn error occurred while creating folders: {e}")
         print("Please check your permissions and the specified paths.")
+    return flight_path
 
-if __name__ == "__main__":
-    create_project_structure()
 
+def read_flight_manifest(manifest_path):
+    """
+    The flights of a CSV or YAML manifest, one dict per flight with at least site and date
+    (YYYYMMDD), optionally flight_id, main_folder and the field drive folders hs_data,
+    applanix_data and swipos_data. Further columns are available to the ini templates.
+    """
+    if manifest_path.lower().endswith((".yaml", ".yml")):
+        if yaml is None:
+            raise ImportError("Reading a YAML flight manifest needs PyYAML; use a CSV manifest instead.")
+        with open(manifest_path, 'r') as file:
+            flights = yaml.safe_load(file)
+        if isinstance(flights, dict):
+            flights = flights.get("flights", [])
+    else:
+        with open(manifest_path, 'r', newline='') as file:
+            flights = list(csv.DictReader(file))
+    rows = []
+    for number, flight in enumerate(flights, start=1):
+        flight = {key.strip(): str(value).strip() for key, value in flight.items() if value not in (None, "")}
+        if not flight.get("site") or not flight.get("date"):
+            raise ValueError(f"Flight {number} of {manifest_path} needs a site and a date.")
+        datetime.datetime.strptime(flight["date"], '%Y%m%d')
+        flight.setdefault("flight_id", "Flight1")
+        rows.append(flight)
+    return rows
+
+
+def create_flights_from_manifest(manifest_path, main_folder=None, templates_dir=None, workers=4, verify=True):
+    """
+    Create the folders of every flight in the manifest and ingest its raw data from the field drives.
+
+    Flights that already exist keep their folders, but their raw data is still ingested;
+    the ingest skips files it copied before, so an interrupted offload resumes where it stopped.
+    Returns the number of files that failed to copy.
+    """
+    flights = read_flight_manifest(manifest_path)
+    print(f"--- Creating {len(flights)} flights from {manifest_path} ---")
+    failed = 0
+    for flight in flights:
+        main_project_path = flight.get("main_folder") or main_folder
+        if not main_project_path:
+            raise ValueError(f"No main project folder for {flight['site']} {flight['date']}; pass --main-folder.")
+        flight_folder_name = f"{flight['date']}_{flight['flight_id']}"
+        flight_path = Path(main_project_path) / flight["site"] / flight_folder_name
+        create_flight_structure(main_project_path, flight["site"], flight_folder_name, templates_dir, flight)
+        for column, sub_dir in RAW_SOURCES.items():
+            if flight.get(column):
+                if not os.path.isdir(flight[column]):
+                    print(f"Warning: {column} folder '{flight[column]}' not found. Skipping.")
+                    failed += 1
+                    continue
+                result = RawIngest.ingest(flight[column], str(flight_path / sub_dir), workers=workers, verify=verify)
+                failed += result["failed"]
+    print(f"\n--- {len(flights)} flights done, {failed} file(s) or folder(s) failed ---")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the hyperspectral flight folder structure, interactively or from a flight manifest.")
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='CSV or YAML flight manifest (site, date, flight_id, main_folder, hs_data, applanix_data, '
+                             'swipos_data); without it the folders of one flight are asked for interactively.')
+    parser.add_argument('--main-folder', type=str, default=None, help='Main project folder for flights without a main_folder column.')
+    parser.add_argument('--templates', type=str, default=None,
+                        help='Folder of ini templates: <templates>/<site>/ortho.ini and lidar.ini, or shared ones in <templates>.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of files copied at the same time (default: 4).')
+    parser.add_argument('--no-verify', action='store_true', help='Do not read the copies back to compare their checksum.')
+    args = parser.parse_args()
+
+    if args.manifest is None:
+        create_project_structure()
+        return
+    failed = create_flights_from_manifest(args.manifest, args.main_folder, args.templates, workers=args.workers,
+                                          verify=not args.no_verify)
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
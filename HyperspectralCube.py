@@ -0,0 +1,252 @@
+"""
+Reader for the raw hyperspectral cubes in 01_Raw/HS_Sensor_Data, without loading them.
+
+A cube is an ENVI header (.hdr) next to a binary file with the pixels interleaved by line
+(BIL), by pixel (BIP) or by band (BSQ). The binary file is memory-mapped and exposed as a
+(lines, samples, bands) array whatever the interleave; lines, bands and spectra are views
+into the mapping, so only the pages that are touched are read from disk. Band statistics
+are computed on first use and then kept, and `iter_lines` walks a cube in blocks of lines
+for processing that streams through a flight.
+"""
+import os
+import re
+import csv
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ENVI data type codes
+ENVI_DTYPES = {1: "u1", 2: "i2", 3: "i4", 4: "f4", 5: "f8", 12: "u2", 13: "u4", 14: "i8", 15: "u8"}
+# Extensions of the binary file next to a header; the header stem without extension comes first
+DATA_EXTENSIONS = ("", ".raw", ".bil", ".bip", ".bsq", ".img", ".dat")
+# Lines per block when streaming; a block of a 640-sample, 270-band uint16 cube is about 88 MB
+DEFAULT_CHUNK_LINES = 256
+STAT_FIELDS = ["cube", "band", "wavelength", "count", "mean", "std", "min", "max"]
+
+
+def read_header(path):
+    """Fields of an ENVI header as a dict with lowercase keys; {...} values become lists of strings."""
+    with open(path, 'r', errors='replace') as file:
+        text = file.read()
+    if not text.lstrip().startswith("ENVI"):
+        raise ValueError(f"{path} is not an ENVI header.")
+    header = {}
+    for match in re.finditer(r"^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)", text, re.MULTILINE):
+        key, value = match.group(1).strip().lower(), match.group(2).strip()
+        if value.startswith("{"):
+            value = [item.strip() for item in value[1:-1].split(",") if item.strip()]
+        header[key] = value
+    return header
+
+
+def data_path(header_path):
+    """Binary file belonging to a header: same name without .hdr, or with one of the usual extensions."""
+    stem = os.path.splitext(header_path)[0]
+    for extension in DATA_EXTENSIONS:
+        candidate = stem + extension
+        if os.path.isfile(candidate) and candidate != header_path:
+            return candidate
+    raise FileNotFoundError(f"No data file found for {header_path}.")
+
+
+def header_path(path):
+    """Header belonging to a header or binary file path."""
+    if path.lower().endswith(".hdr"):
+        return path
+    for candidate in (path + ".hdr", os.path.splitext(path)[0] + ".hdr"):
+        if os.path.isfile(candidate):
+            return candidate
+    raise FileNotFoundError(f"No ENVI header found for {path}.")
+
+
+def find_cubes(folder):
+    """Headers of all cubes below a folder, e.g. <flight>/01_Raw/HS_Sensor_Data."""
+    cubes = []
+    for root, dirs, names in os.walk(folder):
+        dirs.sort()
+        for name in sorted(names):
+            if name.lower().endswith(".hdr"):
+                path = os.path.join(root, name)
+                try:
+                    data_path(path)
+                except FileNotFoundError:
+                    continue
+                cubes.append(path)
+    return cubes
+
+
+class HyperspectralCube:
+    """
+    Memory-mapped ENVI cube, read-only.
+
+    `data` is a (lines, samples, bands) view of the file. Indexing it with integers or slices
+    returns views without copying; which access is fast depends on the interleave: a line
+    is contiguous in BIL and BIP, a band in BSQ, a spectrum in BIP.
+    """
+
+    def __init__(self, path):
+        if np is None:
+            raise ImportError("Reading hyperspectral cubes needs numpy.")
+        self.header_path = header_path(path)
+        self.path = data_path(self.header_path)
+        self.header = read_header(self.header_path)
+        self.lines = int(self.header["lines"])
+        self.samples = int(self.header["samples"])
+        self.bands = int(self.header["bands"])
+        self.interleave = self.header.get("interleave", "bsq").lower()
+        dtype = np.dtype(ENVI_DTYPES[int(self.header["data type"])])
+        self.dtype = dtype.newbyteorder(">" if self.header.get("byte order", "0") == "1" else "<")
+        self.wavelengths = [float(value) for value in self.header.get("wavelength", [])] or None
+        self.band_names = self.header.get("band names") or [f"band_{index + 1}" for index in range(self.bands)]
+        ignore = self.header.get("data ignore value")
+        self.ignore_value = float(ignore) if ignore not in (None, "") else None
+
+        # File layout per interleave, and the axes that turn it into (lines, samples, bands)
+        shape, axes = {"bil": ((self.lines, self.bands, self.samples), (0, 2, 1)),
+                       "bip": ((self.lines, self.samples, self.bands), (0, 1, 2)),
+                       "bsq": ((self.bands, self.lines, self.samples), (1, 2, 0))}[self.interleave]
+        offset = int(self.header.get("header offset", 0))
+        expected = offset + int(np.prod(shape)) * self.dtype.itemsize
+        if os.path.getsize(self.path) < expected:
+            raise ValueError(f"{self.path} is truncated: {os.path.getsize(self.path)} of {expected} bytes.")
+        self.raw = np.memmap(self.path, dtype=self.dtype, mode='r', offset=offset, shape=shape)
+        self.data = self.raw.transpose(axes)
+        self._statistics = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return (f"HyperspectralCube({self.path!r}, {self.lines} lines x {self.samples} samples x {self.bands} bands, "
+                f"{self.interleave.upper()}, {self.dtype})")
+
+    @property
+    def nbytes(self):
+        return self.raw.nbytes
+
+    def close(self):
+        """Release the memory mapping; views taken from the cube must not be used afterwards."""
+        mmap = getattr(self.raw, "_mmap", None)
+        self.raw = self.data = None
+        if mmap is not None:
+            try:
+                mmap.close()
+            except BufferError:
+                # Views are still alive; the mapping is closed when they are released
+                pass
+
+    def band_index(self, wavelength):
+        """Index of the band closest to a wavelength in the unit of the header (usually nm)."""
+        if self.wavelengths is None:
+            raise ValueError(f"{self.header_path} lists no wavelengths.")
+        return int(np.argmin(np.abs(np.asarray(self.wavelengths) - wavelength)))
+
+    def band(self, index):
+        """(lines, samples) view of one band."""
+        return self.data[:, :, index]
+
+    def line(self, index):
+        """(samples, bands) view of one scan line."""
+        return self.data[index]
+
+    def spectrum(self, line, sample):
+        """(bands,) view of the spectrum of one pixel."""
+        return self.data[line, sample]
+
+    def window(self, lines=slice(None), samples=slice(None), bands=slice(None)):
+        """View of a range of lines, samples and bands; lists of bands copy the selected values."""
+        return self.data[lines, samples, bands]
+
+    def iter_lines(self, chunk_lines=DEFAULT_CHUNK_LINES, bands=slice(None), start=0, stop=None):
+        """
+        Walk the cube in blocks of lines: yields (first line, (n, samples, bands) array).
+
+        The blocks are views for a band slice and copies of only the block for a list of bands,
+        so memory use is bounded by the block size, not by the size of the cube.
+        """
+        stop = self.lines if stop is None else min(stop, self.lines)
+        for first in range(start, stop, chunk_lines):
+            yield first, self.data[first:min(first + chunk_lines, stop), :, bands]
+
+    def statistics(self, bands=None, chunk_lines=DEFAULT_CHUNK_LINES):
+        """
+        Count, mean, standard deviation, minimum and maximum of each band, without the ignore value.
+
+        Only bands not asked for before are computed, in one pass over the lines for all of them,
+        accumulated per block in float64. Returns a dict keyed by band index.
+        """
+        bands = list(range(self.bands)) if bands is None else [int(band) for band in bands]
+        missing = [band for band in bands if band not in self._statistics]
+        if missing:
+            count = np.zeros(len(missing), dtype=np.int64)
+            total = np.zeros(len(missing))
+            squares = np.zeros(len(missing))
+            low = np.full(len(missing), np.inf)
+            high = np.full(len(missing), -np.inf)
+            selection = slice(missing[0], missing[-1] + 1) if missing == list(range(missing[0], missing[-1] + 1)) else missing
+            for _, block in self.iter_lines(chunk_lines, bands=selection):
+                values = block.reshape(-1, len(missing)).astype(np.float64)
+                valid = np.isfinite(values)
+                if self.ignore_value is not None:
+                    valid &= values != self.ignore_value
+                count += valid.sum(axis=0)
+                total += np.where(valid, values, 0).sum(axis=0)
+                squares += np.where(valid, values * values, 0).sum(axis=0)
+                low = np.minimum(low, np.where(valid, values, np.inf).min(axis=0, initial=np.inf))
+                high = np.maximum(high, np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf))
+            for position, band in enumerate(missing):
+                n = int(count[position])
+                mean = total[position] / n if n else float("nan")
+                variance = max(squares[position] / n - mean * mean, 0.0) if n else float("nan")
+                self._statistics[band] = {"count": n, "mean": mean, "std": variance ** 0.5,
+                                          "min": low[position] if n else float("nan"),
+                                          "max": high[position] if n else float("nan")}
+        return {band: self._statistics[band] for band in bands}
+
+    def band_statistics(self, index):
+        return self.statistics([index])[index]
+
+
+def write_statistics(cube, path, bands=None):
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=STAT_FIELDS)
+        writer.writeheader()
+        for band, stats in cube.statistics(bands).items():
+            wavelength = cube.wavelengths[band] if cube.wavelengths else ""
+            writer.writerow({"cube": os.path.basename(cube.path), "band": cube.band_names[band],
+                             "wavelength": wavelength, **stats})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize raw hyperspectral cubes (ENVI header with BIL/BIP/BSQ data).")
+    parser.add_argument('paths', nargs='+', help='Cube headers or data files, or folders such as <flight>/01_Raw/HS_Sensor_Data.')
+    parser.add_argument('--stats', action='store_true', help='Write the band statistics of each cube to <cube>_bandstats.csv.')
+    parser.add_argument('--wavelengths', type=float, nargs='+', default=None,
+                        help='Only the bands closest to these wavelengths (with --stats).')
+    parser.add_argument('--chunk-lines', type=int, default=DEFAULT_CHUNK_LINES, help='Lines read at once for the statistics.')
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.paths:
+        paths.extend(find_cubes(path) if os.path.isdir(path) else [path])
+    for path in paths:
+        with HyperspectralCube(path) as cube:
+            span = f", {cube.wavelengths[0]:.1f}-{cube.wavelengths[-1]:.1f}" if cube.wavelengths else ""
+            print(f"{cube.path}: {cube.lines} lines x {cube.samples} samples x {cube.bands} bands{span}, "
+                  f"{cube.interleave.upper()} {cube.dtype.name}, {cube.nbytes / 1024 ** 3:.2f} GB")
+            if args.stats:
+                bands = sorted({cube.band_index(w) for w in args.wavelengths}) if args.wavelengths else None
+                cube.statistics(bands, chunk_lines=args.chunk_lines)
+                output_path = os.path.splitext(cube.path)[0] + "_bandstats.csv"
+                write_statistics(cube, output_path, bands)
+                print(f"  Band statistics: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+import os
+import re
+import json
+import struct
+import argparse
+import collections
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from ProjectInspector import files_dir, read_zip_xml
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".geco_image_cache.json")
+
+# Bumped whenever the recorded fields change, so cached headers are read again
+VALIDATION_FORMAT = 2
+
+# Horizontal GPS accuracy in metres above which the reference is flagged as too coarse for the alignment
+GPS_ACCURACY_WARNING = 5.0
+# Capture gaps longer than this many seconds are flagged: the flight may be incomplete or two flights mixed
+TIME_GAP_WARNING = 300
+
+TIFF_TYPE_FORMATS = {1: "B", 2: "s", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d", 13: "I",
+                     16: "Q", 17: "q", 18: "Q"}
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8}
+# A JPEG may be followed by a preview image (DJI MPF) or padding; its end marker has to be
+# within this many bytes of the end of the file
+JPEG_TAIL_SIZE = 256 * 1024
+# Altum and other multi-camera files are named <capture number>_<band number>.tif, e.g. IMG_0001_1.tif
+BAND_SUFFIX = re.compile(r"(?<=\d)_(\d{1,2})$")
+XMP_ATTRIBUTE = re.compile(r'([\w-]+):(\w+)="([^"]*)"')
+XMP_ELEMENT = re.compile(r"<([\w-]+):(\w+)>([^<]*)</\1:\2>")
+
+
+class CorruptImage(Exception):
+    pass
+
+
+def _read(file, size):
+    data = file.read(size)
+    if len(data) < size:
+        raise CorruptImage("file is truncated")
+    return data
+
+
+class _TiffReader:
+    """
+    Reads the tags of a TIFF structure, either a whole file or the Exif block inside a JPEG.
+    BigTIFF files (version 43, written for images above 4 GB) have 8-byte offsets and counts.
+    """
+
+    def __init__(self, file, base=0):
+        self.file = file
+        self.base = base
+        file.seek(base)
+        order = _read(file, 2)
+        if order not in (b"II", b"MM"):
+            raise CorruptImage("not a TIFF header")
+        self.endian = "<" if order == b"II" else ">"
+        magic = struct.unpack(self.endian + "H", _read(file, 2))[0]
+        if magic == 42:
+            self.first_ifd = struct.unpack(self.endian + "I", _read(file, 4))[0]
+            self.offset_format, self.count_format, self.field_size = "I", "H", 4
+        elif magic == 43:
+            offset_size, _, self.first_ifd = struct.unpack(self.endian + "HHQ", _read(file, 12))
+            if offset_size != 8:
+                raise CorruptImage(f"unsupported BigTIFF offset size {offset_size}")
+            self.offset_format, self.count_format, self.field_size = "Q", "Q", 8
+        else:
+            raise CorruptImage(f"unsupported TIFF version {magic}")
+
+    def ifd(self, offset):
+        """The entries of an image file directory: {tag: (type, count, value or offset field)}."""
+        self.file.seek(self.base + offset)
+        count_size = struct.calcsize(self.count_format)
+        count = struct.unpack(self.endian + self.count_format, _read(self.file, count_size))[0]
+        entry_format = self.endian + "HH" + self.offset_format + f"{self.field_size}s"
+        entry_size = struct.calcsize(entry_format)
+        data = _read(self.file, entry_size * count)
+        entries = {}
+        for i in range(count):
+            tag, kind, number, raw = struct.unpack(entry_format, data[entry_size * i:entry_size * (i + 1)])
+            if kind in TIFF_TYPE_SIZES:
+                entries[tag] = (kind, number, raw)
+        return entries
+
+    def value(self, entry):
+        kind, number, raw = entry
+        size = TIFF_TYPE_SIZES[kind] * number
+        if size > self.field_size:
+            self.file.seek(self.base + struct.unpack(self.endian + self.offset_format, raw)[0])
+            raw = _read(self.file, size)
+        else:
+            raw = raw[:size]
+        if kind == 2:
+            return raw.split(b"\0", 1)[0].decode("ascii", "replace").strip()
+        if kind in (1, 7):
+            return raw
+        values = struct.unpack(self.endian + TIFF_TYPE_FORMATS[kind] * number, raw)
+        if kind in (5, 10):
+            return [a / b if b else None for a, b in zip(values[::2], values[1::2])]
+        return list(values)
+
+
+def _degrees(dms, ref):
+    if not dms or None in dms:
+        return None
+    value = dms[0] + dms[1] / 60 + dms[2] / 3600
+    return -value if ref in ("S", "W") else value
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_xmp(xmp):
+    """The properties of an XMP packet as {'namespace:name': value}, from attributes and simple elements."""
+    text = xmp.decode("utf-8", "replace") if isinstance(xmp, bytes) else xmp
+    properties = {f"{ns}:{name}": value for ns, name, value in XMP_ATTRIBUTE.findall(text)}
+    properties.update({f"{ns}:{name}": value.strip() for ns, name, value in XMP_ELEMENT.findall(text)})
+    return properties
+
+
+def read_exif(reader, ifd0, header):
+    """Timestamp, exposure and GPS position of the Exif and GPS directories of IFD0."""
+    if 306 in ifd0:
+        header["datetime"] = reader.value(ifd0[306])
+    if 34665 in ifd0:
+        exif = reader.ifd(reader.value(ifd0[34665])[0])
+        if 36867 in exif:
+            header["datetime"] = reader.value(exif[36867])
+        if 33434 in exif:
+            header["exposure"] = reader.value(exif[33434])[0]
+    if 34853 in ifd0:
+        gps = reader.ifd(reader.value(ifd0[34853])[0])
+        if 2 in gps and 4 in gps:
+            latitude = _degrees(reader.value(gps[2]), reader.value(gps[1]) if 1 in gps else "N")
+            longitude = _degrees(reader.value(gps[4]), reader.value(gps[3]) if 3 in gps else "E")
+            if latitude is not None and longitude is not None and (latitude, longitude) != (0.0, 0.0):
+                altitude = reader.value(gps[6])[0] if 6 in gps else None
+                header["gps"] = [latitude, longitude, altitude]
+
+
+def read_xmp_fields(xmp, header):
+    """Band name and GPS accuracy from the XMP of MicaSense (Camera:) or DJI (drone-dji:) images."""
+    properties = parse_xmp(xmp)
+    header["band_name"] = properties.get("Camera:BandName")
+    xy = _number(properties.get("Camera:GPSXYAccuracy"))
+    z = _number(properties.get("Camera:GPSZAccuracy"))
+    if xy is None and "drone-dji:RtkStdLon" in properties:
+        xy = max(filter(None, [_number(properties.get("drone-dji:RtkStdLon")),
+                               _number(properties.get("drone-dji:RtkStdLat"))]), default=None)
+        z = _number(properties.get("drone-dji:RtkStdHgt"))
+    header["xy_accuracy"], header["z_accuracy"] = xy, z
+
+
+def read_tiff_header(file, size, header):
+    reader = _TiffReader(file)
+    ifd0 = reader.ifd(reader.first_ifd)
+    header["type"] = "tiff"
+    header["width"] = reader.value(ifd0[256])[0] if 256 in ifd0 else None
+    header["height"] = reader.value(ifd0[257])[0] if 257 in ifd0 else None
+    header["samples"] = reader.value(ifd0[277])[0] if 277 in ifd0 else 1
+    header["bits"] = reader.value(ifd0[258])[0] if 258 in ifd0 else 1
+    # The pixel data has to end within the file, otherwise the copy is truncated
+    for offsets_tag, counts_tag in ((273, 279), (324, 325)):
+        if offsets_tag in ifd0 and counts_tag in ifd0:
+            end = max(o + c for o, c in zip(reader.value(ifd0[offsets_tag]), reader.value(ifd0[counts_tag])))
+            if end > size:
+                raise CorruptImage(f"image data ends at byte {end} of {size}")
+    read_exif(reader, ifd0, header)
+    if 700 in ifd0:
+        read_xmp_fields(reader.value(ifd0[700]), header)
+
+
+def read_jpeg_header(file, size, header):
+    header["type"] = "jpeg"
+    file.seek(2)
+    while True:
+        marker, length = struct.unpack(">2sH", _read(file, 4))
+        if marker[0] != 0xFF:
+            raise CorruptImage("invalid JPEG marker")
+        start = file.tell()
+        if marker[1] == 0xE1:
+            data = _read(file, length - 2)
+            if data.startswith(b"Exif\0\0"):
+                reader = _TiffReader(file, start + 6)
+                read_exif(reader, reader.ifd(reader.first_ifd), header)
+            elif data.startswith(b"http://ns.adobe.com/xap/1.0/\0"):
+                read_xmp_fields(data, header)
+        elif marker[1] in (0xC0, 0xC1, 0xC2):
+            bits, height, width, samples = struct.unpack(">BHHB", _read(file, 6))
+            header.update(bits=bits, height=height, width=width, samples=samples)
+        elif marker[1] == 0xDA:
+            break
+        file.seek(start + length - 2)
+    # Entropy-coded data never contains FF D9, so an end marker after the start of the scan
+    # (and not in the Exif thumbnail) near the end of the file means the image is complete
+    tail_start = max(file.tell(), size - JPEG_TAIL_SIZE)
+    file.seek(tail_start)
+    if b"\xff\xd9" not in _read(file, size - tail_start):
+        raise CorruptImage("JPEG end marker missing, file is truncated")
+
+
+def read_image_header(path):
+    """
+    The header, Exif and XMP of one image: size, band count, bit depth, band name, timestamp,
+    exposure, GPS position and accuracy. Only the headers are read, not the pixels; a file
+    that cannot be read or is shorter than its header says is reported in "error".
+    """
+    header = {"path": path, "format": VALIDATION_FORMAT, "size": None, "mtime": None, "error": None, "type": None,
+              "width": None, "height": None, "samples": None, "bits": None, "band_name": None, "datetime": None,
+              "exposure": None, "gps": None, "xy_accuracy": None, "z_accuracy": None}
+    try:
+        stat = os.stat(path)
+        header["size"], header["mtime"] = stat.st_size, stat.st_mtime
+        with open(path, 'rb') as file:
+            magic = file.read(4)
+            if magic[:2] in (b"II", b"MM"):
+                read_tiff_header(file, stat.st_size, header)
+            elif magic[:2] == b"\xff\xd8":
+                read_jpeg_header(file, stat.st_size, header)
+            else:
+                raise CorruptImage("neither TIFF nor JPEG")
+    except FileNotFoundError:
+        header["error"] = "missing"
+    except (CorruptImage, struct.error, OSError, KeyError, IndexError, ValueError) as e:
+        header["error"] = f"corrupt: {e}"
+    return header
+
+
+class ImageCache:
+    """JSON cache of image headers, an entry is reused while the file keeps its size and time."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+
+    def get(self, path):
+        entry = self.entries.get(os.path.abspath(path))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if (entry is not None and entry.get("format") == VALIDATION_FORMAT
+                and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime):
+            return entry
+        return None
+
+    def put(self, header):
+        self.entries[os.path.abspath(header["path"])] = header
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(tmp_path, self.path)
+
+
+def read_image_headers(paths, cache=None, workers=16):
+    """Headers of many images, read concurrently; unchanged files come from the cache."""
+    cache = cache or ImageCache(None)
+    headers = {}
+    to_read = []
+    for path in paths:
+        cached = cache.get(path)
+        if cached is not None:
+            headers[path] = cached
+        else:
+            to_read.append(path)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for header in executor.map(read_image_header, to_read):
+            headers[header["path"]] = header
+            if header["error"] is None:
+                cache.put(header)
+    print(f"Read {len(to_read)} image headers, {len(paths) - len(to_read)} taken from the cache.")
+    return [headers[path] for path in paths]
+
+
+def chunk_images(project_path):
+    """Image paths of the enabled chunks of a project, read from its files: [(chunk label, paths)]."""
+    project_zip = os.path.join(files_dir(project_path), "project.zip")
+    if not os.path.exists(project_zip):
+        raise FileNotFoundError(f"Project data missing: {project_zip}")
+    chunks = read_zip_xml(project_zip).find("chunks")
+    images = []
+    for chunk in (chunks.findall("chunk") if chunks is not None else []):
+        chunk_zip = os.path.join(os.path.dirname(project_zip), chunk.get("path"))
+        root = read_zip_xml(chunk_zip)
+        if root.get("enabled", "true") != "true":
+            continue
+        paths = []
+        frames = root.find("frames")
+        for frame in (frames.findall("frame") if frames is not None else []):
+            frame_zip = os.path.join(os.path.dirname(chunk_zip), frame.get("path"))
+            for photo in read_zip_xml(frame_zip).iter("photo"):
+                path = photo.get("path")
+                if path:
+                    # Relative photo paths are stored relative to the frame
+                    paths.append(os.path.normpath(os.path.join(os.path.dirname(frame_zip), path)))
+        images.append((root.get("label", ""), paths))
+    return images
+
+
+def _timestamp(value):
+    try:
+        return datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def capture_key(header):
+    return BAND_SUFFIX.sub("", os.path.splitext(header["path"])[0])
+
+
+def band_key(header):
+    """The band of an image: its XMP band name, or the band number of its file name."""
+    if header["band_name"]:
+        return header["band_name"]
+    match = BAND_SUFFIX.search(os.path.splitext(header["path"])[0])
+    return match.group(1) if match else ""
+
+
+def check_chunk(label, headers):
+    """Errors that reject a chunk (missing or corrupt images, no GPS at all) and warnings that flag it."""
+    errors, warnings = [], []
+    prefix = f"chunk {label}: "
+    if not headers:
+        return [prefix + "no images"], warnings, {"images": 0}
+    broken = [h for h in headers if h["error"]]
+    for kind in ("missing", "corrupt"):
+        failed = [h["path"] for h in broken if h["error"].startswith(kind)]
+        if failed:
+            errors.append(prefix + f"{len(failed)} {kind} image(s), e.g. {failed[0]}")
+    readable = [h for h in headers if not h["error"]]
+
+    # Multi-camera captures whose band files are not all there
+    captures = collections.Counter(capture_key(h) for h in headers)
+    bands = max(captures.values())
+    incomplete = sorted(capture for capture, count in captures.items() if count < bands)
+    if incomplete:
+        warnings.append(prefix + f"{len(incomplete)} of {len(captures)} captures lack bands, e.g. {incomplete[0]}")
+
+    # Every band keeps the same bit depth and size through the flight
+    by_band = collections.defaultdict(set)
+    for h in readable:
+        by_band[band_key(h)].add((h["bits"], h["samples"], h["width"], h["height"]))
+    mixed = sorted(band or "?" for band, formats in by_band.items() if len(formats) > 1)
+    if mixed:
+        warnings.append(prefix + f"band(s) {', '.join(mixed)} change bit depth or size within the flight")
+
+    without_gps = [h for h in readable if h["gps"] is None]
+    if readable and len(without_gps) == len(readable):
+        errors.append(prefix + "no image has a GPS position, the alignment has no reference")
+    elif without_gps:
+        warnings.append(prefix + f"{len(without_gps)} image(s) without GPS position")
+    accuracies = sorted(h["xy_accuracy"] for h in readable if h["xy_accuracy"] is not None)
+    median_accuracy = accuracies[len(accuracies) // 2] if accuracies else None
+    if median_accuracy is not None and median_accuracy > GPS_ACCURACY_WARNING:
+        warnings.append(prefix + f"median GPS accuracy {median_accuracy:.1f} m, no RTK fix")
+
+    times = sorted(t for t in (_timestamp(h["datetime"]) for h in readable) if t is not None)
+    if len(times) < len(readable):
+        warnings.append(prefix + f"{len(readable) - len(times)} image(s) without timestamp")
+    gaps = [(b - a).total_seconds() for a, b in zip(times, times[1:])]
+    if gaps and max(gaps) > TIME_GAP_WARNING:
+        warnings.append(prefix + f"{max(gaps) / 60:.0f} min gap between captures, flights may be mixed")
+    exposures = [h["exposure"] for h in readable if h["exposure"]]
+
+    summary = {"images": len(headers), "captures": len(captures), "bands": bands,
+               "band_names": sorted(b for b in by_band if b), "gps_accuracy_m": median_accuracy,
+               "start": times[0].isoformat() if times else None, "end": times[-1].isoformat() if times else None,
+               "exposure_s": [min(exposures), max(exposures)] if exposures else None}
+    return errors, warnings, summary
+
+
+def validate_project(project_path, cache=None, workers=16):
+    """
+    Pre-flight check of the images of a project: "rejected" with errors that would make the
+    alignment fail or go wrong, "flagged" with warnings worth a look, otherwise "ok".
+    """
+    report = {"project": project_path, "status": "ok", "errors": [], "warnings": [], "chunks": {}}
+    try:
+        chunks = chunk_images(project_path)
+    except Exception as e:
+        report.update(status="rejected", errors=[f"project cannot be read: {type(e).__name__}: {e}"])
+        return report
+    for label, paths in chunks:
+        errors, warnings, summary = check_chunk(label, read_image_headers(paths, cache, workers))
+        report["errors"] += errors
+        report["warnings"] += warnings
+        report["chunks"][label] = summary
+    if report["errors"]:
+        report["status"] = "rejected"
+    elif report["warnings"]:
+        report["status"] = "flagged"
+    return report
+
+
+def write_report(report):
+    """Write the pre-flight report to logs/<project>_preflight.json next to the project."""
+    log_dir = os.path.join(os.path.dirname(report["project"]), "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    project_name = os.path.splitext(os.path.basename(report["project"]))[0]
+    path = os.path.join(log_dir, f"{project_name}_preflight.json")
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+    return path
+
+
+def validate_projects(project_paths, cache_path=DEFAULT_CACHE_PATH, workers=16):
+    """Check the images of many projects before they are processed; returns the report per project."""
+    cache = ImageCache(cache_path)
+    reports = {}
+    for project_path in project_paths:
+        report = validate_project(project_path, cache, workers)
+        write_report(report)
+        for message in report["errors"] + report["warnings"]:
+            print(f"Pre-flight {report['status']}: {message} ({project_path})")
+        reports[project_path] = report
+    cache.save()
+    counts = collections.Counter(report["status"] for report in reports.values())
+    print("Pre-flight check: " + ", ".join(f"{status}: {count}" for status, count in sorted(counts.items())))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the images of Metashape projects before processing them.")
+    parser.add_argument('projects', nargs='+', help='.psx project files to check.')
+    parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_PATH, help='Path of the image header cache.')
+    parser.add_argument('--workers', type=int, default=16, help='Number of images read at the same time (default: 16).')
+    args = parser.parse_args()
+
+    reports = validate_projects(args.projects, args.cache, args.workers)
+    raise SystemExit(1 if any(report["status"] == "rejected" for report in reports.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from StageMetrics import StageMetrics
+
+
+def run_post_jobs(project_path, jobs):
+    """Run the deferred post-processing steps of one project; returns their stage records and the first error."""
+    metrics = StageMetrics(project_path, measure_writes=any(job.get("measure_writes") for job in jobs))
+    try:
+        for job in jobs:
+            with metrics.record(job["stage"]):
+                job["fn"](*job["args"], **job["kwargs"])
+    except Exception as e:
+        traceback.print_exc()
+        return metrics.records, f"{type(e).__name__}: {e}"
+    return metrics.records, None
+
+
+class PostProcessingQueue:
+    """
+    Background workers for the post-processing steps of finished projects.
+
+    The steps that only read the exports (COG conversion, plot statistics) are handed over by
+    the projects through ProjectSession.post() and run here while the next project computes.
+    The queue is bounded: it is full while `max_projects` projects wait or run, or while the
+    exports they read take `max_bytes` or more, and the scheduler starts no new project
+    while it is full. Exports are never held back, so a project that finishes always hands
+    over its steps, even to a full queue: `max_bytes` is a soft cap.
+    """
+
+    def __init__(self, workers=1, max_bytes=None, max_projects=None):
+        self.max_bytes = max_bytes
+        self.max_projects = max_projects or 2 * workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.pending = []
+        # Readable once a project's post-processing finished, for the scheduler to wait on with its workers
+        self.sentinel, self.notifier = multiprocessing.Pipe(duplex=False)
+
+    def submit(self, result, jobs):
+        """Hand over the post-processing steps of a finished project, with its result to complete later."""
+        size = sum(job["bytes"] for job in jobs)
+        future = self.executor.submit(run_post_jobs, result["project"], jobs)
+        future.add_done_callback(lambda _: self.notifier.send_bytes(b""))
+        self.pending.append((future, result, size, time.time()))
+        print(f"Post-processing of {result['project']} queued ({len(jobs)} step(s), {size / 1024 ** 3:.1f} GB "
+              f"of exports, {len(self.pending)} project(s) pending).")
+
+    def pending_bytes(self):
+        return sum(size for _, _, size, _ in self.pending)
+
+    def full(self):
+        if len(self.pending) >= self.max_projects:
+            return True
+        return self.max_bytes is not None and self.pending_bytes() >= self.max_bytes
+
+    def wait(self, timeout=None):
+        """Block until the post-processing of a project finishes, or `timeout` seconds passed."""
+        wait([future for future, _, _, _ in self.pending], timeout=timeout, return_when=FIRST_COMPLETED)
+
+    def collect(self):
+        """Results of the projects whose post-processing finished, with its stages and time added."""
+        while self.sentinel.poll():
+            self.sentinel.recv_bytes()
+        done = []
+        for item in [item for item in self.pending if item[0].done()]:
+            self.pending.remove(item)
+            future, result, _, queued_at = item
+            try:
+                records, error = future.result()
+            except Exception as e:
+                records, error = [], f"Post-processing worker crashed: {type(e).__name__}: {e}"
+            result["stats"]["stages"] = list(result["stats"].get("stages", [])) + records
+            result["post_duration"] = time.time() - queued_at
+            if error:
+                print(f"Post-processing failed: {result['project']} -> {error}")
+                result.update(status="failed", error=error, retryable=False)
+            done.append(result)
+        return done
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.sentinel.close()
+        self.notifier.close()
+
+
+def deferred_jobs(result):
+    """Take the deferred post-processing steps out of a project result."""
+    return result["stats"].pop("post_jobs", []) if result["stats"] else []
+
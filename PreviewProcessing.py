@@ -0,0 +1,217 @@
+import Metashape
+import os
+import json
+import time
+
+import ExportCache
+import ChunkSelection
+from ProjectSession import ProjectSession
+from StageManifest import StageManifest
+
+# Reduced settings of the preview; the stages are the same as in Geco2024AlignDemOrthoExport
+MATCH_PARAMS = dict(downscale=4, keypoint_limit=10000, tiepoint_limit=2000, generic_preselection=True, reference_preselection=True)
+OPTIMIZE_PARAMS = dict(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, adaptive_fitting=False)
+DEPTH_PARAMS = dict(downscale=8, filter_mode=Metashape.MildFiltering)
+POINT_CLOUD_PARAMS = dict(source_data=Metashape.DataSource.DepthMapsData, point_colors=False)
+DEM_PARAMS = dict(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation)
+# The height field from the tie points needs no depth maps at all, which makes it the fastest surface
+MODEL_PARAMS = dict(surface_type=Metashape.HeightField, source_data=Metashape.TiePointsData, face_count=Metashape.LowFaceCount)
+SURFACES = ("model", "dem")
+
+# Below this fraction of aligned cameras the preview warns that the flight may need to be repeated
+COVERAGE_WARNING = 0.95
+
+
+def preview_path(project_path, label):
+    """Preview projects live in the <project>.preview folder, one per chunk, apart from the project."""
+    return os.path.join(os.path.splitext(project_path)[0] + ".preview", label + ".psx")
+
+
+def create_preview(doc, chunk, path):
+    """Save a copy of the chunk as a project of its own, without the dense products of the full run."""
+    preview_doc = Metashape.Document()
+    preview_doc.append(doc, chunks=[chunk])
+    preview_chunk = preview_doc.chunk
+    products = [preview_chunk.depth_maps, preview_chunk.point_cloud, preview_chunk.model, preview_chunk.orthomosaic]
+    products += list(preview_chunk.elevations)
+    products = [product for product in products if product is not None]
+    if products:
+        preview_chunk.remove(products)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    preview_doc.save(path)
+
+
+def coverage(chunk):
+    """How many cameras aligned, and which did not, as a first check of the flight."""
+    enabled = [camera for camera in chunk.cameras if camera.enabled]
+    unaligned = [camera.label for camera in enabled if not camera.transform]
+    aligned = len(enabled) - len(unaligned)
+    return {"cameras": len(chunk.cameras), "enabled": len(enabled), "aligned": aligned,
+            "aligned_fraction": round(aligned / len(enabled), 4) if enabled else 0.0, "unaligned": unaligned}
+
+
+def process_preview(project_path, surface="model", chunks=None, **session_options):
+    """
+    Build a quick-look orthomosaic and coverage report of every chunk, in minutes rather than hours.
+
+    Each chunk is copied into a preview project in <project>.preview and processed there
+    with reduced settings: images matched at a quarter of their size and the orthomosaic
+    projected on the height field of the tie points, or with surface="dem" on a DEM from
+    depth maps at an eighth of the image size. The preview projects keep their own stage
+    manifests and the project itself is not changed, so the full run never reuses a
+    preview product. The products are written to exports/preview.
+    """
+    if surface not in SURFACES:
+        raise ValueError(f"Unknown preview surface '{surface}', expected one of {', '.join(SURFACES)}")
+    session = ProjectSession(project_path, **session_options)
+    doc = session.doc
+    export_dir = os.path.join(os.path.dirname(project_path), "exports", "preview")
+    os.makedirs(export_dir, exist_ok=True)
+
+    # The chunks are copied first, so the project is only locked while it is read
+    previews = []
+    for chunk in ChunkSelection.select_chunks(doc, chunks):
+        label = ChunkSelection.export_label(doc, chunk)
+        path = preview_path(project_path, label)
+        manifest = StageManifest(path)
+        camera_labels = [camera.label for camera in chunk.cameras]
+        if manifest.needs_run("copy", inputs=camera_labels, present=os.path.exists(path)):
+            with session.stage("preview_copy", modifies=False):
+                print(f"Copying chunk {chunk.label} to {path}...")
+                create_preview(doc, chunk, path)
+                manifest.complete("copy")
+            manifest.save()
+        previews.append((label, path))
+    session.close()
+
+    stats = session.stats
+    for label, path in previews:
+        preview_stats = process_preview_chunk(path, label, export_dir, surface, **session_options)
+        stats["saves"] += preview_stats["saves"]
+        stats["save_time"] += preview_stats["save_time"]
+        stats["stages"] = stats["stages"] + preview_stats["stages"]
+    return stats
+
+
+def process_preview_chunk(path, label, export_dir, surface="model", **session_options):
+    session = ProjectSession(path, **session_options)
+    chunk = session.doc.chunk
+    start_time = time.time()
+
+    crs_code = "EPSG::4326"
+    coord_system = Metashape.CoordinateSystem(crs_code)
+    chunk.crs = coord_system
+    ortho_proj = Metashape.OrthoProjection()
+    ortho_proj.crs = coord_system
+
+    compression = Metashape.ImageCompression()
+    compression.tiff_compression = Metashape.ImageCompression.TiffCompressionLZW
+    compression.tiff_big = True
+    compression.tiff_overviews = True
+    compression.tiff_tiled = True
+
+    manifest = StageManifest(path)
+    session.on_save(manifest.save)
+    camera_labels = [camera.label for camera in chunk.cameras]
+
+    # A project that was already aligned keeps its alignment; it is better than the preview one
+    cameras_aligned = any(camera.transform for camera in chunk.cameras)
+    if manifest.needs_run("align", params=MATCH_PARAMS, inputs=camera_labels, depends=["copy"], present=cameras_aligned):
+        with session.stage("align") as progress:
+            print("Aligning cameras (preview)...")
+            chunk.matchPhotos(progress=progress.part(0, 2), **MATCH_PARAMS)
+            chunk.alignCameras(progress=progress.part(1, 2))
+            manifest.complete("align")
+
+    if manifest.needs_run("optimize", params=OPTIMIZE_PARAMS, depends=["align"]):
+        with session.stage("optimize") as progress:
+            chunk.optimizeCameras(progress=progress, **OPTIMIZE_PARAMS)
+            manifest.complete("optimize")
+
+    if surface == "dem":
+        if manifest.needs_run("depth_maps", params=DEPTH_PARAMS, depends=["optimize"], present=chunk.depth_maps is not None):
+            with session.stage("depth_maps") as progress:
+                print("Building Depth Maps (preview)...")
+                chunk.buildDepthMaps(progress=progress, **DEPTH_PARAMS)
+                manifest.complete("depth_maps")
+        if manifest.needs_run("point_cloud", params=POINT_CLOUD_PARAMS, depends=["depth_maps"],
+                              present=chunk.point_cloud is not None):
+            with session.stage("point_cloud") as progress:
+                print("Building Point Cloud (preview)...")
+                chunk.buildPointCloud(progress=progress, **POINT_CLOUD_PARAMS)
+                manifest.complete("point_cloud")
+        dem = manifest.elevation(chunk, "dem", adopt=True)
+        if manifest.needs_run("dem", params=dict(DEM_PARAMS, crs=crs_code), depends=["point_cloud"],
+                              present=dem is not None, product=dem.key if dem else None):
+            with session.stage("dem") as progress:
+                print("Building DEM (preview)...")
+                chunk.buildDem(progress=progress, projection=ortho_proj, **DEM_PARAMS)
+                dem = chunk.elevation
+                manifest.complete("dem", product=dem.key)
+        # The orthomosaic and the DEM export use the active elevation
+        chunk.elevation = dem
+        surface_stage, surface_data = "dem", Metashape.ElevationData
+    else:
+        if manifest.needs_run("model", params=MODEL_PARAMS, depends=["optimize"], present=chunk.model is not None):
+            with session.stage("model") as progress:
+                print("Building height field from the tie points (preview)...")
+                chunk.buildModel(progress=progress, **MODEL_PARAMS)
+                manifest.complete("model")
+        surface_stage, surface_data = "model", Metashape.ModelData
+
+    ortho_params = dict(surface_data=surface_data, blending_mode=Metashape.DisabledBlending)
+    if manifest.needs_run("orthomosaic", params=dict(ortho_params, crs=crs_code), depends=[surface_stage],
+                          present=chunk.orthomosaic is not None):
+        with session.stage("orthomosaic") as progress:
+            print("Building Orthomosaic (preview)...")
+            chunk.buildOrthomosaic(progress=progress, projection=ortho_proj, **ortho_params)
+            manifest.complete("orthomosaic")
+
+    # The quick-look keeps the raw bands; the raster transform is left to the full run
+    export_settings = dict(crs=crs_code, compression=ExportCache.compression_settings(compression))
+    exports = [("_Ortho_preview.tif", "orthomosaic", dict(source_data=Metashape.OrthomosaicData,
+                                                          image_format=Metashape.ImageFormatTIFF))]
+    if surface == "dem":
+        exports.append(("_DEM_preview.tif", "dem", dict(source_data=Metashape.ElevationData,
+                                                        image_format=Metashape.ImageFormatTIFF)))
+    for suffix, source, export in exports:
+        export_path = os.path.join(export_dir, label + suffix)
+        fingerprint = ExportCache.export_fingerprint(manifest, [source], **export, **export_settings)
+        if ExportCache.up_to_date(export_path, fingerprint):
+            print(f"Preview export {export_path} is up to date. Skipping.")
+            continue
+        with session.stage("export_" + source, modifies=False) as progress, \
+                ExportCache.atomic_export(export_path, fingerprint) as tmp_path:
+            chunk.exportRaster(progress=progress, path=tmp_path, image_compression=compression, projection=ortho_proj, **export)
+
+    # Metashape's report shows the camera locations and image overlap of the flight
+    report_path = os.path.join(export_dir, label + "_preview_report.pdf")
+    fingerprint = ExportCache.export_fingerprint(manifest, sorted(manifest.stages))
+    if not ExportCache.up_to_date(report_path, fingerprint):
+        with session.stage("export_report", modifies=False) as progress, \
+                ExportCache.atomic_export(report_path, fingerprint) as tmp_path:
+            chunk.exportReport(tmp_path, progress=progress)
+
+    report = dict(coverage(chunk), project=path, chunk=label, surface=surface,
+                  settings={"match": MATCH_PARAMS, "depth_maps": DEPTH_PARAMS if surface == "dem" else None},
+                  seconds=round(time.time() - start_time, 1))
+    coverage_path = os.path.join(export_dir, label + "_coverage.json")
+    with open(coverage_path, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    print(f"Preview of {label}: {report['aligned']} of {report['enabled']} cameras aligned, "
+          f"written to {export_dir} in {report['seconds']:.0f} s.")
+    if report["aligned_fraction"] < COVERAGE_WARNING:
+        print(f"Warning: only {report['aligned_fraction']:.0%} of the cameras of {label} aligned; "
+              f"check the coverage before leaving the site.")
+    session.close()
+    return session.stats
+
+
+def add_preview_arguments(parser):
+    """Command line options for the quick-look preview."""
+    parser.add_argument('--preview', action='store_true',
+                        help='Build a quick-look orthomosaic and coverage report at reduced settings in '
+                             'exports/preview instead of processing the projects.')
+    parser.add_argument('--preview-surface', choices=SURFACES, default="model",
+                        help="Surface of the preview orthomosaic: the height field of the tie points ('model', "
+                             "fastest) or a DEM from low resolution depth maps ('dem') (default: model).")
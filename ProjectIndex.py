@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from ProjectInspector import INSPECTOR_FORMAT, inspect_project, project_mtime, has_product
+from ChunkSelection import unique_label
+
+DEFAULT_DB_PATH = os.path.join(os.path.expanduser("~"), ".project_index.sqlite")
+
+# File name suffixes of the exported products, appended to the chunk's export label; a product
+# counts as exported if any of the names the processing scripts use for it exists
+EXPORT_SUFFIXES = {
+    "dem": ("_DEM.tif",),
+    # Geco2024AlignModelOrthoExport names the orthomosaic built on the DEM <label>DEM_ortho.tif
+    "ortho": ("_Ortho.tif", "DEM_ortho.tif"),
+    "dtm": ("_DTM.tif",),
+    "report": ("_report.pdf",),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    subdirs TEXT,
+    projects TEXT
+);
+CREATE TABLE IF NOT EXISTS projects (
+    path TEXT PRIMARY KEY,
+    directory TEXT,
+    mtime REAL,
+    info TEXT,
+    exports_mtime REAL,
+    exports TEXT,
+    scanned_at REAL
+);
+"""
+
+
+def connect(db_path=DEFAULT_DB_PATH):
+    connection = sqlite3.connect(db_path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def list_directory(path, cached):
+    """
+    List the sub-directories and projects of one directory.
+
+    If the directory's mtime still matches the index, the cached listing is reused;
+    creating or deleting entries always changes the mtime of the containing directory.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return path, None, [], []
+    if cached is not None and cached[0] == mtime:
+        return path, mtime, json.loads(cached[1]), json.loads(cached[2])
+
+    subdirs = []
+    projects = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # The .files folders hold the project data and never contain other projects; the
+                    # .tiles and .preview folders hold the tile and preview projects of a project,
+                    # which are not processed alone
+                    if not entry.name.endswith((".files", ".tiles", ".preview")):
+                        subdirs.append(entry.path)
+                elif entry.name.endswith(".psx"):
+                    projects.append(entry.path)
+    except OSError as e:
+        print(f"Could not list {path}: {e}")
+    return path, mtime, subdirs, projects
+
+
+def list_exports(project_path, cached_mtime, cached_exports):
+    """Names of the files in the project's exports folder, re-listed only if the folder changed."""
+    export_dir = os.path.join(os.path.dirname(project_path), "exports")
+    try:
+        mtime = os.stat(export_dir).st_mtime
+    except OSError:
+        return None, []
+    if cached_mtime == mtime and cached_exports is not None:
+        return mtime, json.loads(cached_exports)
+    with os.scandir(export_dir) as entries:
+        return mtime, sorted(entry.name for entry in entries if entry.is_file())
+
+
+def scan(root, connection, workers=16):
+    """
+    Bring the index up to date for all projects below `root`.
+
+    Directories are listed level by level on a thread pool; only directories whose mtime
+    changed are listed again. Projects are only re-inspected if they were saved since
+    the last scan, and without measuring folder sizes, which the index does not use.
+    """
+    start_time = time.time()
+    root = os.path.abspath(root)
+    prefix = os.path.join(root, "")
+    cached_dirs = {row[0]: row[1:] for row in connection.execute(
+        "SELECT path, mtime, subdirs, projects FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+        (root, len(prefix), prefix))}
+    seen_dirs = set()
+    project_paths = []
+    relisted = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        level = [root]
+        while level:
+            next_level = []
+            for path, mtime, subdirs, projects in executor.map(
+                    lambda p: list_directory(p, cached_dirs.get(p)), level):
+                if mtime is None:
+                    continue
+                seen_dirs.add(path)
+                cached = cached_dirs.get(path)
+                if cached is None or cached[0] != mtime:
+                    relisted += 1
+                    connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                                       (path, mtime, json.dumps(subdirs), json.dumps(projects)))
+                next_level.extend(subdirs)
+                project_paths.extend(projects)
+            level = next_level
+
+        # Forget directories that disappeared, together with their projects
+        for path in set(cached_dirs) - seen_dirs:
+            connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+            connection.execute("DELETE FROM projects WHERE directory = ?", (path,))
+
+        cached_projects = {row[0]: row[1:] for row in connection.execute(
+            "SELECT path, mtime, exports_mtime, exports, json_extract(info, '$.format') FROM projects "
+            "WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix))}
+        for path in set(cached_projects) - set(project_paths):
+            connection.execute("DELETE FROM projects WHERE path = ?", (path,))
+
+        def refresh(project_path):
+            cached = cached_projects.get(project_path)
+            try:
+                mtime = project_mtime(project_path)
+                if cached is not None and cached[0] == mtime and cached[3] == INSPECTOR_FORMAT:
+                    info = None
+                else:
+                    info = inspect_project(project_path, sizes=False)
+            except Exception as e:
+                mtime = None
+                info = {"project": project_path, "chunks": [], "size": 0, "error": f"{type(e).__name__}: {e}"}
+            exports_mtime, exports = list_exports(project_path,
+                                                  cached[1] if cached else None, cached[2] if cached else None)
+            return project_path, mtime, info, exports_mtime, exports
+
+        inspected = 0
+        for project_path, mtime, info, exports_mtime, exports in executor.map(refresh, project_paths):
+            if info is None:
+                connection.execute("UPDATE projects SET exports_mtime = ?, exports = ?, scanned_at = ? WHERE path = ?",
+                                   (exports_mtime, json.dumps(exports), time.time(), project_path))
+            else:
+                inspected += 1
+                connection.execute("INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (project_path, os.path.dirname(project_path), mtime, json.dumps(info),
+                                    exports_mtime, json.dumps(exports), time.time()))
+    connection.commit()
+    print(f"Indexed {len(project_paths)} projects in {len(seen_dirs)} directories in {time.time() - start_time:.1f} s "
+          f"({relisted} directories listed, {inspected} projects inspected).")
+    return project_paths
+
+
+def project_info(connection, project_path):
+    """Inspection of one project from the index, re-inspected and stored only if it was saved since."""
+    project_path = os.path.abspath(project_path)
+    mtime = project_mtime(project_path)
+    row = connection.execute("SELECT mtime, info, exports_mtime, exports FROM projects WHERE path = ?",
+                             (project_path,)).fetchone()
+    if row is not None and row[0] == mtime:
+        info = json.loads(row[1])
+        if info.get("format") == INSPECTOR_FORMAT:
+            return info
+    info = inspect_project(project_path, sizes=False)
+    exports_mtime, exports = list_exports(project_path, row[2] if row else None, row[3] if row else None)
+    connection.execute("INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (project_path, os.path.dirname(project_path), mtime, json.dumps(info),
+                        exports_mtime, json.dumps(exports), time.time()))
+    connection.commit()
+    return info
+
+
+def lacks_export(info, exports, product):
+    """
+    True if any enabled chunk of the project has no exported file for the product. The file
+    names start with the same export label as in the processing scripts, so chunks sharing
+    a label are told apart by their key.
+    """
+    suffixes = EXPORT_SUFFIXES[product]
+    all_labels = [chunk["label"] for chunk in info["chunks"]]
+    labels = [unique_label(chunk["label"], chunk.get("key"), all_labels)
+              for chunk in info["chunks"] if chunk.get("enabled", True)]
+    if not labels:
+        return not any(name.endswith(suffixes) for name in exports)
+    return any(all(label + suffix not in exports for suffix in suffixes) for label in labels)
+
+
+def query(connection, root=None, lacking=(), has=(), modified_since=None):
+    """Return the indexed projects matching all given conditions, sorted by path."""
+    sql = "SELECT path, mtime, info, exports FROM projects"
+    params = ()
+    if root is not None:
+        prefix = os.path.join(os.path.abspath(root), "")
+        sql += " WHERE substr(path, 1, ?) = ?"
+        params = (len(prefix), prefix)
+    matches = []
+    for path, mtime, info, exports in connection.execute(sql + " ORDER BY path", params):
+        info = json.loads(info)
+        exports = json.loads(exports) if exports else []
+        if modified_since is not None and (mtime is None or mtime < modified_since.timestamp()):
+            continue
+        if any(not has_product(info, product) for product in has):
+            continue
+        if any(not lacks_export(info, exports, product) for product in lacking):
+            continue
+        matches.append(path)
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incremental index of the Metashape projects on a storage tree.")
+    parser.add_argument('--db', type=str, default=DEFAULT_DB_PATH, help='Path of the SQLite index.')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan_parser = subparsers.add_parser("scan", help="Update the index for a directory tree.")
+    scan_parser.add_argument('root', type=str, help='Directory to search for Metashape projects.')
+    scan_parser.add_argument('--workers', type=int, default=16, help='Number of directories listed at the same time.')
+
+    query_parser = subparsers.add_parser("query", help="List indexed projects matching conditions.")
+    query_parser.add_argument('root', type=str, nargs='?', default=None, help='Only list projects below this directory.')
+    query_parser.add_argument('--lacking', action='append', default=[], choices=sorted(EXPORT_SUFFIXES),
+                              help='Only projects without this export (can be repeated).')
+    query_parser.add_argument('--has', action='append', default=[],
+                              choices=["tie_points", "depth_maps", "point_cloud", "dem", "orthomosaic", "model"],
+                              help='Only projects with this product in the project (can be repeated).')
+    query_parser.add_argument('--modified-since', type=str, default=None, help='Only projects saved since this date (YYYY-MM-DD).')
+    query_parser.add_argument('--output', type=str, default=None, help='Write the project list to this file instead of printing it.')
+    args = parser.parse_args()
+
+    connection = connect(args.db)
+    if args.command == "scan":
+        scan(args.root, connection, workers=args.workers)
+    else:
+        modified_since = datetime.strptime(args.modified_since, "%Y-%m-%d") if args.modified_since else None
+        projects = query(connection, args.root, lacking=args.lacking, has=args.has, modified_since=modified_since)
+        if args.output:
+            with open(args.output, 'w') as file:
+                for project in projects:
+                    file.write(f"{project}\n")
+            print(f"Wrote {len(projects)} projects to {args.output}")
+        else:
+            for project in projects:
+                print(project)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import os
+import json
+import zipfile
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".project_inspector_cache.json")
+
+# Products reported per chunk
+PRODUCTS = ("tie_points", "depth_maps", "point_cloud", "dem", "orthomosaic", "model")
+
+# Bumped whenever the reported fields change, so cached results are refreshed
+INSPECTOR_FORMAT = 3
+
+
+def files_dir(project_path):
+    return os.path.splitext(project_path)[0] + ".files"
+
+
+def read_zip_xml(zip_path):
+    """Parse the doc.xml stored inside one of Metashape's zip containers."""
+    with zipfile.ZipFile(zip_path) as archive:
+        with archive.open("doc.xml") as doc_xml:
+            return ET.parse(doc_xml).getroot()
+
+
+def product_kind(tag, major_version):
+    """Map an XML element holding a product to the product it represents."""
+    if tag == "depth_maps":
+        return "depth_maps"
+    if tag == "dense_cloud":
+        return "point_cloud"
+    if tag == "point_cloud":
+        # Metashape 1.x called the tie points "point_cloud", 2.x uses it for the dense cloud
+        return "point_cloud" if major_version >= 2 else "tie_points"
+    if tag == "tie_points":
+        return "tie_points"
+    if tag == "elevation":
+        return "dem"
+    if tag == "orthomosaic":
+        return "orthomosaic"
+    if tag == "model":
+        return "model"
+    return None
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def collect_products(element, base_dir, major_version, products):
+    """Record every product element below `element`, with the folder holding its data."""
+    for node in element.iter():
+        path = node.get("path")
+        kind = product_kind(node.tag, major_version)
+        if kind is None or not path:
+            continue
+        product_dir = os.path.dirname(os.path.normpath(os.path.join(base_dir, path)))
+        products.setdefault(kind, []).append(product_dir)
+
+
+def element_key(element):
+    """Key of a chunk or elevation element, as Metashape reports it in chunk.key / elevation.key."""
+    value = element.get("id")
+    return int(value) if value is not None and value.isdigit() else value
+
+
+def inspect_chunk(chunk_zip, major_version, sizes=True):
+    """Report the state of one chunk from its doc.xml and the doc.xml of its frames; `sizes` walks its folders."""
+    chunk_dir = os.path.dirname(chunk_zip)
+    root = read_zip_xml(chunk_zip)
+
+    cameras = root.find("cameras")
+    camera_nodes = list(cameras.iter("camera")) if cameras is not None else []
+    products = {}
+    collect_products(root, chunk_dir, major_version, products)
+
+    frames = root.find("frames")
+    for frame in (frames.findall("frame") if frames is not None else []):
+        frame_zip = os.path.join(chunk_dir, frame.get("path"))
+        if os.path.exists(frame_zip):
+            collect_products(read_zip_xml(frame_zip), os.path.dirname(frame_zip), major_version, products)
+
+    # All DEMs of the chunk and which one is the active one
+    dems = []
+    for elevations in root.iter("elevations"):
+        active_id = elevations.get("active_id")
+        for elevation in elevations.findall("elevation"):
+            if elevation.get("path"):
+                dems.append({"dir": os.path.dirname(os.path.normpath(os.path.join(chunk_dir, elevation.get("path")))),
+                             "key": element_key(elevation), "active": elevation.get("id") == active_id})
+
+    chunk = {
+        "label": root.get("label", ""),
+        "enabled": root.get("enabled", "true") == "true",
+        "cameras": len(camera_nodes),
+        "aligned_cameras": sum(1 for camera in camera_nodes if camera.find("transform") is not None),
+        "size": directory_size(chunk_dir) if sizes else None,
+        "product_sizes": {},
+        "product_dirs": {kind: sorted(set(dirs)) for kind, dirs in products.items()},
+        "dems": dems,
+    }
+    for kind in PRODUCTS:
+        chunk[kind] = kind in products
+        if kind in products and sizes:
+            chunk["product_sizes"][kind] = sum(directory_size(d) for d in set(products[kind]) if d != chunk_dir)
+    return chunk
+
+
+def project_mtime(project_path):
+    """Metashape rewrites project.zip on every save, so it dates the project state."""
+    mtime = os.path.getmtime(project_path)
+    project_zip = os.path.join(files_dir(project_path), "project.zip")
+    if os.path.exists(project_zip):
+        mtime = max(mtime, os.path.getmtime(project_zip))
+    return mtime
+
+
+def inspect_project(project_path, sizes=True):
+    """
+    Read the chunk state of a project straight from its files, without Metashape.
+
+    Without `sizes` the folder sizes are not measured (reported as None), which skips walking
+    every file of the project; counting cameras or listing products does not need them.
+    """
+    psx = ET.parse(project_path).getroot()
+    version = psx.get("version", "0")
+    major_version = int(version.split(".")[0]) if version.split(".")[0].isdigit() else 0
+    project_name = os.path.splitext(os.path.basename(project_path))[0]
+    doc_path = psx.get("path", "{projectname}.files/project.zip").replace("{projectname}", project_name)
+    project_zip = os.path.join(os.path.dirname(project_path), doc_path)
+
+    info = {"project": project_path, "format": INSPECTOR_FORMAT, "mtime": project_mtime(project_path), "version": version,
+            "chunks": [], "size": directory_size(files_dir(project_path)) if sizes else None, "error": None}
+    if not os.path.exists(project_zip):
+        info["error"] = "project data missing"
+        return info
+
+    document = read_zip_xml(project_zip)
+    chunks = document.find("chunks")
+    chunk_elements = chunks.findall("chunk") if chunks is not None else []
+    # Without an active_id the first chunk is the active one
+    active_id = chunks.get("active_id") if chunks is not None else None
+    if active_id is None and chunk_elements:
+        active_id = chunk_elements[0].get("id")
+    for chunk in chunk_elements:
+        chunk_zip = os.path.join(os.path.dirname(project_zip), chunk.get("path"))
+        if os.path.exists(chunk_zip):
+            chunk_info = inspect_chunk(chunk_zip, major_version, sizes)
+            chunk_info["key"] = element_key(chunk)
+            chunk_info["active"] = chunk.get("id") == active_id
+            info["chunks"].append(chunk_info)
+    return info
+
+
+def has_product(info, product):
+    return any(chunk[product] for chunk in info["chunks"])
+
+
+class InspectorCache:
+    """JSON index of inspected projects, an entry is reused while the project is unchanged."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+
+    def get(self, project_path):
+        entry = self.entries.get(os.path.abspath(project_path))
+        try:
+            if entry is not None and entry.get("format") == INSPECTOR_FORMAT and entry["mtime"] == project_mtime(project_path):
+                return entry
+        except OSError:
+            pass
+        return None
+
+    def put(self, info):
+        self.entries[os.path.abspath(info["project"])] = info
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(tmp_path, self.path)
+
+
+def inspect_projects(project_paths, cache=None, workers=8, sizes=True):
+    """
+    Inspect many projects in parallel, only reading those that changed since they were cached.
+
+    Cached results always carry sizes; results inspected without `sizes` are not cached.
+    """
+    cache = cache or InspectorCache(None)
+    results = {}
+    to_inspect = []
+    for project_path in project_paths:
+        cached = cache.get(project_path)
+        if cached is not None:
+            results[project_path] = cached
+        else:
+            to_inspect.append(project_path)
+
+    def safe_inspect(project_path):
+        try:
+            return inspect_project(project_path, sizes)
+        except Exception as e:
+            return {"project": project_path, "mtime": None, "version": None, "chunks": [], "size": 0,
+                    "error": f"{type(e).__name__}: {e}"}
+
+    stored = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for info in executor.map(safe_inspect, to_inspect):
+            results[info["project"]] = info
+            if info["error"] is None and sizes:
+                cache.put(info)
+                stored += 1
+    if stored:
+        cache.save()
+    print(f"Inspected {len(to_inspect)} projects, {len(project_paths) - len(to_inspect)} taken from the cache.")
+    return [results[project_path] for project_path in project_paths]
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def print_report(info):
+    print(f"{info['project']} (Metashape {info['version']}, {format_size(info['size'])})")
+    if info["error"]:
+        print(f"  Error: {info['error']}")
+    for chunk in info["chunks"]:
+        products = ", ".join(kind for kind in PRODUCTS if chunk[kind]) or "none"
+        print(f"  {chunk['label']}: {chunk['aligned_cameras']}/{chunk['cameras']} cameras aligned, "
+              f"products: {products}, {format_size(chunk['size'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the processing state of Metashape projects without opening them in Metashape.")
+    parser.add_argument('projects', nargs='+', help='.psx project files to inspect.')
+    parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_PATH, help='Path of the inspection cache.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    results = inspect_projects(args.projects, InspectorCache(args.cache))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for info in results:
+            print_report(info)
+
+
+if __name__ == "__main__":
+    main()
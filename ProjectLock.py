@@ -0,0 +1,48 @@
+import Metashape
+import os
+import time
+
+
+class ProjectLockedError(Exception):
+    """Raised when a project is locked by another Metashape instance."""
+
+
+def lock_file_path(project_path):
+    """Metashape keeps its lock file inside the project's .files folder."""
+    return os.path.splitext(project_path)[0] + ".files" + os.sep + "lock"
+
+
+def lock_age_hours(project_path):
+    """Return the age of the project's lock file in hours, or None if it is not locked."""
+    lock_path = lock_file_path(project_path)
+    try:
+        mtime = os.path.getmtime(lock_path)
+    except OSError:
+        return None
+    return (time.time() - mtime) / 3600.0
+
+
+def open_project(project_path, ignore_lock=False, stale_lock_hours=None):
+    """
+    Open a Metashape project, respecting its lock.
+
+    A locked project raises ProjectLockedError unless ignore_lock is set, or the
+    lock is older than stale_lock_hours (left behind by a crashed run).
+    """
+    age = lock_age_hours(project_path)
+    if age is not None and not ignore_lock:
+        if stale_lock_hours is not None and age >= stale_lock_hours:
+            print(f"Breaking stale lock ({age:.1f} h old) on project: {project_path}")
+            ignore_lock = True
+        else:
+            raise ProjectLockedError(f"Project is locked ({age:.1f} h old lock): {project_path}")
+
+    doc = Metashape.Document()
+    try:
+        doc.open(project_path, ignore_lock=ignore_lock)
+    except Exception as e:
+        # Metashape may still refuse if another instance grabbed the lock in the meantime
+        if "lock" in str(e).lower():
+            raise ProjectLockedError(f"Project is locked: {project_path}") from e
+        raise
+    return doc
@@ -0,0 +1,150 @@
+import os
+import time
+import contextlib
+
+from ProjectLock import open_project
+from StageManifest import ClearedProductNeeded
+from StageMetrics import StageMetrics
+from BatchProgress import ProgressReporter, StageProgress
+
+# Stages after which the document is saved right away. They take long enough that
+# losing them in a crash would hurt; cheaper changes are saved with the next one.
+DEFAULT_SAVE_POINTS = ("align", "depth_maps", "point_cloud", "model", "dem", "orthomosaic", "dtm")
+
+
+def parse_save_points(value):
+    """Parse the --save-after option: a comma separated list of stages, 'all' or 'none'."""
+    if value is None:
+        return DEFAULT_SAVE_POINTS
+    if not isinstance(value, str):
+        return tuple(value)
+    value = value.strip().lower()
+    if value == "all":
+        return "all"
+    if value == "none":
+        return ()
+    return tuple(stage.strip() for stage in value.split(",") if stage.strip())
+
+
+class ProjectSession:
+    """
+    Keeps one project open for the whole pipeline and coalesces saves.
+
+    Stages report their changes through changed(); the document is only written at the
+    configured save points and once more when the session closes, and only if something
+    changed since the last save. Callbacks registered with on_save run after every save,
+    so bookkeeping such as the stage manifest never gets ahead of the saved document.
+
+    Stages run inside stage() are measured; the measurements are returned with the
+    session stats and written to the project's logs folder when the session closes.
+    stage() yields a progress callback for the Metashape calls of the stage; with a
+    progress_dir from the batch scheduler the progress is reported to the batch.
+
+    Steps that only read the exports are run through post(); with defer_post they are
+    returned with the session stats instead, for the batch scheduler to run in the
+    background while the next project computes.
+    """
+
+    def __init__(self, project_path, ignore_lock=False, stale_lock_hours=None, save_after=None, progress_dir=None,
+                 defer_post=False, measure_writes=False):
+        self.project_path = project_path
+        self.save_points = parse_save_points(save_after)
+        self.doc = open_project(project_path, ignore_lock=ignore_lock, stale_lock_hours=stale_lock_hours)
+        # The chunk being processed; stages count its images
+        self.chunk = self.doc.chunk
+        self.dirty = False
+        self.save_callbacks = []
+        self.metrics = StageMetrics(project_path, measure_writes=measure_writes)
+        self.progress = ProgressReporter(progress_dir, project_path) if progress_dir else None
+        self.defer_post = defer_post
+        self.stats = {"saves": 0, "save_time": 0.0, "stages": self.metrics.records}
+        if defer_post:
+            self.stats["post_jobs"] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # On errors only what was saved at the last save point is kept; the document may be
+        # halfway through a failed stage and is better not written.
+        if exc_type is None:
+            self.close()
+        return False
+
+    def on_save(self, callback):
+        self.save_callbacks.append(callback)
+
+    def changed(self, stage):
+        """Record that a stage modified the document, saving now if it is a save point."""
+        self.dirty = True
+        if self.save_points == "all" or stage in self.save_points:
+            self.save()
+
+    @contextlib.contextmanager
+    def stage(self, name, modifies=True, image_count=None):
+        """Measure a stage; unless it only reads the document, it is reported as changed once it succeeds."""
+        if image_count is None and self.chunk is not None:
+            image_count = len(self.chunk.cameras)
+        if self.progress is not None:
+            self.progress.start_stage(name, image_count)
+        with self.metrics.record(name, image_count):
+            yield StageProgress(self.progress)
+        if self.progress is not None:
+            self.progress.finish_stage(name)
+        # Saving is not part of the stage, it is accounted in the save stats
+        if modifies:
+            self.changed(name)
+
+    def process_chunk(self, fn, chunk, *args, **kwargs):
+        """
+        Run the stages of one chunk, fn(self, chunk, ...). If a stage needs the product of a
+        stage that was cleared to save space, the chunk is processed again from the start,
+        which rebuilds the cleared stage and then the stages built from it.
+        """
+        callbacks = len(self.save_callbacks)
+        rebuilt = set()
+        while True:
+            try:
+                return fn(self, chunk, *args, **kwargs)
+            except ClearedProductNeeded as e:
+                # A pass that did not rebuild what the last one asked for would repeat forever
+                if rebuilt & set(e.cleared):
+                    raise
+                rebuilt.update(e.cleared)
+                print(f"{e} Processing chunk {chunk.label} again to rebuild it.")
+                # The manifest of the interrupted pass is replaced by the one of the next pass
+                del self.save_callbacks[callbacks:]
+
+    def post(self, name, fn, *args, inputs=(), **kwargs):
+        """
+        Run a post-processing stage that reads the exports but not the document, or defer it.
+
+        `inputs` are the files it reads; while it waits, their size counts against the disk
+        space the batch scheduler lets the pending exports hold.
+        """
+        if self.defer_post:
+            size = sum(os.path.getsize(path) for path in inputs if os.path.exists(path))
+            self.stats["post_jobs"].append({"stage": name, "fn": fn, "args": args, "kwargs": kwargs, "bytes": size,
+                                            "measure_writes": self.metrics.measure_writes})
+            return
+        with self.stage(name, modifies=False):
+            fn(*args, **kwargs)
+
+    def save(self):
+        if self.dirty:
+            start_time = time.time()
+            self.doc.save()
+            elapsed = time.time() - start_time
+            self.stats["saves"] += 1
+            self.stats["save_time"] += elapsed
+            self.dirty = False
+            print(f"Project saved in {elapsed:.1f} s.")
+        for callback in self.save_callbacks:
+            callback()
+
+    def close(self):
+        self.save()
+        if self.metrics.records:
+            metrics_path = self.metrics.write_json(os.path.join(os.path.dirname(self.project_path), "logs"))
+            print(f"Stage metrics written to {metrics_path}")
+        print(f"Saved {self.stats['saves']} time(s), {self.stats['save_time']:.1f} s spent in saves: {self.project_path}")
@@ -0,0 +1,144 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# The raster transform set on chunk.raster_transform.formula by the processing scripts.
+# Bands of the raw Altum orthomosaic: B1 Blue, B2 Green, B3 Panchro, B4 Red, B5 Red edge, B6 NIR, B7 LWIR.
+METASHAPE_FORMULA = [
+    'B1 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
+    'B2 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
+    'B4 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
+    'B5 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
+    'B6 * (B3 / (0.2 * B1 + 0.2 * B2 + 0.2 * B4 + 0.2 * B5 + 0.2 * B6)) / 32768',
+    '(B7 / 100) - 273.15'
+]
+
+REFLECTANCE_BANDS = (1, 2, 4, 5, 6)
+PANCHRO_BAND = 3
+THERMAL_BAND = 7
+OUTPUT_NODATA = -32767.0  # Same no-data value Metashape writes into float exports
+
+# Source dataset opened once per worker process
+_source = None
+
+
+def transform_block(bands, valid=None, nodata=OUTPUT_NODATA):
+    """
+    Apply METASHAPE_FORMULA to a (7, rows, cols) block of raw bands.
+
+    The pan-sharpening ratio B3 / (0.2 * (B1 + B2 + B4 + B5 + B6)) is computed once per
+    pixel and shared by the five reflectance bands. Pixels where the ratio is undefined are
+    no-data in the reflectance bands only; the temperature does not depend on it. Returns a
+    (6, rows, cols) float32 block.
+    """
+    raw = bands.astype(np.float32, copy=False)
+    out = np.empty((len(REFLECTANCE_BANDS) + 1,) + raw.shape[1:], dtype=np.float32)
+
+    denominator = raw[REFLECTANCE_BANDS[0] - 1].copy()
+    for band in REFLECTANCE_BANDS[1:]:
+        denominator += raw[band - 1]
+    denominator *= 0.2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = raw[PANCHRO_BAND - 1] / denominator
+    scale *= 1.0 / 32768
+    for i, band in enumerate(REFLECTANCE_BANDS):
+        np.multiply(raw[band - 1], scale, out=out[i])
+
+    np.multiply(raw[THERMAL_BAND - 1], 1.0 / 100, out=out[-1])
+    out[-1] -= 273.15
+
+    out[:-1, ~np.isfinite(scale)] = nodata
+    if valid is not None:
+        out[:, ~valid] = nodata
+    return out
+
+
+def _open_source(source_path):
+    global _source
+    _source = rasterio.open(source_path)
+
+
+def _process_window(window, nodata):
+    bands = _source.read(indexes=list(range(1, THERMAL_BAND + 1)), window=window)
+    valid = _source.dataset_mask(window=window) > 0
+    return window, transform_block(bands, valid, nodata)
+
+
+def iter_windows(width, height, tile_size):
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+
+def transform_raster(source_path, output_path, workers=None, tile_size=1024, nodata=OUTPUT_NODATA):
+    """
+    Apply the multispectral raster transform to a raw orthomosaic export.
+
+    Tiles are read and transformed by a pool of worker processes while the main process
+    writes finished tiles. At most two tiles per worker are in flight, so memory use
+    depends on the tile size and worker count, not on the size of the orthomosaic.
+    """
+    workers = workers or os.cpu_count()
+    start_time = time.time()
+    with rasterio.open(source_path) as src:
+        if src.count < THERMAL_BAND:
+            raise ValueError(f"Expected at least {THERMAL_BAND} bands in {source_path}, found {src.count}.")
+        profile = src.profile.copy()
+        width, height = src.width, src.height
+
+    profile.update(driver="GTiff", count=len(REFLECTANCE_BANDS) + 1, dtype="float32", nodata=nodata,
+                   tiled=True, blockxsize=256, blockysize=256, compress="lzw", predictor=3, BIGTIFF="IF_SAFER")
+    profile.pop("photometric", None)
+
+    tmp_path = output_path + ".partial"
+    windows = iter_windows(width, height, tile_size)
+    tiles_done = 0
+    try:
+        with rasterio.open(tmp_path, "w", **profile) as dst, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_open_source, initargs=(source_path,)) as executor:
+            pending = set()
+            while True:
+                while len(pending) < 2 * workers:
+                    window = next(windows, None)
+                    if window is None:
+                        break
+                    pending.add(executor.submit(_process_window, window, nodata))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window, block = future.result()
+                    dst.write(block, window=window)
+                    tiles_done += 1
+    except BaseException:
+        # A failed transform leaves no partial output behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, output_path)
+
+    elapsed = time.time() - start_time
+    megapixels = width * height / 1e6
+    print(f"Transformed {megapixels:.1f} MPix in {tiles_done} tiles in {elapsed:.1f} s "
+          f"({megapixels / max(elapsed, 1e-6):.1f} MPix/s): {output_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the multispectral raster transform (reflectance and temperature) to a raw orthomosaic export.")
+    parser.add_argument('source', type=str, help='Raw multiband orthomosaic exported without raster transform.')
+    parser.add_argument('output', type=str, help='Output GeoTIFF with 5 reflectance bands and the temperature band in degrees Celsius.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: all cores).')
+    parser.add_argument('--tile-size', type=int, default=1024, help='Edge length in pixels of the tiles processed by each worker.')
+    args = parser.parse_args()
+
+    transform_raster(args.source, args.output, workers=args.workers, tile_size=args.tile_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes read and written at once; large enough that the copy runs at disk speed
+CHUNK_SIZE = 8 * 1024 * 1024
+MANIFEST_NAME = "ingest_manifest.json"
+CHECKSUM_NAME = "checksums.sha256"
+# Seconds between writes of the manifest while a copy runs, so an interrupted ingest loses little
+MANIFEST_SAVE_INTERVAL = 10.0
+
+
+def file_checksum(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_file(source, target, chunk_size=CHUNK_SIZE):
+    """
+    Copy a file through a .partial file, hashing the source on the way; returns its sha256.
+
+    A .partial file left by an interrupted copy is continued from where it stopped, so a
+    large file is not copied again from the start. The part already copied is compared
+    with the same part of the source first, and the hash is always taken of the source,
+    so reading the copy back and comparing its hash checks the copy against the source.
+    """
+    partial = target + ".partial"
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(partial) and os.path.getmtime(source) <= os.path.getmtime(partial) \
+            and os.path.getsize(partial) <= os.path.getsize(source):
+        with open(source, 'rb') as src, open(partial, 'rb') as dst:
+            for block in iter(lambda: dst.read(chunk_size), b""):
+                if src.read(len(block)) != block:
+                    # The part copied differs from the source: copy from the start
+                    offset = 0
+                    digest = hashlib.sha256()
+                    break
+                digest.update(block)
+                offset += len(block)
+    with open(source, 'rb') as src, open(partial, 'r+b' if offset else 'wb') as dst:
+        src.seek(offset)
+        dst.seek(offset)
+        dst.truncate()
+        for block in iter(lambda: src.read(chunk_size), b""):
+            digest.update(block)
+            dst.write(block)
+        dst.flush()
+        os.fsync(dst.fileno())
+    stat = os.stat(source)
+    os.utime(partial, (stat.st_atime, stat.st_mtime))
+    os.replace(partial, target)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """
+    Record of the files ingested into a folder: source, size, time and sha256 of each.
+
+    A file is only copied again if its source changed or its copy is missing or has a
+    different size. The checksums are also written in the sha256sum format, so a copy
+    can be checked later with `sha256sum -c checksums.sha256` from the folder.
+    """
+
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+        self.path = os.path.join(target_dir, MANIFEST_NAME)
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                self.files = json.load(file)["files"]
+        self.lock = threading.RLock()
+        self.last_save = time.time()
+
+    def up_to_date(self, relpath, source):
+        entry = self.files.get(relpath)
+        target = os.path.join(self.target_dir, relpath)
+        if entry is None or not os.path.exists(target):
+            return False
+        stat = os.stat(source)
+        return (entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+                and os.path.getsize(target) == stat.st_size)
+
+    def record(self, relpath, source, checksum):
+        stat = os.stat(source)
+        with self.lock:
+            self.files[relpath] = {"source": source, "size": stat.st_size, "mtime": stat.st_mtime, "sha256": checksum,
+                                   "copied": datetime.now().isoformat(timespec="seconds")}
+            if time.time() - self.last_save > MANIFEST_SAVE_INTERVAL:
+                self.save()
+
+    def save(self):
+        with self.lock:
+            self.last_save = time.time()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump({"files": self.files}, file, indent=1)
+            os.replace(tmp_path, self.path)
+            with open(os.path.join(self.target_dir, CHECKSUM_NAME), 'w') as file:
+                for relpath, entry in sorted(self.files.items()):
+                    file.write(f"{entry['sha256']}  {relpath.replace(os.sep, '/')}\n")
+
+
+def source_files(source_dir):
+    """Files below a source folder as (path, path relative to the folder), in a stable order."""
+    files = []
+    for root, dirs, names in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files.append((path, os.path.relpath(path, source_dir)))
+    return files
+
+
+def ingest(source_dir, target_dir, workers=4, verify=True):
+    """
+    Copy everything below `source_dir` into `target_dir`, several files at a time.
+
+    Each file is hashed while it is copied and, with `verify`, the copy is read back and
+    must have the same checksum. Files already ingested unchanged are skipped, so an
+    interrupted ingest is resumed by running it again. Returns the number of files copied,
+    skipped and failed, and the bytes copied.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    manifest = IngestManifest(target_dir)
+    files = source_files(source_dir)
+    pending = [(path, relpath) for path, relpath in files if not manifest.up_to_date(relpath, path)]
+    total = sum(os.path.getsize(path) for path, _ in pending)
+    print(f"Ingesting {len(pending)} of {len(files)} files ({total / 1024 ** 3:.1f} GB) from {source_dir} to {target_dir}...")
+
+    def copy(item):
+        path, relpath = item
+        target = os.path.join(target_dir, relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            checksum = copy_file(path, target)
+            if verify and file_checksum(target) != checksum:
+                os.remove(target)
+                raise IOError("checksum of the copy differs from the source")
+        except OSError as e:
+            print(f"  Failed: {path}: {e}")
+            return 0, False
+        manifest.record(relpath, path, checksum)
+        return os.path.getsize(target), True
+
+    start_time = time.time()
+    copied = failed = copied_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size, ok in executor.map(copy, pending):
+            copied += ok
+            failed += not ok
+            copied_bytes += size
+    manifest.save()
+    elapsed = time.time() - start_time
+    print(f"Ingested {copied} files ({copied_bytes / 1024 ** 2 / max(elapsed, 1e-6):.0f} MB/s), "
+          f"{len(files) - len(pending)} already there, {failed} failed: {target_dir}")
+    return {"copied": copied, "skipped": len(files) - len(pending), "failed": failed, "bytes": copied_bytes}
+
+
+def verify_folder(target_dir, workers=4):
+    """Check every ingested file against the checksum in the manifest; returns the files that differ."""
+    manifest = IngestManifest(target_dir)
+
+    def check(item):
+        relpath, entry = item
+        path = os.path.join(target_dir, relpath)
+        return relpath if not os.path.exists(path) or file_checksum(path) != entry["sha256"] else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        bad = [relpath for relpath in executor.map(check, manifest.files.items()) if relpath]
+    print(f"Verified {len(manifest.files) - len(bad)} of {len(manifest.files)} files in {target_dir}.")
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy raw data from a field drive with checksums, resumably.")
+    parser.add_argument('source', help='Folder on the field drive.')
+    parser.add_argument('target', help='Folder to copy it into, e.g. <flight>/01_Raw/HS_Sensor_Data.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of files copied at the same time (default: 4).')
+    parser.add_argument('--no-verify', action='store_true', help='Do not read the copies back to compare their checksum.')
+    parser.add_argument('--verify-only', action='store_true', help='Only check the files in target against its manifest.')
+    args = parser.parse_args()
+
+    if args.verify_only:
+        bad = verify_folder(args.target, workers=args.workers)
+        for relpath in bad:
+            print(f"  Differs: {relpath}")
+        raise SystemExit(1 if bad else 0)
+    result = ingest(args.source, args.target, workers=args.workers, verify=not args.no_verify)
+    raise SystemExit(1 if result["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import os
+import json
+import uuid
+import hashlib
+from datetime import datetime
+
+
+def manifest_path(project_path, chunk_key=None):
+    """
+    The manifest lives next to the project in the references folder, one file per .psx and
+    chunk, with the chunk key in the file name. Without a key it is the manifest of a project
+    with a single processed chunk: tile and preview projects, and projects processed before
+    the manifests were kept per chunk.
+    """
+    base_dir = os.path.dirname(project_path)
+    project_name = os.path.splitext(os.path.basename(project_path))[0]
+    suffix = "_stages.json" if chunk_key is None else f"_chunk{chunk_key}_stages.json"
+    return os.path.join(base_dir, "references", project_name + suffix)
+
+
+def migrate_manifest(project_path, chunk_key):
+    """
+    Move the manifest of a project processed before the manifests were kept per chunk to the
+    chunk it was written for; only the active chunk was processed then. Done once: an existing
+    manifest of the chunk is never replaced.
+    """
+    legacy_path = manifest_path(project_path)
+    chunk_path = manifest_path(project_path, chunk_key)
+    if os.path.exists(legacy_path) and not os.path.exists(chunk_path):
+        print(f"Moving the stage manifest {legacy_path} to the active chunk: {chunk_path}")
+        os.replace(legacy_path, chunk_path)
+
+
+def digest(value):
+    """Stable short hash of any JSON-like value (Metashape enums are hashed by their name)."""
+    encoded = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+class ClearedProductNeeded(Exception):
+    """
+    A stage has to run but needs the product of stages that were cleared to save space.
+
+    Those stages are recorded as needed, so when the chunk is processed again they are
+    rebuilt first (see ProjectSession.process_chunk).
+    """
+
+    def __init__(self, stage, cleared):
+        super().__init__(f"Stage '{stage}' has to be rebuilt but needs the cleared product of {', '.join(cleared)}.")
+        self.stage = stage
+        self.cleared = cleared
+
+
+class StageManifest:
+    """
+    Persistent record of which processing stages are complete for a project.
+
+    Every stage is stored with its parameters, a hash of its inputs and the run id of
+    each upstream stage it depends on. A stage is only rerun if one of those changed,
+    if it never completed, or if its product is missing from the chunk. Rerunning a
+    stage gives it a new run id, which in turn invalidates everything downstream.
+
+    A product removed on purpose to free space (see ClearinStorageSpace) is recorded with
+    clear(); the stage stays complete so the stages built from it stay valid. Only if one
+    of those has to be rebuilt does the cleared stage have to run again, before it.
+    """
+
+    def __init__(self, project_path, chunk_key=None):
+        self.path = manifest_path(project_path, chunk_key)
+        self.stages = {}
+        self.pending = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                self.stages = json.load(file).get("stages", {})
+
+    def fingerprint(self, name, params, inputs, depends):
+        upstream = {dep: self.stages.get(dep, {}).get("run_id") for dep in depends}
+        return digest({"stage": name, "params": params, "inputs": inputs, "upstream": upstream})
+
+    def needs_run(self, name, params=None, inputs=None, depends=(), present=None, product=None):
+        """
+        Decide whether a stage has to run.
+
+        `present` tells whether the stage's product currently exists in the chunk, or is None
+        for stages without a product to check. Products that exist but were built before the
+        manifest was introduced are adopted as complete so that old projects are not
+        reprocessed from scratch; `product` is the key recorded for an adopted product.
+        """
+        params = params or {}
+        fingerprint = self.fingerprint(name, params, inputs, depends)
+        self.pending[name] = {"params": params, "inputs": digest(inputs), "depends": list(depends),
+                              "fingerprint": fingerprint}
+        entry = self.stages.get(name)
+
+        if entry is None and present is True and all(dep in self.stages for dep in depends):
+            print(f"Stage '{name}': existing result found, recording it in the manifest.")
+            self.complete(name, adopted=True, product=product)
+            return False
+        if entry is not None and entry.get("needed_by"):
+            print(f"Stage '{name}': product was cleared to save space and is needed by "
+                  f"'{entry['needed_by']}', rebuilding.")
+            return True
+        if entry is not None and entry["fingerprint"] == fingerprint and (present is not False or entry.get("cleared")):
+            if present is False:
+                print(f"Stage '{name}': product was cleared to save space, stages built from it are kept. Skipping.")
+            else:
+                print(f"Stage '{name}' is up to date. Skipping.")
+            del self.pending[name]
+            return False
+
+        cleared = [dep for dep in depends if self.stages.get(dep, {}).get("cleared")]
+        if cleared:
+            for dep in cleared:
+                self.stages[dep]["needed_by"] = name
+            self.save()
+            del self.pending[name]
+            raise ClearedProductNeeded(name, cleared)
+
+        if entry is None:
+            print(f"Stage '{name}' has not run yet.")
+        elif present is False:
+            print(f"Stage '{name}': product missing from the project, rebuilding.")
+        else:
+            print(f"Stage '{name}': parameters, inputs or upstream stages changed, rebuilding.")
+        return True
+
+    def complete(self, name, adopted=False, product=None):
+        """
+        Record a stage as complete with the settings passed to the last needs_run call.
+
+        `product` is the key of the product the stage built, for stages such as the DEM and
+        DTM whose product is one of several of its kind in the chunk.
+
+        The record is written by the next save(), which should follow the document save,
+        so a crash never leaves a stage marked complete that the saved project lacks.
+        """
+        entry = self.pending.pop(name)
+        entry["run_id"] = uuid.uuid4().hex
+        entry["completed_at"] = datetime.now().isoformat(timespec="seconds")
+        entry["adopted"] = adopted
+        if product is not None:
+            entry["product"] = product
+        self.stages[name] = entry
+
+    def product(self, name):
+        """Key of the product recorded for a stage by complete(), or None."""
+        return self.stages.get(name, {}).get("product")
+
+    def elevation(self, chunk, name, adopt=False):
+        """
+        The elevation of `chunk` built by stage `name` (a DEM or DTM), found by the key recorded
+        for it, since building another one makes that the active elevation. None if the stage
+        recorded no key or the elevation is gone. With `adopt`, a stage without a record yet
+        gets the oldest elevation of the chunk: projects processed before the manifest built
+        their DEM before any DTM.
+        """
+        if adopt and name not in self.stages:
+            return chunk.elevations[0] if chunk.elevations else None
+        key = self.product(name)
+        if key is None:
+            return None
+        return next((elevation for elevation in chunk.elevations if elevation.key == key), None)
+
+    def clear(self, name):
+        """Record that the product of a complete stage was removed to free space; returns False if the stage is unknown."""
+        entry = self.stages.get(name)
+        if entry is None:
+            return False
+        entry["cleared"] = datetime.now().isoformat(timespec="seconds")
+        return True
+
+    def invalidate(self, name):
+        """Forget a stage so that it and all stages depending on it rerun."""
+        if self.stages.pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"stages": self.stages}, file, indent=2, sort_keys=True, default=str)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,192 @@
+import os
+import sys
+import csv
+import json
+import time
+import threading
+from datetime import datetime
+
+from ProjectInspector import directory_size, files_dir
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def current_rss():
+    """Resident memory of this process in bytes, or None if it cannot be measured."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return None
+
+
+def lifetime_peak_rss():
+    """Peak resident memory since the process started, used when psutil is missing."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakMemorySampler:
+    """Samples the resident memory on a background thread while a stage runs."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.peak = current_rss()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if self.peak is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.peak = max(self.peak, current_rss())
+        else:
+            self.peak = lifetime_peak_rss()
+        return False
+
+
+class StageMetrics:
+    """
+    Records wall time, CPU time, peak memory and bytes written for each stage of a project.
+
+    Bytes written are the growth of the project's .files folder and of its exports folder
+    over the stage; removing data shows up as negative values. Measuring them walks both
+    folders before and after every stage, which takes a while on network storage, so they
+    are only measured with `measure_writes` and are None otherwise.
+    """
+
+    def __init__(self, project_path, measure_writes=False):
+        self.project_path = project_path
+        self.measure_writes = measure_writes
+        self.watch_dirs = {"project": files_dir(project_path),
+                           "exports": os.path.join(os.path.dirname(project_path), "exports")}
+        self.records = []
+
+    def measure_dirs(self):
+        if not self.measure_writes:
+            return dict.fromkeys(self.watch_dirs)
+        return {name: directory_size(path) for name, path in self.watch_dirs.items()}
+
+    def record(self, stage, image_count=None):
+        return _StageRecording(self, stage, image_count)
+
+    def write_json(self, log_dir):
+        """Write the records of this project to logs/<project>_metrics_<time>.json."""
+        os.makedirs(log_dir, exist_ok=True)
+        project_name = os.path.splitext(os.path.basename(self.project_path))[0]
+        path = os.path.join(log_dir, f"{project_name}_metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(path, 'w') as file:
+            json.dump({"project": self.project_path, "stages": self.records}, file, indent=2)
+        return path
+
+
+def growth(before, after):
+    return after - before if before is not None and after is not None else None
+
+
+class _StageRecording:
+    def __init__(self, metrics, stage, image_count):
+        self.metrics = metrics
+        self.stage = stage
+        self.image_count = image_count
+
+    def __enter__(self):
+        self.sizes_before = self.metrics.measure_dirs()
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.wall_start = time.perf_counter()
+        # Metashape runs its processing threads inside this process, so they count here
+        self.cpu_start = time.process_time()
+        self.sampler = PeakMemorySampler().__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.sampler.__exit__(exc_type, exc_value, tb)
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = time.process_time() - self.cpu_start
+        sizes_after = self.metrics.measure_dirs()
+        record = {
+            "stage": self.stage,
+            "status": "ok" if exc_type is None else "failed",
+            "started_at": self.started_at,
+            "wall_seconds": round(wall_time, 3),
+            "cpu_seconds": round(cpu_time, 3),
+            "peak_rss_bytes": self.sampler.peak,
+            "project_bytes_written": growth(self.sizes_before["project"], sizes_after["project"]),
+            "export_bytes_written": growth(self.sizes_before["exports"], sizes_after["exports"]),
+            "image_count": self.image_count,
+        }
+        self.metrics.records.append(record)
+        print(f"Stage '{self.stage}' took {wall_time:.1f} s wall, {cpu_time:.1f} s CPU.")
+        return False
+
+
+BATCH_FIELDS = ["project", "stage", "status", "started_at", "wall_seconds", "cpu_seconds", "peak_rss_bytes",
+                "project_bytes_written", "export_bytes_written", "image_count"]
+
+
+def write_batch_csv(results, path):
+    """One row per project and stage of a batch."""
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=BATCH_FIELDS)
+        writer.writeheader()
+        for result in results:
+            for record in result["stats"].get("stages", []):
+                writer.writerow(dict(record, project=result["project"]))
+
+
+def write_prometheus_textfile(results, path):
+    """Write the stage metrics in the Prometheus textfile collector format."""
+    metrics = [
+        ("wall_seconds", "Wall time of a processing stage in seconds"),
+        ("cpu_seconds", "CPU time of a processing stage in seconds"),
+        ("peak_rss_bytes", "Peak resident memory during a processing stage"),
+        ("project_bytes_written", "Growth of the project folder during a processing stage"),
+        ("export_bytes_written", "Growth of the exports folder during a processing stage"),
+    ]
+    lines = []
+    for field, help_text in metrics:
+        name = f"geco_stage_{field}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for result in results:
+            project = os.path.splitext(os.path.basename(result["project"]))[0]
+            for record in result["stats"].get("stages", []):
+                if record[field] is not None:
+                    lines.append(f'{name}{{project="{project}",stage="{record["stage"]}"}} {record[field]}')
+    lines.append("# HELP geco_project_save_seconds Time spent saving the project")
+    lines.append("# TYPE geco_project_save_seconds gauge")
+    for result in results:
+        project = os.path.splitext(os.path.basename(result["project"]))[0]
+        lines.append(f'geco_project_save_seconds{{project="{project}"}} {result["stats"].get("save_time", 0.0)}')
+    # Write next to the target and rename, so the collector never reads a half written file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def write_batch_metrics(results, metrics_dir):
+    os.makedirs(metrics_dir, exist_ok=True)
+    csv_path = os.path.join(metrics_dir, f"batch_metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    write_batch_csv(results, csv_path)
+    write_prometheus_textfile(results, os.path.join(metrics_dir, "geco_processing.prom"))
+    print(f"Batch metrics written to {csv_path}")
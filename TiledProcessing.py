@@ -0,0 +1,294 @@
+import Metashape
+import os
+import json
+import math
+import shutil
+import itertools
+
+import BatchScheduler
+import ExportCache
+from ProjectSession import ProjectSession
+from StageManifest import StageManifest, digest
+
+# Processing settings of the tiles, the same as for whole flights in Geco2024AlignDemOrthoExport
+DEPTH_PARAMS = dict(downscale=1, filter_mode=Metashape.MildFiltering)
+POINT_CLOUD_PARAMS = dict(source_data=Metashape.DataSource.DepthMapsData, point_colors=True)
+DEM_PARAMS = dict(source_data=Metashape.PointCloudData, interpolation=Metashape.EnabledInterpolation)
+ORTHO_PARAMS = dict(surface_data=Metashape.ElevationData, blending_mode=Metashape.DisabledBlending)
+
+# Products mosaicked from the tiles, by the suffix of their export
+PRODUCTS = ("_DEM.tif", "_Ortho.tif")
+
+
+def parse_tiles(value):
+    """Parse the --tiles option, e.g. '3x2' for 3 columns and 2 rows."""
+    try:
+        cols, rows = (int(n) for n in value.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Tiles must be given as COLSxROWS, e.g. 3x2, not '{value}'")
+    if cols < 1 or rows < 1:
+        raise ValueError(f"Tiles must be given as COLSxROWS, e.g. 3x2, not '{value}'")
+    return cols, rows
+
+
+def crs_bounds(chunk, center, size):
+    """Bounds (left, bottom, right, top) in the chunk's CRS of a box in the region's axes."""
+    xs, ys = [], []
+    for corner in itertools.product((-0.5, 0.5), repeat=3):
+        offset = Metashape.Vector([corner[0] * size[0], corner[1] * size[1], corner[2] * size[2]])
+        point = chunk.crs.project(chunk.transform.matrix.mulp(center + chunk.region.rot * offset))
+        xs.append(point.x)
+        ys.append(point.y)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def tile_plan(chunk, cols, rows, overlap=0.1, label=None):
+    """
+    Split the region of the chunk into cols x rows tiles along the region's horizontal axes.
+
+    Each tile is processed with its core enlarged by `overlap` of the core size on every
+    side, so the products are complete up to the edge of the core; only the core is used
+    in the mosaic.
+    """
+    region = chunk.region
+    core_x, core_y = region.size.x / cols, region.size.y / rows
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            offset = Metashape.Vector([-region.size.x / 2 + (col + 0.5) * core_x,
+                                       -region.size.y / 2 + (row + 0.5) * core_y, 0.0])
+            center = region.center + region.rot * offset
+            tiles.append({"name": f"{label or chunk.label}_r{row}_c{col}", "row": row, "col": col,
+                          "center": [center.x, center.y, center.z],
+                          "size": [core_x * (1 + 2 * overlap), core_y * (1 + 2 * overlap), region.size.z],
+                          "core_bounds": crs_bounds(chunk, center, [core_x, core_y, region.size.z])})
+    return tiles
+
+
+def create_tiles(doc, chunk, plan, tiles_dir, camera_margin=0.5):
+    """
+    Save every tile as a project of its own, holding a copy of the aligned chunk.
+
+    Only cameras whose center lies within the tile, enlarged by `camera_margin` of the
+    tile size, stay enabled, so depth maps are computed for the images the tile needs.
+    """
+    if os.path.isdir(tiles_dir):
+        shutil.rmtree(tiles_dir)
+    os.makedirs(tiles_dir)
+    tile_paths = []
+    for tile in plan:
+        tile_doc = Metashape.Document()
+        tile_doc.append(doc, chunks=[chunk])
+        tile_chunk = tile_doc.chunk
+        tile_chunk.label = tile["name"]
+        region = Metashape.Region()
+        region.center = Metashape.Vector(tile["center"])
+        region.size = Metashape.Vector(tile["size"])
+        region.rot = chunk.region.rot
+        tile_chunk.region = region
+
+        enabled = 0
+        for camera in tile_chunk.cameras:
+            inside = False
+            if camera.center is not None:
+                local = region.rot.t() * (camera.center - region.center)
+                inside = all(abs(local[i]) <= tile["size"][i] * (0.5 + camera_margin) for i in (0, 1))
+            camera.enabled = camera.enabled and inside
+            enabled += camera.enabled
+        tile_path = os.path.join(tiles_dir, tile["name"] + ".psx")
+        tile_doc.save(tile_path)
+        tile_paths.append(tile_path)
+        print(f"Tile {tile['name']}: {enabled} of {len(tile_chunk.cameras)} cameras.")
+
+    with open(os.path.join(tiles_dir, "tiles.json"), 'w') as file:
+        json.dump({"tiles": plan}, file, indent=2)
+    return tile_paths
+
+
+def process_tile(tile_path, crs_code="EPSG::4326", **session_options):
+    """Build and export the dense products of one tile; run by the batch scheduler like any project."""
+    session = ProjectSession(tile_path, **session_options)
+    chunk = session.doc.chunk
+    export_dir = os.path.join(os.path.dirname(tile_path), "exports")
+    os.makedirs(export_dir, exist_ok=True)
+
+    coord_system = Metashape.CoordinateSystem(crs_code)
+    chunk.crs = coord_system
+    ortho_proj = Metashape.OrthoProjection()
+    ortho_proj.crs = coord_system
+
+    # Tiles are only intermediate products, mosaicked and compressed again afterwards
+    compression = Metashape.ImageCompression()
+    compression.tiff_compression = Metashape.ImageCompression.TiffCompressionLZW
+    compression.tiff_big = True
+    compression.tiff_tiled = True
+
+    manifest = StageManifest(tile_path)
+    session.on_save(manifest.save)
+
+    if manifest.needs_run("depth_maps", params=DEPTH_PARAMS, present=chunk.depth_maps is not None):
+        with session.stage("depth_maps") as progress:
+            chunk.buildDepthMaps(progress=progress, **DEPTH_PARAMS)
+            manifest.complete("depth_maps")
+    if manifest.needs_run("point_cloud", params=POINT_CLOUD_PARAMS, depends=["depth_maps"],
+                          present=chunk.point_cloud is not None):
+        with session.stage("point_cloud") as progress:
+            chunk.buildPointCloud(progress=progress, **POINT_CLOUD_PARAMS)
+            manifest.complete("point_cloud")
+    dem = manifest.elevation(chunk, "dem", adopt=True)
+    if manifest.needs_run("dem", params=dict(DEM_PARAMS, crs=crs_code), depends=["point_cloud"],
+                          present=dem is not None, product=dem.key if dem else None):
+        with session.stage("dem") as progress:
+            chunk.buildDem(progress=progress, projection=ortho_proj, **DEM_PARAMS)
+            dem = chunk.elevation
+            manifest.complete("dem", product=dem.key)
+    # Orthomosaic and export use the active elevation
+    chunk.elevation = dem
+    if manifest.needs_run("orthomosaic", params=dict(ORTHO_PARAMS, crs=crs_code), depends=["dem"],
+                          present=chunk.orthomosaic is not None):
+        with session.stage("orthomosaic") as progress:
+            chunk.buildOrthomosaic(progress=progress, projection=ortho_proj, **ORTHO_PARAMS)
+            manifest.complete("orthomosaic")
+
+    export_settings = dict(crs=crs_code, compression=ExportCache.compression_settings(compression))
+    exports = [("_DEM.tif", "dem", dict(source_data=Metashape.ElevationData, image_format=Metashape.ImageFormatTIFF)),
+               ("_Ortho.tif", "orthomosaic", dict(source_data=Metashape.OrthomosaicData, image_format=Metashape.ImageFormatTIFF,
+                                                  raster_transform=Metashape.RasterTransformValue))]
+    for suffix, source, export in exports:
+        path = os.path.join(export_dir, chunk.label + suffix)
+        fingerprint = ExportCache.export_fingerprint(manifest, [source], **export, **export_settings)
+        if not ExportCache.up_to_date(path, fingerprint):
+            with session.stage("export_" + source, modifies=False) as progress, \
+                    ExportCache.atomic_export(path, fingerprint) as tmp_path:
+                chunk.exportRaster(progress=progress, path=tmp_path, image_compression=compression, projection=ortho_proj,
+                                   **export)
+    session.close()
+    return session.stats
+
+
+def mosaic(tiles, output_path):
+    """
+    Mosaic tile rasters into one GeoTIFF, each tile contributing the pixels of its core.
+
+    `tiles` lists (raster path, core bounds) pairs. The mosaic gets the finest resolution
+    of the tiles, and every tile is resampled onto it one at a time, so memory use is
+    set by the size of a tile, not of the mosaic. Where cores overlap (regions that are
+    rotated against the CRS axes) the first tile with data wins.
+    """
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.warp import reproject, Resampling
+    from rasterio.windows import from_bounds, Window
+
+    with rasterio.open(tiles[0][0]) as first:
+        profile = first.profile.copy()
+        crs = first.crs
+    resolutions = []
+    for path, _ in tiles:
+        with rasterio.open(path) as src:
+            resolutions.append(src.res)
+    res_x = min(r[0] for r in resolutions)
+    res_y = min(r[1] for r in resolutions)
+    left = min(core[0] for _, core in tiles)
+    bottom = min(core[1] for _, core in tiles)
+    right = max(core[2] for _, core in tiles)
+    top = max(core[3] for _, core in tiles)
+    width = max(int(math.ceil((right - left) / res_x)), 1)
+    height = max(int(math.ceil((top - bottom) / res_y)), 1)
+    transform = from_origin(left, top, res_x, res_y)
+
+    dtype = np.dtype(profile["dtype"])
+    nodata = profile.get("nodata")
+    if nodata is None:
+        nodata = -32767.0 if dtype.kind == "f" else 0
+    profile.update(driver="GTiff", width=width, height=height, transform=transform, nodata=nodata,
+                   tiled=True, blockxsize=256, blockysize=256, compress="lzw", BIGTIFF="IF_SAFER")
+    profile.pop("photometric", None)
+
+    with rasterio.open(output_path, "w+", **profile) as dst:
+        for path, core in tiles:
+            window = from_bounds(*core, transform=transform).round_offsets().round_lengths()
+            window = window.intersection(Window(0, 0, width, height))
+            block = np.full((profile["count"], int(window.height), int(window.width)), nodata, dtype=dtype)
+            with rasterio.open(path) as src:
+                reproject(source=rasterio.band(src, list(range(1, src.count + 1))), destination=block,
+                          src_transform=src.transform, src_crs=src.crs, src_nodata=src.nodata if src.nodata is not None else nodata,
+                          dst_transform=dst.window_transform(window), dst_crs=crs, dst_nodata=nodata,
+                          resampling=Resampling.nearest)
+            existing = dst.read(window=window)
+            missing = existing == nodata
+            existing[missing] = block[missing]
+            dst.write(existing, window=window)
+        dst.build_overviews([2, 4, 8, 16, 32], Resampling.average)
+    print(f"Mosaicked {len(tiles)} tiles into {width} x {height} pixels: {output_path}")
+
+
+def process_tiled(session, manifest, chunk, tiles, overlap=0.1, workers=1, crs_code="EPSG::4326", camera_margin=0.5,
+                  label=None):
+    """
+    Build the DEM and orthomosaic of a large flight tile by tile and mosaic them into the exports.
+
+    The aligned chunk is split into tiles that are saved as projects of their own in
+    the <project>.tiles/<label> folder next to the project, processed by the batch scheduler with up to
+    `workers` tiles at once, and their exports mosaicked into exports/<label>_DEM.tif and
+    exports/<label>_Ortho.tif. Peak memory is set by the tile size. Tiles keep their own
+    stage manifests, so an interrupted run continues with the tiles not yet done.
+    """
+    project_path = session.project_path
+    base_dir = os.path.dirname(project_path)
+    label = label or chunk.label
+    tiles_dir = os.path.join(os.path.splitext(project_path)[0] + ".tiles", label)
+    plan_path = os.path.join(tiles_dir, "tiles.json")
+    cols, rows = tiles
+
+    tile_params = dict(cols=cols, rows=rows, overlap=overlap, camera_margin=camera_margin)
+    if manifest.needs_run("tiles", params=tile_params, depends=["optimize"], present=os.path.exists(plan_path)):
+        with session.stage("tiles", modifies=False):
+            print(f"Splitting the chunk into {cols} x {rows} tiles...")
+            plan = tile_plan(chunk, cols, rows, overlap, label)
+            create_tiles(session.doc, chunk, plan, tiles_dir, camera_margin)
+            manifest.complete("tiles")
+        # The manifest is only written with a save; nothing in the project changed
+        manifest.save()
+    with open(plan_path, 'r') as file:
+        plan = json.load(file)["tiles"]
+
+    tile_paths = [os.path.join(tiles_dir, tile["name"] + ".psx") for tile in plan]
+    results = BatchScheduler.run_batch(process_tile, tile_paths, workers=workers, retries=1, crs_code=crs_code)
+    failed = [os.path.basename(r["project"]) for r in results if r["status"] != "ok"]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(plan)} tiles failed: {', '.join(failed)}")
+    for result in results:
+        for record in result["stats"].get("stages", []):
+            session.metrics.records.append(dict(record, stage="tile_" + record["stage"]))
+
+    export_dir = os.path.join(base_dir, "exports")
+    for suffix in PRODUCTS:
+        tile_exports = [(os.path.join(tiles_dir, "exports", tile["name"] + suffix), tile["core_bounds"]) for tile in plan]
+        output_path = os.path.join(export_dir, label + suffix)
+        tile_fingerprints = [ExportCache.recorded_fingerprint(path) for path, _ in tile_exports]
+        fingerprint = None if None in tile_fingerprints else digest({"tiles": tile_fingerprints, "plan": plan})
+        if ExportCache.up_to_date(output_path, fingerprint):
+            print(f"Mosaic {output_path} is up to date. Skipping.")
+            continue
+        with session.stage("mosaic" + suffix.split(".")[0].lower(), modifies=False), \
+                ExportCache.atomic_export(output_path, fingerprint) as tmp_path:
+            mosaic(tile_exports, tmp_path)
+
+
+def add_tiling_arguments(parser):
+    """Command line options for processing large flights in tiles."""
+    parser.add_argument('--tiles', type=str, default=None,
+                        help='Build the dense cloud, DEM and orthomosaic in COLSxROWS tiles (e.g. 3x3) and mosaic them.')
+    parser.add_argument('--tile-overlap', type=float, default=10.0,
+                        help='Overlap of neighbouring tiles in percent of the tile size (default: 10).')
+    parser.add_argument('--tile-workers', type=int, default=1,
+                        help='Number of tiles of a project processed at the same time (default: 1).')
+
+
+def tiling_settings(args):
+    """Settings of the tiling mode from the command line, or None to process flights whole."""
+    if not args.tiles:
+        return None
+    return {"tiles": parse_tiles(args.tiles), "overlap": args.tile_overlap / 100.0, "workers": args.tile_workers}
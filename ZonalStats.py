@@ -0,0 +1,232 @@
+"""
+Per-plot statistics of the orthomosaic bands, without Metashape or a GIS.
+
+The plot polygons are read from GeoJSON and indexed by the raster tiles they touch, so only
+the tiles under a plot are ever read. Each tile is read once for all the plots in it; the
+pixels of a plot are selected with a rasterized mask across all bands at once and kept per
+plot until the percentiles are taken. Memory use therefore depends on the size of the plots,
+not of the orthomosaic. A season of flights is summarized in parallel, one flight per worker.
+"""
+import os
+import csv
+import json
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.warp import transform_geom
+    from rasterio.windows import Window, from_bounds
+except ImportError:
+    np = rasterio = None
+
+from CogConversion import alpha_bands, band_validity
+
+# Bands of the orthomosaic exported with the raster transform of the processing scripts
+TRANSFORMED_BANDS = ("blue", "green", "red", "red_edge", "nir", "temperature_c")
+PERCENTILES = (5, 25, 50, 75, 95)
+STAT_FIELDS = (["flight", "plot", "band", "pixels", "valid_pixels", "valid_fraction", "mean", "std", "min"]
+               + [f"p{q}" for q in PERCENTILES] + ["max"])
+DEFAULT_TILE_SIZE = 1024
+# GeoJSON coordinates are WGS 84 unless the file names another CRS
+GEOJSON_CRS = "EPSG:4326"
+
+
+def _bounds(geometry):
+    coords = np.array(_flatten(geometry["coordinates"]), dtype=np.float64)
+    return coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max()
+
+
+def _flatten(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        return [coordinates[:2]]
+    return [point for part in coordinates for point in _flatten(part)]
+
+
+def load_plots(path, id_field="plot"):
+    """The plot polygons of a GeoJSON file as (plot id, geometry, crs), in file order."""
+    with open(path, 'r') as file:
+        collection = json.load(file)
+    crs = collection.get("crs", {}).get("properties", {}).get("name", GEOJSON_CRS)
+    plots = []
+    for i, feature in enumerate(collection["features"]):
+        geometry = feature.get("geometry")
+        if not geometry or geometry["type"] not in ("Polygon", "MultiPolygon"):
+            continue
+        properties = feature.get("properties") or {}
+        plot_id = properties.get(id_field, feature.get("id", i))
+        plots.append((str(plot_id), geometry, crs))
+    if not plots:
+        raise ValueError(f"No plot polygons in {path}")
+    return plots
+
+
+def band_names(dataset):
+    """Names of the bands to summarize, without the alpha band: their descriptions, the transformed bands or B1, B2..."""
+    bands = [i for i in range(dataset.count) if i not in alpha_bands(dataset)]
+    if all(dataset.descriptions[i] for i in bands):
+        return bands, [dataset.descriptions[i] for i in bands]
+    if len(bands) == len(TRANSFORMED_BANDS):
+        return bands, list(TRANSFORMED_BANDS)
+    return bands, [f"B{i + 1}" for i in bands]
+
+
+def tile_index(dataset, plots, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Spatial index of the plots by raster tile: {(tile row, tile col): [plot numbers]}, with the
+    plot geometries in the CRS of the raster. Plots outside the raster are left out of the index.
+    """
+    geometries = []
+    index = {}
+    for number, (_, geometry, crs) in enumerate(plots):
+        if dataset.crs and crs and rasterio.crs.CRS.from_user_input(crs) != dataset.crs:
+            geometry = transform_geom(crs, dataset.crs, geometry)
+        geometries.append(geometry)
+        window = from_bounds(*_bounds(geometry), transform=dataset.transform)
+        first_row, first_col = max(math.floor(window.row_off), 0), max(math.floor(window.col_off), 0)
+        last_row = min(math.ceil(window.row_off + window.height), dataset.height) - 1
+        last_col = min(math.ceil(window.col_off + window.width), dataset.width) - 1
+        for row in range(first_row // tile_size, last_row // tile_size + 1):
+            for col in range(first_col // tile_size, last_col // tile_size + 1):
+                index.setdefault((row, col), []).append(number)
+    return geometries, index
+
+
+def summarize(values, pixels):
+    """Statistics of the valid values of one plot and band."""
+    stats = dict(pixels=pixels, valid_pixels=int(values.size), valid_fraction=values.size / pixels if pixels else 0.0)
+    if values.size:
+        percentiles = np.percentile(values, PERCENTILES)
+        stats.update(mean=float(values.mean()), std=float(values.std()), min=float(values.min()), max=float(values.max()))
+        stats.update({f"p{q}": float(p) for q, p in zip(PERCENTILES, percentiles)})
+    return stats
+
+
+def zonal_statistics(raster_path, plots, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Statistics of every band of a raster per plot, as one row per plot and band.
+
+    `plots` are the (plot id, geometry, crs) of load_plots. A pixel belongs to a plot if its
+    centre is inside the polygon; overlapping plots each count the shared pixels. Pixels
+    outside the alpha mask, no-data and non-finite values are not valid.
+    """
+    if rasterio is None:
+        raise ImportError("The zonal statistics need numpy and rasterio.")
+    flight = os.path.splitext(os.path.basename(raster_path))[0]
+    with rasterio.open(raster_path) as src:
+        bands, names = band_names(src)
+        geometries, index = tile_index(src, plots, tile_size)
+        values = [[[] for _ in bands] for _ in plots]
+        pixels = [0] * len(plots)
+        for (row, col), numbers in sorted(index.items()):
+            window = Window(col * tile_size, row * tile_size,
+                            min(tile_size, src.width - col * tile_size), min(tile_size, src.height - row * tile_size))
+            block = src.read(window=window)
+            valid = band_validity(src, block, window)[bands]
+            block = block[bands]
+            transform = src.window_transform(window)
+            for number in numbers:
+                mask = rasterize([geometries[number]], out_shape=block.shape[1:], transform=transform,
+                                 fill=0, default_value=1, dtype="uint8").astype(bool)
+                if not mask.any():
+                    continue
+                pixels[number] += int(mask.sum())
+                plot_block, plot_valid = block[:, mask], valid[:, mask]
+                for band in range(len(bands)):
+                    values[number][band].append(plot_block[band][plot_valid[band]])
+
+    rows = []
+    for number, (plot_id, _, _) in enumerate(plots):
+        for band, name in enumerate(names):
+            band_values = values[number][band]
+            band_values = np.concatenate(band_values).astype(np.float64) if band_values else np.empty(0)
+            rows.append(dict(flight=flight, plot=plot_id, band=name, **summarize(band_values, pixels[number])))
+    return rows
+
+
+def write_table(rows, path):
+    """Write the statistics as a tidy table: one row per flight, plot and band."""
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=STAT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def zonal_path(raster_path):
+    """The table of a flight is written next to its orthomosaic."""
+    return os.path.splitext(raster_path)[0] + "_zonal.csv"
+
+
+def summarize_flight(raster_path, plots_path, id_field="plot", tile_size=DEFAULT_TILE_SIZE):
+    """Write the per-plot statistics of one orthomosaic next to it and return them."""
+    rows = zonal_statistics(raster_path, load_plots(plots_path, id_field), tile_size)
+    write_table(rows, zonal_path(raster_path))
+    print(f"Plot statistics of {raster_path} written to {zonal_path(raster_path)}.")
+    return rows
+
+
+def update_flight(raster_path, plots_path, id_field="plot"):
+    """The plot statistics stage of the processing scripts: summarize an export unless its table is newer than it and the plots."""
+    if not os.path.exists(raster_path):
+        return
+    table_path = zonal_path(raster_path)
+    if os.path.exists(table_path) and os.path.getmtime(table_path) >= max(os.path.getmtime(raster_path),
+                                                                           os.path.getmtime(plots_path)):
+        print(f"Plot statistics {table_path} are up to date. Skipping.")
+        return
+    summarize_flight(raster_path, plots_path, id_field)
+
+
+def summarize_season(raster_paths, plots_path, output_path=None, id_field="plot", workers=None,
+                     tile_size=DEFAULT_TILE_SIZE):
+    """Summarize the flights in parallel, one flight per worker, and optionally write all rows to one table."""
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers or min(len(raster_paths), os.cpu_count())) as executor:
+        futures = [executor.submit(summarize_flight, path, plots_path, id_field, tile_size) for path in raster_paths]
+        for future in futures:
+            rows.extend(future.result())
+    if output_path:
+        write_table(rows, output_path)
+        print(f"Plot statistics of {len(raster_paths)} flights written to {output_path}.")
+    return rows
+
+
+def add_zonal_arguments(parser):
+    """Command line options of the plot statistics stage of the processing scripts."""
+    parser.add_argument('--plots', type=str, default=None,
+                        help='GeoJSON of the plot polygons; writes the statistics of each orthomosaic band per plot '
+                             'to exports/<chunk>_Ortho_zonal.csv (requires numpy and rasterio).')
+    parser.add_argument('--plot-id-field', type=str, default="plot",
+                        help='Property of the plot polygons holding the plot name (default: plot).')
+
+
+def zonal_settings(args):
+    """The settings of the plot statistics stage, or None without --plots."""
+    if not args.plots:
+        return None
+    if rasterio is None:
+        # Fail before the projects are processed rather than after
+        raise ImportError("The zonal statistics need numpy and rasterio.")
+    load_plots(args.plots, args.plot_id_field)
+    return {"plots_path": args.plots, "id_field": args.plot_id_field}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Statistics of the orthomosaic bands per plot, for a season of flights.")
+    parser.add_argument('plots', help='GeoJSON of the plot polygons.')
+    parser.add_argument('orthomosaics', nargs='+', help='Orthomosaic exports, one per flight.')
+    parser.add_argument('--id-field', type=str, default="plot", help='Property of the polygons holding the plot name (default: plot).')
+    parser.add_argument('--output', type=str, default=None, help='Table of all flights, in addition to the table next to each orthomosaic.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of flights summarized at once (default: all cores).')
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE, help='Edge length in pixels of the tiles read.')
+    args = parser.parse_args()
+
+    summarize_season(args.orthomosaics, args.plots, output_path=args.output, id_field=args.id_field,
+                     workers=args.workers, tile_size=args.tile_size)
+
+
+if __name__ == "__main__":
+    main()
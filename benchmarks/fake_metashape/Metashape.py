@@ -0,0 +1,454 @@
+"""
+Stand-in for the Metashape Python module, used to benchmark the processing scripts
+on machines without a Metashape license.
+
+Processing calls sleep for a configurable time and mark their product as built in a
+small state file next to the project; exports write files of a configurable size.
+The configuration is read from the JSON file named by FAKE_METASHAPE_CONFIG, missing
+keys fall back to DEFAULT_CONFIG. If FAKE_METASHAPE_STATS names a directory, the
+duration of every call is appended there as JSON lines, one file per process.
+"""
+import os
+import json
+import time
+
+DEFAULT_CONFIG = {
+    # Seconds per call, calls listed in per_image are multiplied by the number of images
+    "latency": {
+        "open": 0.05,
+        "matchPhotos": 0.0005,
+        "alignCameras": 0.0003,
+        "filter": 0.01,
+        "optimizeCameras": 0.02,
+        "buildDepthMaps": 0.001,
+        "buildPointCloud": 0.0005,
+        "classifyGroundPoints": 0.05,
+        "buildModel": 0.05,
+        "decimateModel": 0.01,
+        "smoothModel": 0.01,
+        "buildDem": 0.05,
+        "buildOrthomosaic": 0.1,
+        "exportRaster": 0.05,
+        "exportPointCloud": 0.05,
+        "exportReport": 0.02,
+        "removeOrthophotos": 0.01,
+    },
+    "per_image": ["matchPhotos", "alignCameras", "buildDepthMaps", "buildPointCloud"],
+    # Saving costs a fixed time plus a time proportional to the size of the built products
+    "save_seconds": 0.02,
+    "save_seconds_per_gb": 0.5,
+    # Size of the built products in MB, used for the save time and the export sizes
+    "sizes_mb": {"depth_maps": 400, "point_cloud": 300, "model": 20, "dem": 40, "orthomosaic": 200},
+    # Size of exported files in MB; with write_outputs false they are created sparse
+    "export_mb": {"raster": 50, "point_cloud": 100, "report": 1},
+    "write_outputs": False,
+    "time_scale": 1.0,
+}
+
+
+def _load_config():
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    path = os.environ.get("FAKE_METASHAPE_CONFIG")
+    if path:
+        with open(path, 'r') as file:
+            user_config = json.load(file)
+        for key, value in user_config.items():
+            if isinstance(value, dict):
+                config[key].update(value)
+            else:
+                config[key] = value
+    return config
+
+
+CONFIG = _load_config()
+
+
+def _record(call, seconds):
+    stats_dir = os.environ.get("FAKE_METASHAPE_STATS")
+    if stats_dir:
+        with open(os.path.join(stats_dir, f"{os.getpid()}.jsonl"), 'a') as file:
+            file.write(json.dumps({"call": call, "seconds": seconds}) + "\n")
+
+
+def _simulate(call, images=1, progress=None):
+    seconds = CONFIG["latency"].get(call, 0.0) * CONFIG["time_scale"]
+    if call in CONFIG["per_image"]:
+        seconds *= images
+    start_time = time.time()
+    if progress is not None:
+        for step in range(1, 11):
+            time.sleep(seconds / 10)
+            progress(step * 10.0)
+    else:
+        time.sleep(seconds)
+    _record(call, time.time() - start_time)
+
+
+def _write_output(path, size_mb):
+    with open(path, 'wb') as file:
+        if CONFIG["write_outputs"]:
+            block = b"\0" * (1024 * 1024)
+            for _ in range(int(size_mb)):
+                file.write(block)
+        else:
+            file.truncate(int(size_mb * 1024 * 1024))
+
+
+class _Constant:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"Metashape.{self.name}"
+
+
+def __getattr__(name):
+    # Enum values such as Metashape.MildFiltering or Metashape.ElevationData
+    if name[:1].isupper():
+        return _Constant(name)
+    raise AttributeError(name)
+
+
+class _Namespace:
+    def __getattr__(self, name):
+        return _Constant(name)
+
+
+DataSource = _Namespace()
+PointClass = _Namespace()
+
+
+class Vector(list):
+    """Just enough vector arithmetic for the region handling of the scripts."""
+
+    x = property(lambda self: self[0])
+    y = property(lambda self: self[1])
+    z = property(lambda self: self[2])
+
+    def __add__(self, other):
+        return Vector(a + b for a, b in zip(self, other))
+
+    def __sub__(self, other):
+        return Vector(a - b for a, b in zip(self, other))
+
+    def __mul__(self, factor):
+        return Vector(a * factor for a in self)
+
+
+class Matrix:
+    """Identity rotation and transform; the fake chunks are not georeferenced."""
+
+    def __mul__(self, vector):
+        return Vector(vector)
+
+    def mulp(self, point):
+        return Vector(point)
+
+    def t(self):
+        return self
+
+
+class Region:
+    def __init__(self, center=(0.0, 0.0, 0.0), size=(0.0, 0.0, 0.0)):
+        self.center = Vector(center)
+        self.size = Vector(size)
+        self.rot = Matrix()
+
+
+class ChunkTransform:
+    def __init__(self):
+        self.matrix = Matrix()
+
+
+class CoordinateSystem:
+    def __init__(self, wkt=""):
+        self.name = wkt
+
+    def project(self, point):
+        return Vector(point)
+
+
+class OrthoProjection:
+    def __init__(self):
+        self.crs = None
+
+
+class ImageCompression:
+    TiffCompressionNone = _Constant("ImageCompression.TiffCompressionNone")
+    TiffCompressionLZW = _Constant("ImageCompression.TiffCompressionLZW")
+    TiffCompressionJPEG = _Constant("ImageCompression.TiffCompressionJPEG")
+    TiffCompressionPackbits = _Constant("ImageCompression.TiffCompressionPackbits")
+    TiffCompressionDeflate = _Constant("ImageCompression.TiffCompressionDeflate")
+
+    def __init__(self):
+        self.tiff_compression = ImageCompression.TiffCompressionLZW
+        self.jpeg_quality = 90
+        self.tiff_big = False
+        self.tiff_overviews = False
+        self.tiff_tiled = False
+
+
+class RasterTransform:
+    def __init__(self):
+        self.formula = []
+        self.enabled = False
+
+
+class Camera:
+    def __init__(self, label, aligned, center, enabled=True):
+        self.label = label
+        self.transform = [1.0] if aligned else None
+        self.center = Vector(center) if aligned else None
+        self.enabled = enabled
+
+
+class Sensor:
+    def __init__(self, label, layer_index):
+        self.label = label
+        self.layer_index = layer_index
+
+
+class _Product:
+    """A built product; its presence in the chunk is all the scripts look at."""
+
+    def __init__(self, chunk, kind, key=0):
+        self.chunk = chunk
+        self.kind = kind
+        self.key = key
+        self.label = f"{kind} {key}"
+
+    def removeOrthophotos(self):
+        _simulate("removeOrthophotos")
+
+    def classifyGroundPoints(self, progress=None, **kwargs):
+        _simulate("classifyGroundPoints", progress=progress)
+        self.chunk.state["classified"] = True
+
+    def removeKeypoints(self):
+        pass
+
+
+class _Model(_Product):
+    @property
+    def faces(self):
+        return [None] * 1000
+
+
+class TiePoints:
+    class Filter:
+        ReprojectionError = _Constant("TiePoints.Filter.ReprojectionError")
+        ReconstructionUncertainty = _Constant("TiePoints.Filter.ReconstructionUncertainty")
+        ProjectionAccuracy = _Constant("TiePoints.Filter.ProjectionAccuracy")
+        ImageCount = _Constant("TiePoints.Filter.ImageCount")
+
+        # Largest value of each criterion on a freshly aligned chunk
+        SPREAD = {"ReprojectionError": 1.2, "ReconstructionUncertainty": 30.0, "ProjectionAccuracy": 8.0,
+                  "ImageCount": 10.0}
+
+        def __init__(self):
+            self.values = []
+            self.chunk = None
+
+        def init(self, chunk, criterion):
+            _simulate("filter")
+            # Values spread evenly up to a maximum that shrinks as points are removed
+            self.chunk = chunk
+            initial = chunk.state.setdefault("initial_tie_points", 1000)
+            count = chunk.state.setdefault("tie_points", initial)
+            spread = self.SPREAD[criterion.name.split(".")[-1]] * (count / initial) ** 2
+            self.values = [spread * (i + 1) / count for i in range(count)]
+
+        def selectPoints(self, threshold):
+            pass
+
+        def removePoints(self, threshold):
+            self.values = [v for v in self.values if v <= threshold]
+            if self.chunk is not None:
+                self.chunk.state["tie_points"] = len(self.values)
+
+
+class Chunk:
+    def __init__(self, state, key=0):
+        self.state = state
+        self.key = state.get("key", key)
+        self.label = state["label"]
+        self.enabled = state.get("enabled", True)
+        self.crs = None
+        self.primary_channel = 0
+        self.raster_transform = RasterTransform()
+        self.sensors = [Sensor(name, i) for i, name in enumerate(
+            ["Blue", "Green", "Panchro", "Red", "Red edge", "NIR", "LWIR"])]
+        # The images are laid out on a square grid, 10 m apart
+        side = max(int(state["images"] ** 0.5), 1)
+        disabled = set(state.get("disabled_cameras", []))
+        self.cameras = [Camera(f"IMG_{i:04d}", state["aligned"], [10.0 * (i % side), 10.0 * (i // side), 0.0],
+                               enabled=f"IMG_{i:04d}" not in disabled) for i in range(state["images"])]
+        self.tie_points = _Product(self, "tie_points") if state["aligned"] else None
+        region = state.get("region") or {"center": [5.0 * (side - 1), 5.0 * (side - 1), 0.0],
+                                         "size": [10.0 * side, 10.0 * side, 50.0]}
+        self.region = Region(region["center"], region["size"])
+        self.transform = ChunkTransform()
+
+    def _sync(self):
+        """Keep the settings the scripts change in the saved state."""
+        self.state["label"] = self.label
+        self.state["region"] = {"center": list(self.region.center), "size": list(self.region.size)}
+        self.state["disabled_cameras"] = [camera.label for camera in self.cameras if not camera.enabled]
+
+    def _product(self, kind, cls=_Product):
+        return cls(self, kind) if self.state.get(kind) else None
+
+    @property
+    def depth_maps(self):
+        return self._product("depth_maps")
+
+    @property
+    def point_cloud(self):
+        return self._product("point_cloud")
+
+    @property
+    def model(self):
+        return self._product("model", _Model)
+
+    @property
+    def orthomosaic(self):
+        return self._product("orthomosaic")
+
+    @property
+    def elevations(self):
+        return [_Product(self, "dem", key) for key in self.state["elevations"]]
+
+    @property
+    def elevation(self):
+        active = self.state.get("active_elevation")
+        return _Product(self, "dem", active) if active is not None else None
+
+    @elevation.setter
+    def elevation(self, product):
+        self.state["active_elevation"] = product.key
+
+    def matchPhotos(self, progress=None, **kwargs):
+        _simulate("matchPhotos", len(self.cameras), progress)
+
+    def alignCameras(self, progress=None, **kwargs):
+        _simulate("alignCameras", len(self.cameras), progress)
+        self.state["aligned"] = True
+        for camera in self.cameras:
+            camera.transform = [1.0]
+        self.tie_points = _Product(self, "tie_points")
+
+    def optimizeCameras(self, progress=None, **kwargs):
+        _simulate("optimizeCameras", progress=progress)
+
+    def buildDepthMaps(self, progress=None, **kwargs):
+        _simulate("buildDepthMaps", len(self.cameras), progress)
+        self.state["depth_maps"] = True
+
+    def buildPointCloud(self, progress=None, **kwargs):
+        _simulate("buildPointCloud", len(self.cameras), progress)
+        self.state["point_cloud"] = True
+
+    def buildModel(self, progress=None, **kwargs):
+        _simulate("buildModel", progress=progress)
+        self.state["model"] = True
+
+    def decimateModel(self, progress=None, **kwargs):
+        _simulate("decimateModel", progress=progress)
+
+    def smoothModel(self, *args, progress=None, **kwargs):
+        _simulate("smoothModel", progress=progress)
+
+    def buildDem(self, progress=None, **kwargs):
+        _simulate("buildDem", progress=progress)
+        key = max(self.state["elevations"], default=-1) + 1
+        self.state["elevations"].append(key)
+        self.state["active_elevation"] = key
+
+    def buildOrthomosaic(self, progress=None, **kwargs):
+        _simulate("buildOrthomosaic", progress=progress)
+        self.state["orthomosaic"] = True
+
+    def exportRaster(self, path=None, progress=None, **kwargs):
+        _simulate("exportRaster", progress=progress)
+        _write_output(path, CONFIG["export_mb"]["raster"])
+
+    def exportPointCloud(self, path=None, progress=None, **kwargs):
+        _simulate("exportPointCloud", progress=progress)
+        _write_output(path, CONFIG["export_mb"]["point_cloud"])
+
+    def exportReport(self, path=None, progress=None, **kwargs):
+        _simulate("exportReport", progress=progress)
+        _write_output(path, CONFIG["export_mb"]["report"])
+
+    def remove(self, items):
+        items = items if isinstance(items, list) else [items]
+        for item in items:
+            if item.kind == "dem":
+                self.state["elevations"].remove(item.key)
+                if self.state.get("active_elevation") == item.key:
+                    self.state["active_elevation"] = None
+            else:
+                self.state[item.kind] = False
+
+
+def state_path(project_path):
+    return os.path.splitext(project_path)[0] + ".files" + os.sep + "fake_state.json"
+
+
+def new_chunk_state(label, images):
+    return {"label": label, "images": images, "aligned": False, "depth_maps": False, "point_cloud": False,
+            "model": False, "orthomosaic": False, "classified": False, "elevations": [], "active_elevation": None}
+
+
+class Document:
+    def __init__(self):
+        self.path = None
+        self.chunks = []
+        self.read_only = False
+
+    @property
+    def chunk(self):
+        return self.chunks[0] if self.chunks else None
+
+    def open(self, path, read_only=False, ignore_lock=False):
+        start_time = time.time()
+        with open(state_path(path), 'r') as file:
+            state = json.load(file)
+        time.sleep(CONFIG["latency"]["open"] * CONFIG["time_scale"])
+        self.path = path
+        self.read_only = read_only
+        self.chunks = [Chunk(chunk_state, key) for key, chunk_state in enumerate(state["chunks"])]
+        _record("open", time.time() - start_time)
+
+    def append(self, document, chunks=None, progress=None):
+        for chunk in chunks or document.chunks:
+            chunk._sync()
+            state = json.loads(json.dumps(chunk.state))
+            state.pop("key", None)
+            self.chunks.append(Chunk(state, len(self.chunks)))
+
+    def _products_gb(self):
+        sizes = CONFIG["sizes_mb"]
+        total_mb = 0
+        for chunk in self.chunks:
+            state = chunk.state
+            total_mb += sum(sizes[kind] for kind in ("depth_maps", "point_cloud", "model", "orthomosaic") if state[kind])
+            total_mb += sizes["dem"] * len(state["elevations"])
+        return total_mb / 1024
+
+    def save(self, path=None):
+        start_time = time.time()
+        path = path or self.path
+        seconds = CONFIG["save_seconds"] + CONFIG["save_seconds_per_gb"] * self._products_gb()
+        time.sleep(seconds * CONFIG["time_scale"])
+        os.makedirs(os.path.dirname(state_path(path)), exist_ok=True)
+        for chunk in self.chunks:
+            chunk._sync()
+        with open(state_path(path), 'w') as file:
+            json.dump({"chunks": [chunk.state for chunk in self.chunks]}, file)
+        if not os.path.exists(path):
+            with open(path, 'w') as file:
+                file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                           '<document version="2.0.0" path="{projectname}.files/project.zip"/>\n')
+        self.path = path
+        _record("save", time.time() - start_time)
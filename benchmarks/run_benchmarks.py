@@ -0,0 +1,186 @@
+"""
+Benchmark the processing scripts against the fake Metashape module.
+
+Every selected entry point processes synthetic project lists of the given sizes with
+each worker count. The report lists wall time, the time spent opening and saving
+projects and the speed-up over a single worker.
+
+    python benchmarks/run_benchmarks.py --projects 1,10,100 --workers 1,2,4
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import contextlib
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+FAKE_METASHAPE_DIR = os.path.join(BENCHMARK_DIR, "fake_metashape")
+
+# The fake module has to shadow a real Metashape install, also in spawned workers
+sys.path[:0] = [FAKE_METASHAPE_DIR, REPO_DIR]
+os.environ["PYTHONPATH"] = os.pathsep.join([FAKE_METASHAPE_DIR, REPO_DIR, os.environ.get("PYTHONPATH", "")])
+
+import Metashape  # noqa: E402
+
+ENTRY_POINTS = {
+    "AlignProcessExportGeco2024": "process_multiple_projects",
+    "Geco2024AlignDemOrthoExport": "process_multiple_projects",
+    "Geco2024AlignModelOrthoExport": "process_multiple_projects",
+    "Geco2024GroundPointDTM": "process_multiple_projects",
+}
+
+
+def create_projects(directory, count, images, processed=False):
+    """Create `count` synthetic projects, each in its own flight folder like on the storage."""
+    project_paths = []
+    for i in range(count):
+        label = f"2024{(i % 12) + 1:02d}{(i % 28) + 1:02d}_site{i:03d}"
+        project_path = os.path.join(directory, label, label + ".psx")
+        os.makedirs(os.path.dirname(Metashape.state_path(project_path)), exist_ok=True)
+        with open(project_path, 'w') as file:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<document version="2.0.0" path="{projectname}.files/project.zip"/>\n')
+        state = Metashape.new_chunk_state(label, images)
+        if processed:
+            # The ground classification script starts from an aligned project with a point cloud
+            state.update(aligned=True, depth_maps=True, point_cloud=True, orthomosaic=True,
+                         elevations=[0], active_elevation=0)
+        with open(Metashape.state_path(project_path), 'w') as file:
+            json.dump({"chunks": [state]}, file)
+        project_paths.append(project_path)
+    return project_paths
+
+
+def collect_call_stats(stats_dir):
+    """Sum the durations recorded by the fake module in all processes, per call."""
+    totals = {}
+    for name in os.listdir(stats_dir):
+        with open(os.path.join(stats_dir, name), 'r') as file:
+            for line in file:
+                record = json.loads(line)
+                count, seconds = totals.get(record["call"], (0, 0.0))
+                totals[record["call"]] = (count + 1, seconds + record["seconds"])
+    return totals
+
+
+@contextlib.contextmanager
+def silenced(log_path):
+    """Send the output of the scripts and their worker processes to a log file."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+    with open(log_path, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+
+
+def run_case(entry_point, project_count, workers, images, work_dir, log_path):
+    module = importlib.import_module(entry_point)
+    process_multiple_projects = getattr(module, ENTRY_POINTS[entry_point])
+
+    case_dir = tempfile.mkdtemp(dir=work_dir)
+    stats_dir = os.path.join(case_dir, "stats")
+    os.makedirs(stats_dir)
+    project_paths = create_projects(os.path.join(case_dir, "projects"), project_count, images,
+                                    processed=entry_point == "Geco2024GroundPointDTM")
+    os.environ["FAKE_METASHAPE_STATS"] = stats_dir
+
+    start_time = time.time()
+    with silenced(log_path):
+        results = process_multiple_projects(project_paths, workers=workers)
+    wall_time = time.time() - start_time
+    del os.environ["FAKE_METASHAPE_STATS"]
+
+    calls = collect_call_stats(stats_dir)
+    shutil.rmtree(case_dir, ignore_errors=True)
+    return {
+        "entry_point": entry_point,
+        "projects": project_count,
+        "workers": workers,
+        "images": images,
+        "wall_time": wall_time,
+        "failed": sum(1 for result in results if result["status"] != "ok"),
+        "opens": calls.get("open", (0, 0.0))[0],
+        "open_time": calls.get("open", (0, 0.0))[1],
+        "saves": calls.get("save", (0, 0.0))[0],
+        "save_time": calls.get("save", (0, 0.0))[1],
+        "calls": {call: {"count": count, "seconds": seconds} for call, (count, seconds) in calls.items()},
+    }
+
+
+def print_table(rows):
+    print(f"{'entry point':32} {'projects':>8} {'workers':>7} {'wall s':>9} {'speed-up':>8} "
+          f"{'opens':>6} {'open s':>8} {'saves':>6} {'save s':>8} {'failed':>6}")
+    single_worker = {(r["entry_point"], r["projects"]): r["wall_time"] for r in rows if r["workers"] == 1}
+    for r in rows:
+        baseline = single_worker.get((r["entry_point"], r["projects"]))
+        speed_up = f"{baseline / r['wall_time']:.2f}x" if baseline else "-"
+        print(f"{r['entry_point']:32} {r['projects']:8d} {r['workers']:7d} {r['wall_time']:9.2f} {speed_up:>8} "
+              f"{r['opens']:6d} {r['open_time']:8.2f} {r['saves']:6d} {r['save_time']:8.2f} {r['failed']:6d}")
+
+
+def parse_counts(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing scripts with a fake Metashape module.")
+    parser.add_argument('--projects', type=parse_counts, default=[1, 10, 50],
+                        help='Comma separated project list sizes (default: 1,10,50).')
+    parser.add_argument('--workers', type=parse_counts, default=[1, 2, 4],
+                        help='Comma separated worker counts (default: 1,2,4).')
+    parser.add_argument('--entry-points', type=str, default=",".join(ENTRY_POINTS),
+                        help='Comma separated scripts to benchmark (default: all).')
+    parser.add_argument('--images', type=int, default=200, help='Images per synthetic project.')
+    parser.add_argument('--config', type=str, default=None,
+                        help='JSON file overriding the fake Metashape latencies and sizes (see benchmarks/fake_metashape/Metashape.py).')
+    parser.add_argument('--output', type=str, default=None, help='Write the results as JSON to this file.')
+    parser.add_argument('--log', type=str, default=os.path.join(tempfile.gettempdir(), "benchmark_scripts.log"),
+                        help='File receiving the output of the benchmarked scripts.')
+    args = parser.parse_args()
+
+    if args.config:
+        os.environ["FAKE_METASHAPE_CONFIG"] = os.path.abspath(args.config)
+        Metashape.CONFIG = Metashape._load_config()
+
+    entry_points = [e.strip() for e in args.entry_points.split(",") if e.strip()]
+    unknown = [e for e in entry_points if e not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"Unknown entry points: {', '.join(unknown)}")
+
+    rows = []
+    work_dir = tempfile.mkdtemp(prefix="geco_benchmark_")
+    try:
+        for entry_point in entry_points:
+            for project_count in args.projects:
+                for workers in args.workers:
+                    print(f"Running {entry_point} with {project_count} projects and {workers} worker(s)...", flush=True)
+                    rows.append(run_case(entry_point, project_count, workers, args.images, work_dir, args.log))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print_table(rows)
+    print(f"\nOutput of the scripts: {args.log}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(rows, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
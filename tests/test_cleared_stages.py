@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+
+# The processing scripts run against the stand-in Metashape module of the benchmarks
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+sys.path[:0] = [os.path.join(BENCHMARKS_DIR, "fake_metashape"), BENCHMARKS_DIR]
+
+import Metashape
+import AlignProcessExportGeco2024
+import ClearinStorageSpace
+from StageManifest import StageManifest
+from run_benchmarks import create_projects
+
+Metashape.CONFIG["time_scale"] = 0
+
+
+def chunk_state(project_path):
+    with open(Metashape.state_path(project_path), 'r') as file:
+        return json.load(file)["chunks"][0]
+
+
+def stage_names(stats):
+    return [record["stage"] for record in stats["stages"]]
+
+
+def test_rerun_rebuilds_cleared_depth_maps_in_the_same_run(tmp_path):
+    [project_path] = create_projects(str(tmp_path), 1, 10)
+    AlignProcessExportGeco2024.process_project(project_path)
+
+    ClearinStorageSpace.reclaim_project(project_path, artifacts=("depth_maps",))
+    assert not chunk_state(project_path)["depth_maps"]
+    # The point cloud and everything built from it stay valid without the depth maps
+    assert "depth_maps" not in stage_names(AlignProcessExportGeco2024.process_project(project_path))
+
+    # Losing the point cloud needs the cleared depth maps again
+    with open(Metashape.state_path(project_path), 'r') as file:
+        state = json.load(file)
+    state["chunks"][0]["point_cloud"] = False
+    with open(Metashape.state_path(project_path), 'w') as file:
+        json.dump(state, file)
+
+    stages = stage_names(AlignProcessExportGeco2024.process_project(project_path))
+    assert stages.index("depth_maps") < stages.index("point_cloud") < stages.index("dem")
+    assert chunk_state(project_path)["depth_maps"] and chunk_state(project_path)["point_cloud"]
+    manifest = StageManifest(project_path, 0)
+    assert not {"cleared", "needed_by"} & set(manifest.stages["depth_maps"])
+
+    # The rebuilt chunk is up to date again
+    assert not any(name in stage_names(AlignProcessExportGeco2024.process_project(project_path))
+                   for name in ("depth_maps", "point_cloud", "dem", "dtm"))
@@ -0,0 +1,37 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+rasterio = pytest.importorskip("rasterio")
+
+import GroundFilter
+
+
+def write_ply(path, x, y, z):
+    points = np.zeros(x.size, dtype=[("x", "<f4"), ("y", "<f4"), ("z", "<f4")])
+    points["x"], points["y"], points["z"] = x, y, z
+    with open(path, "wb") as file:
+        file.write(f"ply\nformat binary_little_endian 1.0\nelement vertex {x.size}\n"
+                   f"property float x\nproperty float y\nproperty float z\nend_header\n".encode())
+        file.write(points.tobytes())
+
+
+def build(cloud_path, output_path, tile_size):
+    GroundFilter.build_dtm(str(cloud_path), str(output_path), resolution=1.0, tile_size=tile_size, workers=1)
+    with rasterio.open(output_path) as dtm:
+        # Rows count down from the top of the grid, which is padded to whole tiles above the cloud
+        return dtm.read(1)[-60:, :60]
+
+
+@pytest.mark.parametrize("tile_size", [15, 10, 4])
+def test_small_tiles_give_the_dtm_of_one_tile(tmp_path, tile_size):
+    """With the buffer (the 20 m cell size) larger than half a tile, a cell reaches three or more tiles per axis."""
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(0, 60, 40000), rng.uniform(0, 60, 40000)
+    z = 0.05 * x + rng.uniform(0, 0.1, x.size)
+    z[(x > 20) & (x < 30) & (y > 20) & (y < 30)] += 5
+    cloud_path = tmp_path / "cloud.ply"
+    write_ply(cloud_path, x, y, z)
+
+    expected = build(cloud_path, tmp_path / "one_tile.tif", 250)
+    assert (expected != GroundFilter.OUTPUT_NODATA).sum() > 0.9 * expected.size
+    np.testing.assert_array_equal(build(cloud_path, tmp_path / "small_tiles.tif", tile_size), expected)